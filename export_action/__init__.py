@@ -1 +1,3 @@
 __version__ = '0.1.1'
+
+default_app_config = 'export_action.apps.ExportActionConfig'
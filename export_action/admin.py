@@ -1,20 +1,43 @@
-import uuid
+from django import forms
 from django.contrib import admin
 from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect
+from django.utils.http import urlencode
 from django.utils.translation import ugettext_lazy as _
 
+from .selection import save_selection
+
+
+def get_export_options(model_admin):
+    """ Return the `report.report_to_iterator` options declared on
+    `model_admin`, if any.
+    """
+    options = {}
+    if getattr(model_admin, 'export_computed_fields', None):
+        options['computed'] = dict(model_admin.export_computed_fields)
+    if getattr(model_admin, 'export_formats', None):
+        options['formats'] = dict(model_admin.export_formats)
+    return options
+
 
 def export_selected_objects(modeladmin, request, queryset):
-    selected = list(queryset.values_list('id', flat=True))
     ct = ContentType.objects.get_for_model(queryset.model)
     url = reverse("export_action:export")
 
+    if forms.BooleanField().to_python(request.POST.get('select_across')):
+        # All objects of the changelist were selected: pass on its filters,
+        # search and ordering, so the export view can build the same queryset.
+        return HttpResponseRedirect("%s?%s" % (url, urlencode([
+            ('ct', ct.pk),
+            ('select_across', 1),
+            ('_changelist_filters', request.GET.urlencode()),
+        ])))
+
+    selected = list(queryset.values_list('id', flat=True))
     if len(selected) > 1000:
-        session_key = "export_action_%s" % uuid.uuid4()
-        request.session[session_key] = selected
-        return HttpResponseRedirect("%s?ct=%s&session_key=%s" % (url, ct.pk, session_key))
+        token = save_selection(selected)
+        return HttpResponseRedirect("%s?ct=%s&selection=%s" % (url, ct.pk, token))
     else:
         return HttpResponseRedirect(
             "%s?ct=%s&ids=%s" % (url, ct.pk, ",".join(str(pk) for pk in selected)))
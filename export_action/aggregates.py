@@ -0,0 +1,58 @@
+# coding: utf-8
+
+from __future__ import unicode_literals, absolute_import
+
+import django
+from django.db.models import Aggregate, TextField
+
+from .expressions import Cast
+
+
+SEPARATOR = ','
+
+
+class DistinctAggregate(Aggregate):
+    """ Aggregate of text values accepting `distinct`, which Django<1.11
+    aggregates do not.
+    """
+    template = '%(function)s(%(distinct)s%(expressions)s)'
+    allow_distinct = True
+
+    def __init__(self, expression, distinct=False, **extra):
+        extra['output_field'] = TextField()
+        if django.VERSION >= (2, 2):
+            extra['distinct'] = distinct
+        else:
+            extra['distinct'] = 'DISTINCT ' if distinct else ''
+        super(DistinctAggregate, self).__init__(expression, **extra)
+
+
+class GroupConcat(DistinctAggregate):
+    """ GROUP_CONCAT of SQLite and MySQL.
+
+    SQLite only accepts the default separator along with DISTINCT, so
+    `SEPARATOR` is used for every database.
+    """
+    function = 'GROUP_CONCAT'
+
+    def as_mysql(self, compiler, connection):
+        return self.as_sql(
+            compiler, connection,
+            template="%%(function)s(%%(distinct)s%%(expressions)s SEPARATOR '%s')" % SEPARATOR)
+
+
+class StringAgg(DistinctAggregate):
+    """ STRING_AGG of PostgreSQL, joining text values with `SEPARATOR`. """
+    function = 'STRING_AGG'
+    template = "%%(function)s(%%(distinct)s%%(expressions)s, '%s')" % SEPARATOR
+
+
+def get_string_agg(vendor):
+    """ Return a function building an aggregate that joins the distinct
+    values of a field path in a string, or None if `vendor` has none.
+    """
+    if vendor == 'postgresql':
+        return lambda path: StringAgg(Cast(path, TextField()), distinct=True)
+    if vendor in ('sqlite', 'mysql'):
+        return lambda path: GroupConcat(path, distinct=True)
+    return None
@@ -0,0 +1,14 @@
+# coding: utf-8
+
+from __future__ import unicode_literals, absolute_import
+
+from django.apps import AppConfig
+
+
+class ExportActionConfig(AppConfig):
+    name = 'export_action'
+    verbose_name = 'Export action'
+
+    def ready(self):
+        # Connects the receivers bumping model versions of cached results
+        from . import results  # noqa
@@ -0,0 +1,186 @@
+# coding: utf-8
+"""
+Parquet and Arrow IPC exports.
+
+Rows are converted to Arrow record batches of `EXPORT_ACTION_CHUNK_SIZE`
+rows, typed after the model fields they are read from, and written as they
+come, so memory usage does not grow with the number of rows. Parquet files
+keep batches until they have `EXPORT_ACTION_PARQUET_ROW_GROUP_SIZE` rows,
+written as one row group, as readers handle few large row groups better
+than many small ones.
+
+These formats need `pyarrow`, which is only imported when they are used.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+import pkgutil
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import force_text
+
+from .introspection import get_value_field
+
+
+FORMATS = ('parquet', 'arrow')
+
+CONTENT_TYPES = {
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.file',
+}
+
+INTEGER_FIELDS = (
+    'AutoField', 'BigAutoField', 'BigIntegerField', 'IntegerField', 'PositiveIntegerField',
+    'PositiveSmallIntegerField', 'SmallIntegerField',
+)
+
+
+def is_available():
+    """ Return whether `pyarrow` is installed, without importing it """
+    return pkgutil.find_loader('pyarrow') is not None
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet  # noqa
+    except ImportError:
+        raise ImproperlyConfigured("pyarrow is required to export to parquet and arrow.")
+    return pyarrow
+
+
+def _to_text(value):
+    return None if value is None else force_text(value)
+
+
+def get_arrow_type(pa, field):
+    """ Return the Arrow type of the values of a model `field`, and a function
+    converting them, or None if they need no conversion.
+    Values of unknown fields, or of no field, are exported as text.
+    """
+    field = get_value_field(field)
+    internal_type = field.get_internal_type() if field is not None else None
+
+    if internal_type in INTEGER_FIELDS:
+        return pa.int64(), None
+    if internal_type in ('BooleanField', 'NullBooleanField'):
+        return pa.bool_(), None
+    if internal_type == 'FloatField':
+        return pa.float64(), None
+    if internal_type == 'DecimalField':
+        return pa.decimal128(field.max_digits, field.decimal_places), None
+    if internal_type == 'DateTimeField':
+        return pa.timestamp('us', tz='UTC' if settings.USE_TZ else None), None
+    if internal_type == 'DateField':
+        return pa.date32(), None
+    if internal_type == 'TimeField':
+        return pa.time64('us'), None
+    if internal_type == 'DurationField':
+        return pa.duration('us'), None
+    if internal_type == 'BinaryField':
+        return pa.binary(), lambda value: None if value is None else bytes(value)
+    return pa.string(), _to_text
+
+
+def get_arrow_schema(pa, columns):
+    """ Return the schema of `columns`, a list of (name, field) like the
+    result of `report.get_export_columns`, and the converters of each column.
+    """
+    types, converters = [], []
+    for name, field in columns:
+        arrow_type, converter = get_arrow_type(pa, field)
+        types.append(pa.field(name, arrow_type))
+        converters.append(converter)
+    return pa.schema(types), converters
+
+
+def iter_record_batches(pa, data, schema, converters, chunk_size=None):
+    """ Group rows of `data` in record batches of `chunk_size` rows """
+    from .report import _get_chunk_size  # report imports this module
+    chunk_size = chunk_size or _get_chunk_size()
+    chunk = []
+    for row in data:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield _to_record_batch(pa, chunk, schema, converters)
+            chunk = []
+    if chunk:
+        yield _to_record_batch(pa, chunk, schema, converters)
+
+
+def _to_record_batch(pa, rows, schema, converters):
+    arrays = []
+    for i, converter in enumerate(converters):
+        values = [row[i] for row in rows]
+        if converter is not None:
+            values = [converter(value) for value in values]
+        arrays.append(pa.array(values, type=schema.types[i]))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class _ChunkSink(object):
+    """ Write-only file keeping what is written until `pop` is called.
+    Positions keep growing, as writers record offsets in the file footer.
+    """
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_columnar(data, format, columns, chunk_size=None, row_group_size=None):
+    """ Write rows of `data` as a parquet or arrow file of `columns`, a list
+    of (name, field), yielding chunks of bytes after every record batch, or
+    every row group of `row_group_size` rows for parquet.
+    """
+    pa = _import_pyarrow()
+    schema, converters = get_arrow_schema(pa, columns)
+    sink = _ChunkSink()
+    stream = pa.PythonFile(sink, mode='w')
+    if format == 'parquet':
+        writer = pa.parquet.ParquetWriter(stream, schema)
+        row_group_size = row_group_size or getattr(
+            settings, 'EXPORT_ACTION_PARQUET_ROW_GROUP_SIZE', 100000)
+    else:
+        writer = pa.ipc.new_file(stream, schema)
+
+    batches, rows = [], 0
+    for batch in iter_record_batches(pa, data, schema, converters, chunk_size):
+        if format == 'parquet':
+            batches.append(batch)
+            rows += batch.num_rows
+            if rows < row_group_size:
+                continue
+            writer.write_table(pa.Table.from_batches(batches))
+            batches, rows = [], 0
+        else:
+            writer.write_batch(batch)
+        chunk = sink.pop()
+        if chunk:
+            yield chunk
+    if batches:
+        writer.write_table(pa.Table.from_batches(batches))
+    writer.close()
+    yield sink.pop()
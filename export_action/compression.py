@@ -0,0 +1,117 @@
+# coding: utf-8
+"""
+Compression of streamed exports.
+
+Chunks of bytes are compressed as they are produced, either as a gzip file
+or as the single entry of a zip archive. Zip archives are written without
+seeking, with a data descriptor after the entry and zip64 records, so
+entries have no size limit.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+import struct
+import zlib
+
+from django.conf import settings
+from django.utils import timezone
+
+
+COMPRESSIONS = ('gzip', 'zip')
+
+CONTENT_TYPES = {
+    'gzip': 'application/gzip',
+    'zip': 'application/zip',
+}
+
+EXTENSIONS = {
+    'gzip': '.gz',
+    'zip': '.zip',
+}
+
+ZIP64_VERSION = 45
+ZIP_FLAGS = 0x08 | 0x800  # data descriptor, utf-8 file name
+ZIP_DEFLATED = 8
+ZIP64_LIMIT = 0xFFFFFFFF
+
+
+def iter_gzip(chunks):
+    """ Compress `chunks` of bytes as a gzip file, yielding chunks of bytes """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _dos_date_time(when):
+    date = (when.year - 1980) << 9 | when.month << 5 | when.day
+    time = when.hour << 11 | when.minute << 5 | when.second // 2
+    return date, time
+
+
+def iter_zip(chunks, filename):
+    """ Compress `chunks` of bytes as the `filename` entry of a zip archive,
+    yielding chunks of bytes.
+    """
+    name = filename.encode('utf-8')
+    now = timezone.now()
+    date, time = _dos_date_time(timezone.localtime(now) if settings.USE_TZ else now)
+
+    # Sizes and crc are unknown yet, they follow the data in a descriptor
+    local_extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+    header = struct.pack(
+        '<IHHHHHIIIHH', 0x04034b50, ZIP64_VERSION, ZIP_FLAGS, ZIP_DEFLATED, time, date,
+        0, ZIP64_LIMIT, ZIP64_LIMIT, len(name), len(local_extra))
+    header += name + local_extra
+    yield header
+
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc, size, compressed_size = 0, 0, 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        data = compressor.compress(chunk)
+        if data:
+            compressed_size += len(data)
+            yield data
+    data = compressor.flush()
+    compressed_size += len(data)
+    crc &= 0xFFFFFFFF
+    yield data + struct.pack('<IIQQ', 0x08074b50, crc, compressed_size, size)
+
+    directory_offset = len(header) + compressed_size + 24
+    central_extra = struct.pack('<HHQQQ', 1, 24, size, compressed_size, 0)
+    directory = struct.pack(
+        '<IHHHHHHIIIHHHHHII', 0x02014b50, ZIP64_VERSION, ZIP64_VERSION, ZIP_FLAGS,
+        ZIP_DEFLATED, time, date, crc, ZIP64_LIMIT, ZIP64_LIMIT, len(name),
+        len(central_extra), 0, 0, 0, 0o644 << 16, ZIP64_LIMIT)
+    directory += name + central_extra
+
+    end_offset = directory_offset + len(directory)
+    end = struct.pack(
+        '<IQHHIIQQQQ', 0x06064b50, 44, ZIP64_VERSION, ZIP64_VERSION, 0, 0, 1, 1,
+        len(directory), directory_offset)
+    end += struct.pack('<IIQI', 0x07064b50, 0, end_offset, 1)
+    end += struct.pack(
+        '<IHHHHIIH', 0x06054b50, 0, 0, 0xFFFF, 0xFFFF, ZIP64_LIMIT, ZIP64_LIMIT, 0)
+    yield directory + end
+
+
+def get_filename(filename, method):
+    """ Return the name of the compressed file of `filename`: gzip files
+    keep the name of the format, zip archives replace it.
+    """
+    if method == 'zip':
+        filename = filename.rsplit('.', 1)[0]
+    return filename + EXTENSIONS[method]
+
+
+def iter_compressed(chunks, method, filename):
+    """ Compress `chunks` with one of `COMPRESSIONS`. `filename` is the name
+    of the zip archive entry.
+    """
+    if method == 'gzip':
+        return iter_gzip(chunks)
+    return iter_zip(chunks, filename)
@@ -0,0 +1,160 @@
+# coding: utf-8
+"""
+Conversion of exported values for each format.
+
+A converter is chosen once per column, after the model field its values are
+read from, and applied to a whole batch of rows at a time, column by column.
+Columns whose values can be written as they are, like numbers in a
+workbook, are not converted at all.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+from itertools import islice
+import base64
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import six, timezone
+from django.utils.encoding import force_text
+from django.utils.html import escape
+from django.utils.six import text_type
+from django.utils.text import normalize_newlines
+
+from .introspection import get_value_field
+
+
+# Values of these fields have no html special characters once made text
+HTML_SAFE_TYPES = {
+    'AutoField', 'BigAutoField', 'BigIntegerField', 'BooleanField', 'DateField',
+    'DateTimeField', 'DecimalField', 'DurationField', 'FloatField', 'IntegerField',
+    'NullBooleanField', 'PositiveIntegerField', 'PositiveSmallIntegerField',
+    'SmallIntegerField', 'TimeField', 'UUIDField',
+}
+
+# Fields whose values are json types
+JSON_TYPES = {'JSONField', 'HStoreField', 'ArrayField'}
+
+
+def binary_to_text(value):
+    return force_text(base64.b64encode(bytes(value)))
+
+
+def json_to_text(value):
+    return json.dumps(value, cls=DjangoJSONEncoder, ensure_ascii=False)
+
+
+def to_naive_datetime(value):
+    """ Excel has no time zones, aware datetimes are written in the current
+    time zone.
+    """
+    if timezone.is_aware(value):
+        return timezone.make_naive(value)
+    return value
+
+
+def to_cell(value):
+    """ Convert a value of unknown type for openpyxl """
+    if isinstance(value, six.binary_type):
+        return value.decode('utf-8', 'ignore')
+    elif type(value) is dict:
+        return text_type(value)
+    return value
+
+
+def html_cell(value):
+    """ Same as `{{ value|linebreaksbr }}` in report_html.html """
+    return escape(normalize_newlines(force_text(value))).replace('\n', '<br />')
+
+
+def _get_xlsx_converter(internal_type):
+    if internal_type is None:
+        return to_cell
+    if internal_type == 'DateTimeField' and settings.USE_TZ:
+        return to_naive_datetime
+    if internal_type == 'UUIDField':
+        return text_type
+    if internal_type == 'BinaryField':
+        return binary_to_text
+    if internal_type in JSON_TYPES:
+        return json_to_text
+    return None
+
+
+def _get_csv_converter(internal_type):
+    # The csv module writes everything else as str() does
+    if internal_type is None:
+        return force_text
+    if internal_type == 'BinaryField':
+        return binary_to_text
+    if internal_type in JSON_TYPES:
+        return json_to_text
+    return None
+
+
+def _get_html_converter(internal_type):
+    if internal_type in HTML_SAFE_TYPES:
+        return force_text
+    if internal_type == 'BinaryField':
+        return binary_to_text
+    if internal_type in JSON_TYPES:
+        return lambda value: html_cell(json_to_text(value))
+    return html_cell
+
+
+TARGETS = {
+    'xlsx': (_get_xlsx_converter, None),
+    'csv': (_get_csv_converter, 'None'),
+    'html': (_get_html_converter, 'None'),
+}
+
+
+def _skip_null(convert, null):
+    def converter(value):
+        return null if value is None else convert(value)
+    return converter
+
+
+def get_converters(columns, target):
+    """ Return a converter of values for each of `columns`, as returned by
+    `report.get_export_columns`, to write them to `target`, one of
+    `TARGETS`. A converter is None when values are written as they are.
+
+    Returns list of converters, value written for nulls.
+    """
+    get_converter, null = TARGETS[target]
+    converters = []
+    for name, field in columns:
+        field = get_value_field(field)
+        convert = get_converter(field.get_internal_type() if field is not None else None)
+        converters.append(convert and _skip_null(convert, null))
+    return converters, null
+
+
+def convert_rows(rows, converters, null=None, batch_size=None):
+    """ Yield `rows` with the values of each column converted by its
+    converter from `get_converters`, a batch of `batch_size` rows
+    (`EXPORT_ACTION_CHUNK_SIZE`) at a time. Nulls of columns without a
+    converter are replaced by `null`.
+    """
+    from .report import _get_chunk_size  # report imports this module
+    batch_size = batch_size or _get_chunk_size()
+    if null is None and not any(converters):
+        for row in rows:
+            yield row
+        return
+
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        columns = list(zip(*batch))
+        for i, convert in enumerate(converters):
+            if convert is not None:
+                columns[i] = list(map(convert, columns[i]))
+            elif null is not None and None in columns[i]:
+                columns[i] = [null if value is None else value for value in columns[i]]
+        for row in zip(*columns):
+            yield row
@@ -0,0 +1,127 @@
+# coding: utf-8
+"""
+Database expressions formatting exported values, so rows come out of the
+database ready to be written.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+import re
+
+from django.db.models import Case, CharField, Func, TextField, Value, When
+from django.utils.encoding import force_text
+
+try:
+    from django.db.models.functions import Cast
+except ImportError:  # Django<1.10
+    class Cast(Func):
+        """ Cast `expression` to the database type of `output_field`, like
+        `Cast` of Django>=1.10.
+        """
+        function = 'CAST'
+        template = '%(function)s(%(expressions)s AS %(db_type)s)'
+
+        def __init__(self, expression, output_field):
+            super(Cast, self).__init__(expression, output_field=output_field)
+
+        def as_sql(self, compiler, connection, db_type=None):
+            self.extra['db_type'] = db_type or self.output_field.db_type(connection)
+            return super(Cast, self).as_sql(compiler, connection)
+
+        def as_mysql(self, compiler, connection):
+            # MySQL only casts to a few types, text values to char
+            return self.as_sql(compiler, connection, db_type='char')
+
+
+# strftime directives supported by `DateFormat`, per database
+SQLITE_FORMATS = {
+    '%Y': '%Y', '%m': '%m', '%d': '%d', '%j': '%j', '%H': '%H', '%M': '%M', '%S': '%S',
+    '%%': '%%',
+}
+POSTGRESQL_FORMATS = {
+    '%Y': 'YYYY', '%m': 'MM', '%d': 'DD', '%j': 'DDD', '%H': 'HH24', '%M': 'MI', '%S': 'SS',
+    '%%': '%',
+}
+MYSQL_FORMATS = {
+    '%Y': '%Y', '%m': '%m', '%d': '%d', '%j': '%j', '%H': '%H', '%M': '%i', '%S': '%s',
+    '%%': '%%',
+}
+
+
+def _translate_format(format, directives, quote=None):
+    """ Translate a strftime `format` with the `directives` of a database.
+    Literal text is wrapped in `quote`, if given.
+    """
+    parts = []
+    for token in re.split(r'(%.)', format):
+        if not token:
+            continue
+        if token.startswith('%'):
+            if token not in directives:
+                raise ValueError("Unsupported date format directive %r" % token)
+            parts.append(directives[token])
+        else:
+            parts.append(quote + token + quote if quote else token)
+    return ''.join(parts)
+
+
+class DateFormat(Func):
+    """ Format a date or datetime with a strftime `format`, like
+    `DateFormat('created_on', '%Y-%m-%d')`.
+
+    SQLite, PostgreSQL and MySQL support the %Y, %m, %d, %j, %H, %M and %S
+    directives; other databases fall back to the ISO format.
+    Datetimes are formatted as stored, which is UTC when USE_TZ is on.
+    """
+
+    def __init__(self, expression, format, **extra):
+        self.format = format
+        extra['output_field'] = CharField()
+        super(DateFormat, self).__init__(expression, **extra)
+
+    def _func(self, function, *expressions):
+        return Func(*expressions, function=function, output_field=CharField())
+
+    def as_sql(self, compiler, connection):
+        return Cast(self.get_source_expressions()[0], TextField()).as_sql(compiler, connection)
+
+    def as_sqlite(self, compiler, connection):
+        format = _translate_format(self.format, SQLITE_FORMATS)
+        return self._func(
+            'STRFTIME', Value(format), *self.get_source_expressions()
+        ).as_sql(compiler, connection)
+
+    def as_postgresql(self, compiler, connection):
+        format = _translate_format(self.format, POSTGRESQL_FORMATS, quote='"')
+        return self._func(
+            'TO_CHAR', self.get_source_expressions()[0], Value(format)
+        ).as_sql(compiler, connection)
+
+    def as_mysql(self, compiler, connection):
+        format = _translate_format(self.format, MYSQL_FORMATS)
+        return self._func(
+            'DATE_FORMAT', self.get_source_expressions()[0], Value(format)
+        ).as_sql(compiler, connection)
+
+
+def choices_display(path, field):
+    """ Return an expression of the display value of `field`, reached by
+    `path`, like `get_FOO_display()`. Unknown values are kept as text.
+    """
+    return Case(
+        *[When(**{path: value, 'then': Value(force_text(label))})
+          for value, label in field.flatchoices],
+        default=Cast(path, TextField()),
+        output_field=CharField()
+    )
+
+
+def get_format_expression(path, format):
+    """ Return the expression of a format declared in `export_formats`:
+    a strftime string, an expression or a function of the path returning one.
+    """
+    if hasattr(format, 'resolve_expression'):
+        return format
+    if callable(format):
+        return format(path)
+    return DateFormat(path, format)
@@ -2,10 +2,13 @@
 
 from __future__ import unicode_literals, absolute_import
 
+from collections import namedtuple, OrderedDict
 from itertools import chain
+import hashlib
 
+from django.apps import apps
 from django.contrib.contenttypes.models import ContentType
-from django.db.models.fields import FieldDoesNotExist
+from django.utils.encoding import force_text
 
 
 def _get_field_by_name(model_class, field_name):
@@ -38,7 +41,7 @@ def _get_all_field_names(model):
     100% compatible version of the old API of model._meta.get_all_field_names()
     From: https://docs.djangoproject.com/en/1.9/ref/models/meta/#migrating-from-the-old-api
     """
-    return list(set(chain.from_iterable(
+    return list(OrderedDict.fromkeys(chain.from_iterable(
         (field.name, field.attname) if hasattr(field, 'attname') else (field.name,)
         for field in model._meta.get_fields()
         # For complete backwards compatibility, you may want to exclude
@@ -47,31 +50,71 @@ def _get_all_field_names(model):
     )))
 
 
-def get_relation_fields_from_model(model_class):
-    """ Get related fields (m2m, FK, and reverse FK) """
-    relation_fields = []
+ModelIndex = namedtuple(
+    'ModelIndex', 'field_names direct_fields relation_fields related_models to_many')
+
+_model_indexes = {}
+
+
+def _get_related_model(field, direct):
+    """ Model reached through the relation `field` """
+    if direct:
+        try:
+            return _get_remote_field(field).parent_model()
+        except AttributeError:
+            return _get_remote_field(field).model
+    # Indirect related field
+    if hasattr(field, 'related_model'):  # Django>=1.8
+        return field.related_model
+    return field.model()
+
+
+def _build_model_index(model_class):
     all_fields_names = _get_all_field_names(model_class)
+    direct_fields = []
+    relation_fields = []
+    related_models = {}
+    to_many = set()
     for field_name in all_fields_names:
         field, model, direct, m2m = _get_field_by_name(model_class, field_name)
-        # get_all_field_names will return the same field
-        # both with and without _id. Ignore the duplicate.
-        if field_name[-3:] == '_id' and field_name[:-3] in all_fields_names:
-            continue
         if m2m or not direct or _get_remote_field(field):
+            related_models[field_name] = _get_related_model(field, direct)
+            if field.many_to_many or field.one_to_many:
+                to_many.add(field_name)
+            # get_all_field_names will return the same field
+            # both with and without _id. Ignore the duplicate.
+            if field_name[-3:] == '_id' and field_name[:-3] in all_fields_names:
+                continue
             field.field_name_override = field_name
-            relation_fields += [field]
-    return relation_fields
+            relation_fields.append(field)
+        else:
+            direct_fields.append(field)
+    return ModelIndex(
+        frozenset(all_fields_names), tuple(direct_fields), tuple(relation_fields), related_models,
+        frozenset(to_many))
+
+
+def get_model_index(model_class):
+    """ Return the fields of `model_class`, indexed once per model.
+
+    The index is rebuilt when the app registry expires the fields cache of the
+    model, as it does when models are registered.
+    """
+    fields = model_class._meta.get_fields()
+    cached = _model_indexes.get(model_class)
+    if cached is None or cached[0] is not fields:
+        cached = _model_indexes[model_class] = (fields, _build_model_index(model_class))
+    return cached[1]
+
+
+def get_relation_fields_from_model(model_class):
+    """ Get related fields (m2m, FK, and reverse FK) """
+    return list(get_model_index(model_class).relation_fields)
 
 
 def get_direct_fields_from_model(model_class):
     """ Direct, not m2m, not FK """
-    direct_fields = []
-    all_fields_names = _get_all_field_names(model_class)
-    for field_name in all_fields_names:
-        field, model, direct, m2m = _get_field_by_name(model_class, field_name)
-        if direct and not m2m and not _get_remote_field(field):
-            direct_fields += [field]
-    return direct_fields
+    return list(get_model_index(model_class).direct_fields)
 
 
 def get_model_from_path_string(root_model, path):
@@ -81,24 +124,182 @@ def get_model_from_path_string(root_model, path):
     """
     for path_section in path.split('__'):
         if path_section:
-            try:
-                field, model, direct, m2m = _get_field_by_name(root_model, path_section)
-            except FieldDoesNotExist:
+            index = get_model_index(root_model)
+            if path_section not in index.field_names:
                 return root_model
-            if direct:
-                if _get_remote_field(field):
-                    try:
-                        root_model = _get_remote_field(field).parent_model()
-                    except AttributeError:
-                        root_model = _get_remote_field(field).model
-            else:
-                if hasattr(field, 'related_model'):
-                    root_model = field.related_model
-                else:
-                    root_model = field.model
+            root_model = index.related_models.get(path_section, root_model)
     return root_model
 
 
+FieldPathPlan = namedtuple('FieldPathPlan', 'columns models joins invalid to_many')
+PlanColumn = namedtuple('PlanColumn', 'path model field')
+
+_plans = {}
+
+
+def _compile_field_paths(root_model, paths):
+    # Build a trie of relation hops, so each hop is resolved once.
+    trie = OrderedDict()
+    for path in paths:
+        node = trie
+        for path_section in path.split('__')[:-1]:
+            node = node.setdefault(path_section, OrderedDict())
+
+    # Resolve the trie: {relation path: model reached, or None if invalid}
+    hops = OrderedDict()
+    to_many_hops = set()
+    stack = [('', root_model, trie, False)]
+    while stack:
+        prefix, model, node, to_many = stack.pop()
+        index = get_model_index(model)
+        for path_section, children in node.items():
+            related_model = index.related_models.get(path_section)
+            hops[prefix + path_section] = related_model
+            if related_model is not None:
+                hop_to_many = to_many or path_section in index.to_many
+                if hop_to_many:
+                    to_many_hops.add(prefix + path_section)
+                stack.append((prefix + path_section + '__', related_model, children, hop_to_many))
+
+    columns, invalid, joins, to_many = [], [], [], []
+    for path in paths:
+        relation, _, field_name = path.rpartition('__')
+        model = hops.get(relation) if relation else root_model
+        field = None
+        if model is None or not (
+                field_name == 'pk' or field_name in get_model_index(model).field_names):
+            invalid.append(path)
+            model = root_model if model is None else model
+        else:
+            field = model._meta.pk if field_name == 'pk' else model._meta.get_field(field_name)
+            if relation and relation not in joins:
+                joins.append(relation)
+            if relation in to_many_hops or field_name in get_model_index(model).to_many:
+                to_many.append(path)
+        columns.append(PlanColumn(path, model, field))
+    models = list(OrderedDict.fromkeys(column.model for column in columns))
+    return FieldPathPlan(
+        tuple(columns), tuple(models), tuple(joins), tuple(invalid), tuple(to_many))
+
+
+def compile_field_paths(root_model, paths):
+    """ Resolve field paths like foo__bar__baz from `root_model` at once.
+
+    Returns a `FieldPathPlan`, with:
+        columns: `PlanColumn` (path, model, field) for each path, where
+            field is None for invalid paths
+        models: distinct models of the columns
+        joins: relation paths that are joined to query the columns
+        invalid: paths that do not lead to a field
+        to_many: paths through m2m or reverse FK relations, which can
+            have many values for each object
+
+    Plans are cached per model and set of paths, until the model is indexed
+    again.
+    """
+    paths = tuple(paths)
+    key = (root_model, paths)
+    index = get_model_index(root_model)
+    cached = _plans.get(key)
+    if cached is None or cached[0] is not index:
+        if len(_plans) >= 256:
+            _plans.clear()
+        cached = _plans[key] = (index, _compile_field_paths(root_model, paths))
+    return cached[1]
+
+
+def _get_model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.model_name)
+
+
+def dump_field_plan(plan):
+    """ Return `plan`, from `compile_field_paths`, as a json serializable
+    dict, see `load_field_plan`.
+    """
+    return {
+        'columns': [
+            [column.path, _get_model_label(column.model),
+             column.field.name if column.field is not None else None]
+            for column in plan.columns
+        ],
+        'joins': list(plan.joins),
+        'invalid': list(plan.invalid),
+        'to_many': list(plan.to_many),
+    }
+
+
+def load_field_plan(data):
+    """ Rebuild a `FieldPathPlan` dumped by `dump_field_plan`, reading its
+    models and fields by name instead of resolving its paths again.
+    """
+    columns = []
+    for path, label, field_name in data['columns']:
+        model = apps.get_model(label)
+        field = model._meta.get_field(field_name) if field_name is not None else None
+        columns.append(PlanColumn(path, model, field))
+    models = list(OrderedDict.fromkeys(column.model for column in columns))
+    return FieldPathPlan(
+        tuple(columns), tuple(models), tuple(data['joins']), tuple(data['invalid']),
+        tuple(data['to_many']))
+
+
+def get_joined_models(root_model, plan):
+    """ Return `root_model` and the models the joins of `plan` go through """
+    models = OrderedDict([(root_model, None)])
+    for join in plan.joins:
+        sections = join.split('__')
+        for i in range(len(sections)):
+            models[get_model_from_path_string(root_model, '__'.join(sections[:i + 1]))] = None
+    return list(models)
+
+
+def get_schema_fingerprint(root_model, paths):
+    """ Return a hash of the fields of `root_model` and of the models `paths`
+    go through, which changes when the schema of one of them does.
+    """
+    parts = []
+    for model in get_joined_models(root_model, compile_field_paths(root_model, paths)):
+        parts.append(_get_model_label(model))
+        for field in model._meta.get_fields():
+            related_model = getattr(field, 'related_model', None)
+            parts.append('%s:%s:%s:%s' % (
+                field.name, type(field).__name__, getattr(field, 'null', False),
+                _get_model_label(related_model) if related_model else ''))
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def get_related_lookups(root_model, paths):
+    """ Return the `select_related` and `prefetch_related` lookups needed to
+    read `paths` from instances of `root_model` without extra queries.
+
+    Relations reached through m2m or reverse FK relations are prefetched,
+    the others are selected.
+    """
+    select_related, prefetch_related = [], []
+    for path in paths:
+        model, relation, to_many = root_model, [], False
+        for path_section in path.split('__'):
+            index = get_model_index(model)
+            if path_section not in index.related_models:
+                break
+            relation.append(path_section)
+            to_many = to_many or path_section in index.to_many
+            model = index.related_models[path_section]
+        lookups = prefetch_related if to_many else select_related
+        if relation and '__'.join(relation) not in lookups:
+            lookups.append('__'.join(relation))
+    return select_related, prefetch_related
+
+
+def get_value_field(field):
+    """ Return the field whose values `values_list` returns for `field`,
+    which is the primary key of the related model for relations.
+    """
+    while field is not None and field.is_relation:
+        field = field.related_model._meta.pk
+    return field
+
+
 def get_fields(model_class, field_name='', path=''):
     """ Get fields and meta data from a model
 
@@ -116,17 +317,10 @@ def get_fields(model_class, field_name='', path=''):
     app_label = model_class._meta.app_label
 
     if field_name != '':
-        field, model, direct, m2m = _get_field_by_name(model_class, field_name)
+        new_model = get_model_index(model_class).related_models[field_name]
 
         path += field_name
         path += '__'
-        if direct:  # Direct field
-            try:
-                new_model = _get_remote_field(field).parent_model
-            except AttributeError:
-                new_model = _get_remote_field(field).model
-        else:  # Indirect related field
-            new_model = field.related_model
 
         fields = get_direct_fields_from_model(new_model)
 
@@ -142,19 +336,7 @@ def get_fields(model_class, field_name='', path=''):
 def get_related_fields(model_class, field_name, path=""):
     """ Get fields for a given model """
     if field_name:
-        field, model, direct, m2m = _get_field_by_name(model_class, field_name)
-        if direct:
-            # Direct field
-            try:
-                new_model = _get_remote_field(field).parent_model()
-            except AttributeError:
-                new_model = _get_remote_field(field).model
-        else:
-            # Indirect related field
-            if hasattr(field, 'related_model'):  # Django>=1.8
-                new_model = field.related_model
-            else:
-                new_model = field.model()
+        new_model = get_model_index(model_class).related_models[field_name]
 
         path += field_name
         path += '__'
@@ -165,3 +347,55 @@ def get_related_fields(model_class, field_name, path=""):
     model_ct = ContentType.objects.get_for_model(new_model)
 
     return (new_fields, model_ct, path)
+
+
+def _get_relation_model(model_class, path):
+    """ Return the model reached by the relation `path`, like `foo__bar__`,
+    from `model_class`. Raises LookupError if `path` is not a relation.
+    """
+    model = model_class
+    for path_section in path.split('__'):
+        if path_section:
+            model = get_model_index(model).related_models[path_section]
+    return model
+
+
+def get_field_tree(model_class, path='', depth=1, computed_fields=()):
+    """ Return the fields and relations of the model reached by the relation
+    `path` from `model_class`, like `get_fields` and `get_related_fields`,
+    as a json serializable dict. Relations are expanded `depth` levels deep.
+
+    `computed_fields` are (name, label) of the computed fields, listed
+    with the fields of `model_class`.
+
+    Raises LookupError if `path` is not a relation.
+    """
+    model = _get_relation_model(model_class, path)
+    index = get_model_index(model)
+    fields = [
+        {'name': field.name, 'path': path + field.name,
+         'label': force_text(field.verbose_name or field), 'type': type(field).__name__}
+        for field in index.direct_fields
+    ]
+    if not path:
+        fields.extend(
+            {'name': name, 'path': name, 'label': force_text(label), 'type': None}
+            for name, label in computed_fields)
+    relations = []
+    for field in index.relation_fields:
+        name = field.field_name_override
+        if getattr(field, 'verbose_name', None):
+            label = '%s [%s]' % (force_text(field.verbose_name), force_text(field.description))
+        else:
+            label = field.get_accessor_name()
+        relation = {
+            'name': name, 'path': path + name + '__', 'label': label,
+            'model': _get_model_label(index.related_models[name]),
+            'to_many': name in index.to_many,
+        }
+        if depth > 1:
+            relation['children'] = get_field_tree(model_class, relation['path'], depth - 1)
+        relations.append(relation)
+    return {
+        'model': _get_model_label(model), 'path': path, 'fields': fields, 'relations': relations,
+    }
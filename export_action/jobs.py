@@ -0,0 +1,242 @@
+# coding: utf-8
+"""
+Background exports.
+
+Jobs are created by the export view when the "run in background" option is
+checked, and handed to the executor configured by `EXPORT_ACTION_EXECUTOR`:
+
+* `export_action.jobs.ThreadPoolExecutor` (default) runs jobs in a pool of
+  `EXPORT_ACTION_WORKERS` threads of the web process;
+* `export_action.jobs.QueueExecutor` leaves jobs pending, to be run by the
+  `export_action_worker` management command;
+* `export_action.jobs.ImmediateExecutor` runs jobs right away, in the calling
+  thread. Mostly useful for tests.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+import datetime
+import logging
+from multiprocessing.pool import ThreadPool
+from tempfile import TemporaryFile
+import threading
+
+from django.conf import settings
+from django.contrib import admin
+from django.core.files import File
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.encoding import force_text
+from django.utils.module_loading import import_string
+
+from . import parallel, report
+from .admin import get_export_options
+from .compression import get_filename, iter_compressed
+from .metrics import ExportMetrics
+from .models import ExportJob
+
+
+logger = logging.getLogger(__name__)
+
+
+def _iter_progress(rows, progress, every):
+    """ Yield `rows`, calling `progress` with the number of rows done every
+    `every` rows, and once they are all done.
+    """
+    rows_done = 0
+    for row in rows:
+        yield row
+        rows_done += 1
+        if rows_done % every == 0:
+            progress(rows_done)
+    progress(rows_done)
+
+
+def iter_export(queryset, fields, format, user, pks=None, options=None, compression=None,
+                normalize=False, title=None, progress=None, workers=1):
+    """ Export `fields` of `queryset` outside of a request.
+
+    `options` are keyword arguments for `report.report_to_iterator`, merged
+    with the ones declared on the model admin. `compression` is one of
+    `compression.COMPRESSIONS`, and `normalize` exports a sheet per model.
+    `progress` is an optional function called with the number of objects
+    exported so far. With more than one of `workers`, exports supported by
+    `parallel.is_supported` are split between processes.
+
+    Returns iterator of chunks of bytes, filename, message in case of issues.
+    """
+    user_options = dict(options or {})
+    options = dict(user_options)
+    model_admin = admin.site._registry.get(queryset.model)
+    options.update(get_export_options(model_admin))
+    chunk_size = report._get_chunk_size()
+    progress = progress or (lambda rows_done: None)
+    export_metrics = ExportMetrics(queryset.model, format, user, background=True)
+    filename = report.generate_filename(
+        title or queryset.model._meta.model_name, report.get_format_extension(format))
+
+    with export_metrics.measure():
+        if normalize:
+            options.pop('aggregate', None)
+            sheets, message = report.report_to_sheets(
+                queryset, fields, user, chunk_size=chunk_size, pks=pks, **options)
+            sheets = [
+                (sheet_title, header, export_metrics.iter_rows(rows))
+                for sheet_title, header, rows in sheets
+            ]
+            # The first sheet has the exported objects
+            sheet_title, header, rows = sheets[0]
+            sheets[0] = (sheet_title, header, _iter_progress(rows, progress, chunk_size))
+            chunks = report.iter_xlsx_sheets(sheets)
+        elif workers > 1 and parallel.is_supported(queryset, format, pks):
+            # Only messages are needed here, rows are exported by the workers
+            rows, message = report.report_to_iterator(queryset, fields, user, pks=[], **options)
+
+            def parallel_progress(rows_done):
+                export_metrics.rows = rows_done
+                progress(rows_done)
+
+            chunks = parallel.iter_parallel(
+                queryset, fields, format, user, pks=pks, options=user_options,
+                workers=workers, progress=parallel_progress)
+        else:
+            rows, message = report.report_to_iterator(
+                queryset, fields, user, chunk_size=chunk_size, pks=pks, **options)
+            rows = _iter_progress(export_metrics.iter_rows(rows), progress, chunk_size)
+            columns = report.get_export_columns(queryset.model, fields, user, **options)
+            header = [name for name, field in columns]
+            chunks = report.iter_format(rows, format, header=header, columns=columns)
+        if compression:
+            chunks = iter_compressed(chunks, compression, filename)
+            filename = get_filename(filename, compression)
+    return export_metrics.iter_chunks(chunks), filename, message
+
+
+def run_job(job_id, workers=1):
+    """ Run a pending job. Does nothing if the job was already taken.
+    `workers` is the number of processes exporting it, see `iter_export`,
+    which are forked, so only single-threaded processes should use more
+    than one.
+    """
+    claimed = ExportJob.objects.filter(pk=job_id, status=ExportJob.PENDING).update(
+        status=ExportJob.RUNNING, started_on=timezone.now())
+    if not claimed:
+        return
+    job = ExportJob.objects.get(pk=job_id)
+
+    try:
+        queryset = job.get_queryset()
+        pks = job.get_selection()
+        fields = job.get_fields()
+        job.rows_total = queryset.count() if pks is None else len(pks)
+        job.save(update_fields=['rows_total'])
+
+        def progress(rows_done):
+            job.rows_done = rows_done
+            ExportJob.objects.filter(pk=job.pk).update(rows_done=rows_done)
+
+        options = job.get_options()
+        chunks, filename, job.message = iter_export(
+            queryset, fields, job.format, job.user, pks=pks,
+            compression=options.pop('compression', None),
+            normalize=options.pop('normalize', False), options=options,
+            title=job.content_type.model, progress=progress, workers=workers)
+
+        with TemporaryFile() as myfile:
+            for chunk in chunks:
+                myfile.write(chunk)
+            job.file.save(filename, File(myfile, name=filename), save=False)
+        job.status = ExportJob.DONE
+    except Exception as e:
+        logger.exception("Export job %s failed", job.pk)
+        job.status = ExportJob.FAILED
+        job.message = force_text(e)
+    job.finished_on = timezone.now()
+    job.save()
+
+
+class BaseExecutor(object):
+
+    def submit(self, job):
+        raise NotImplementedError
+
+
+class ImmediateExecutor(BaseExecutor):
+
+    def submit(self, job):
+        run_job(job.pk)
+
+
+class QueueExecutor(BaseExecutor):
+    """ Jobs stay pending until picked by the `export_action_worker` command """
+
+    def submit(self, job):
+        pass
+
+
+def _run_job_in_thread(job_id):
+    try:
+        run_job(job_id)
+    finally:
+        connection.close()
+
+
+class ThreadPoolExecutor(BaseExecutor):
+
+    def __init__(self):
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def submit(self, job):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(getattr(settings, 'EXPORT_ACTION_WORKERS', 2))
+        self.pool.apply_async(_run_job_in_thread, (job.pk,))
+
+
+_executors = {}
+
+
+def get_executor():
+    path = getattr(settings, 'EXPORT_ACTION_EXECUTOR', 'export_action.jobs.ThreadPoolExecutor')
+    if path not in _executors:
+        _executors[path] = import_string(path)()
+    return _executors[path]
+
+
+def delete_expired_jobs():
+    """ Delete the jobs finished more than `EXPORT_ACTION_JOB_TTL` seconds
+    ago, along with their files.
+    """
+    ttl = getattr(settings, 'EXPORT_ACTION_JOB_TTL', 24 * 60 * 60)
+    expired = timezone.now() - datetime.timedelta(seconds=ttl)
+    ExportJob.objects.filter(finished_on__lt=expired).delete()
+
+
+def start_job(queryset, fields, format, user, pks=None, options=None, compression=None,
+              normalize=False):
+    """ Create a job exporting `fields` of `queryset` and submit it once the
+    current transaction is committed, so the executor finds it. `options`
+    are keyword arguments for `report.report_to_iterator`, besides the ones
+    declared on the model admin. `compression` is one of
+    `compression.COMPRESSIONS`, or None to keep the file uncompressed.
+    `normalize` exports a sheet per model, see `report.report_to_sheets`.
+    Expired jobs are deleted first.
+    """
+    delete_expired_jobs()
+    job = ExportJob(user=user, format=format)
+    job.set_queryset(queryset)
+    job.set_selection(pks)
+    job.set_fields(fields)
+    options = dict(options or {})
+    if compression:
+        options['compression'] = compression
+    if normalize:
+        options['normalize'] = True
+    job.set_options(options)
+    job.save()
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(lambda: get_executor().submit(job))
+    else:  # Django<1.9, submitted right away
+        get_executor().submit(job)
+    return job
@@ -0,0 +1,145 @@
+# coding: utf-8
+
+from __future__ import unicode_literals, absolute_import
+
+import io
+import os
+import sys
+
+from django.apps import apps
+from django.contrib.admin.utils import prepare_lookup_value
+from django.contrib.auth import get_user_model
+from django.core.exceptions import FieldError, ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from export_action import columnar
+from export_action.compression import COMPRESSIONS
+from export_action.jobs import iter_export
+
+
+FORMATS = ('csv', 'html', 'xlsx', 'ndjson') + columnar.FORMATS
+
+
+def _parse_lookups(values):
+    """ Parse `lookup=value` arguments like the admin parses changelist
+    filters: values of `__in` lookups are split, values of `__isnull` ones
+    are booleans, like `False`, and `null` is None.
+    """
+    lookups = {}
+    for value in values or []:
+        lookup, sep, value = value.partition('=')
+        if not sep:
+            raise CommandError("Invalid lookup %r, expected lookup=value." % lookup)
+        lookups[lookup] = None if value == 'null' else prepare_lookup_value(lookup, value)
+    return lookups
+
+
+class Command(BaseCommand):
+    help = (
+        "Export fields of a model to a file or stdout, like the export action. "
+        "Fields are paths like reporter__email.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help="Model to export, as app_label.ModelName.")
+        parser.add_argument('fields', nargs='+', help="Field paths to export.")
+        parser.add_argument(
+            '--user',
+            help="Username whose permissions are checked, like in the admin. Required.")
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument(
+            '--filter', action='append', metavar='LOOKUP=VALUE',
+            help="Export objects matching a lookup, like status=1. Can be repeated.")
+        parser.add_argument(
+            '--exclude', action='append', metavar='LOOKUP=VALUE',
+            help="Skip objects matching a lookup. Can be repeated.")
+        parser.add_argument('--order-by', action='append', help="Ordering of the objects.")
+        parser.add_argument(
+            '--pks-file', help="File with the pks of the objects to export, one per line.")
+        parser.add_argument(
+            '--output', default='-',
+            help="File or directory to write to, or - for stdout (default).")
+        parser.add_argument('--compression', choices=COMPRESSIONS)
+        parser.add_argument(
+            '--aggregate', action='store_true', default=False,
+            help="One row per object, joining values of to-many paths.")
+        parser.add_argument(
+            '--labels', action='store_true', default=False,
+            help="Export the labels of fields with choices.")
+        parser.add_argument(
+            '--normalize', action='store_true', default=False,
+            help="One sheet per related model, for xlsx.")
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help="Processes exporting shards of the objects, for csv and ndjson exports "
+                 "ordered by pk.")
+
+    def get_queryset(self, options):
+        try:
+            model_class = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        queryset = model_class._default_manager.all()
+        try:
+            queryset = queryset.filter(**_parse_lookups(options['filter']))
+            queryset = queryset.exclude(**_parse_lookups(options['exclude']))
+            if options['order_by']:
+                queryset = queryset.order_by(*options['order_by'])
+            queryset.query.get_compiler(queryset.db).as_sql()
+        except (FieldError, ValidationError, ValueError) as e:
+            raise CommandError(e)
+        return queryset
+
+    def get_pks(self, model_class, path):
+        if not path:
+            return None
+        pk_field = model_class._meta.pk
+        with io.open(path) as pks_file:
+            try:
+                return [pk_field.to_python(line.strip()) for line in pks_file if line.strip()]
+            except ValidationError as e:
+                raise CommandError(e)
+
+    def get_output(self, path, filename, stdout=None):
+        """ Return the binary stream to write to, and whether to close it.
+        Exports are bytes, written to the buffer of `stdout` when it has one,
+        or to `stdout` itself, like a BytesIO given to `call_command`.
+        """
+        if path == '-':
+            stdout = stdout or sys.stdout
+            return getattr(stdout, 'buffer', stdout), False
+        if os.path.isdir(path):
+            path = os.path.join(path, filename)
+        return open(path, 'wb'), True
+
+    def handle(self, *args, **options):
+        if not options['user']:
+            raise CommandError("--user is required.")
+        if options['format'] in columnar.FORMATS and not columnar.is_available():
+            raise CommandError("--format %s needs pyarrow, which is not installed." %
+                               options['format'])
+        queryset = self.get_queryset(options)
+        pks = self.get_pks(queryset.model, options['pks_file'])
+        try:
+            user = get_user_model()._default_manager.get_by_natural_key(options['user'])
+        except get_user_model().DoesNotExist:
+            raise CommandError("User %r does not exist." % options['user'])
+
+        chunks, filename, message = iter_export(
+            queryset, options['fields'], options['format'], user, pks=pks,
+            options={'aggregate': options['aggregate'], 'labels': options['labels']},
+            compression=options['compression'],
+            normalize=options['normalize'] and options['format'] == 'xlsx',
+            workers=options['workers'])
+        if message:
+            self.stderr.write(message)
+
+        output, close = self.get_output(options['output'], filename, options.get('stdout'))
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+            output.flush()
+        finally:
+            if close:
+                output.close()
+        if close and options['verbosity'] > 1:
+            self.stderr.write("Exported to %s." % output.name)
@@ -0,0 +1,38 @@
+# coding: utf-8
+
+from __future__ import unicode_literals, absolute_import
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from export_action.jobs import delete_expired_jobs, run_job
+from export_action.models import ExportJob
+
+
+class Command(BaseCommand):
+    help = (
+        "Run pending background exports, see `export_action.jobs.QueueExecutor`, "
+        "and delete expired ones.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true', default=False,
+            help="Exit when there are no pending jobs left.")
+        parser.add_argument(
+            '--sleep', type=float, default=5,
+            help="Seconds to wait between polls for new jobs.")
+
+    def handle(self, *args, **options):
+        while True:
+            delete_expired_jobs()
+            pending = list(ExportJob.objects.filter(
+                status=ExportJob.PENDING).order_by('created_on').values_list('pk', flat=True))
+            for job_id in pending:
+                # Workers are forked from this single-threaded process
+                run_job(job_id, workers=getattr(settings, 'EXPORT_ACTION_PARALLEL_WORKERS', 1))
+                self.stdout.write("Export job %s processed." % job_id)
+            if options['once']:
+                break
+            time.sleep(options['sleep'])
@@ -0,0 +1,239 @@
+# coding: utf-8
+"""
+Instrumentation of exports.
+
+An `ExportMetrics` follows an export through its rows and the chunks of
+bytes written from them, splitting the time spent in:
+
+* query: fetching rows from the database;
+* conversion: converting and encoding rows, while they are fetched;
+* serialization: writing the file once every row is fetched, like saving a
+  workbook or writing the footer of a parquet file.
+
+Time spent waiting for the client to read the response is not counted.
+
+Memory can only be read for the whole process: `process_peak_rss_kb` is the
+peak resident memory of the process since it started, including earlier
+exports and requests, and `peak_rss_growth_kb` how much the export raised
+it, which is 0 when it stayed below an earlier peak. `traced_peak_kb` is the
+peak of memory allocated by Python since `tracemalloc` started, when it runs.
+
+Once the export is written, metrics are sent with the
+`export_action.signals.export_finished` signal, and to the functions listed
+in `EXPORT_ACTION_METRICS_CALLBACKS`, like `log_metrics` and `statsd_metrics`.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+from contextlib import contextmanager
+import logging
+import socket
+import sys
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .signals import export_finished
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+logger = logging.getLogger(__name__)
+
+
+def _get_process_peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # In bytes on macOS, kilobytes elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _get_traced_peak_kb():
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.get_traced_memory()[1] // 1024
+
+
+class ExportMetrics(object):
+    """ Metrics of an export of `model` in `format` """
+
+    def __init__(self, model, format, user=None, background=False):
+        self.model = model
+        self.format = format
+        self.user = user
+        self.background = background
+        self.rows = 0
+        self.bytes = 0
+        self.query_time = 0.0
+        self.conversion_time = 0.0
+        self.serialization_time = 0.0
+        self.process_peak_rss_kb = None
+        self.peak_rss_growth_kb = None
+        self.traced_peak_kb = None
+        self.finished = False
+        self.completed = False
+        self._open_rows = 0
+        self._rows_done_at = None
+        self._initial_peak_rss_kb = _get_process_peak_rss_kb()
+
+    @property
+    def label(self):
+        return '%s.%s' % (self.model._meta.app_label, self.model._meta.model_name)
+
+    @property
+    def total_time(self):
+        return self.query_time + self.conversion_time + self.serialization_time
+
+    def as_dict(self):
+        return {
+            'model': self.label,
+            'format': self.format,
+            'background': self.background,
+            'completed': self.completed,
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'query_time': self.query_time,
+            'conversion_time': self.conversion_time,
+            'serialization_time': self.serialization_time,
+            'total_time': self.total_time,
+            'process_peak_rss_kb': self.process_peak_rss_kb,
+            'peak_rss_growth_kb': self.peak_rss_growth_kb,
+            'traced_peak_kb': self.traced_peak_kb,
+        }
+
+    @contextmanager
+    def measure(self):
+        """ Count the time spent in the block as conversion, or as
+        serialization after every row was fetched, besides the time fetching
+        rows.
+        """
+        start, query_time = time.time(), self.query_time
+        try:
+            yield
+        finally:
+            end = time.time()
+            if self._rows_done_at is None or self._rows_done_at < start:
+                split = end if self._rows_done_at is None else start
+            else:
+                split = self._rows_done_at
+            self.conversion_time += split - start - (self.query_time - query_time)
+            self.serialization_time += end - split
+
+    def iter_rows(self, rows):
+        """ Wrap `rows`, counting them and the time spent fetching them """
+        self._open_rows += 1
+        self._rows_done_at = None
+        return self._iter_rows(iter(rows))
+
+    def _iter_rows(self, rows):
+        try:
+            while True:
+                start = time.time()
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    break
+                finally:
+                    self.query_time += time.time() - start
+                self.rows += 1
+                yield row
+        finally:
+            self._open_rows -= 1
+            if not self._open_rows:
+                self._rows_done_at = time.time()
+
+    def iter_chunks(self, chunks):
+        """ Wrap the chunks of bytes written, counting them, and finish once
+        they are consumed, or on failure, with `completed` unset.
+        """
+        chunks = iter(chunks)
+        try:
+            while True:
+                with self.measure():
+                    try:
+                        chunk = next(chunks)
+                    except StopIteration:
+                        self.completed = True
+                        break
+                self.bytes += len(chunk)
+                yield chunk
+        finally:
+            self.finish()
+
+    def finish(self):
+        """ Send the metrics, once """
+        if self.finished:
+            return
+        self.finished = True
+        self.process_peak_rss_kb = _get_process_peak_rss_kb()
+        if self.process_peak_rss_kb is not None:
+            self.peak_rss_growth_kb = self.process_peak_rss_kb - self._initial_peak_rss_kb
+        self.traced_peak_kb = _get_traced_peak_kb()
+        export_finished.send(sender=self.model, metrics=self)
+        for callback in get_callbacks():
+            try:
+                callback(self)
+            except Exception:
+                logger.exception("Export metrics callback %r failed", callback)
+
+
+_callbacks = {}
+
+
+def get_callbacks():
+    paths = tuple(getattr(settings, 'EXPORT_ACTION_METRICS_CALLBACKS', ()))
+    if paths not in _callbacks:
+        _callbacks[paths] = [import_string(path) for path in paths]
+    return _callbacks[paths]
+
+
+def log_metrics(metrics):
+    """ Log `metrics` to the `export_action.metrics` logger """
+    logger.info(
+        "Exported %(rows)d rows of %(model)s to %(format)s, %(bytes)d bytes in "
+        "%(total_time).3fs (query %(query_time).3fs, conversion %(conversion_time).3fs, "
+        "serialization %(serialization_time).3fs), process peak RSS %(process_peak_rss_kb)s KB "
+        "(+%(peak_rss_growth_kb)s KB)%(status)s",
+        dict(metrics.as_dict(), status='' if metrics.completed else ', aborted'))
+
+
+_statsd_socket = None
+
+
+def statsd_metrics(metrics):
+    """ Send `metrics` as statsd counters, timers and gauges to
+    `EXPORT_ACTION_STATSD_HOST` and `EXPORT_ACTION_STATSD_PORT`, named after
+    `EXPORT_ACTION_STATSD_PREFIX` and the format, like
+    `export_action.csv.rows`.
+    """
+    global _statsd_socket
+    host = getattr(settings, 'EXPORT_ACTION_STATSD_HOST', 'localhost')
+    port = getattr(settings, 'EXPORT_ACTION_STATSD_PORT', 8125)
+    prefix = '%s.%s' % (getattr(settings, 'EXPORT_ACTION_STATSD_PREFIX', 'export_action'),
+                        metrics.format)
+    lines = [
+        '%s.%s:1|c' % (prefix, 'exports' if metrics.completed else 'aborted'),
+        '%s.rows:%d|c' % (prefix, metrics.rows),
+        '%s.bytes:%d|c' % (prefix, metrics.bytes),
+    ]
+    for name in ('query_time', 'conversion_time', 'serialization_time', 'total_time'):
+        lines.append('%s.%s:%d|ms' % (prefix, name, getattr(metrics, name) * 1000))
+    if metrics.process_peak_rss_kb is not None:
+        lines.append('%s.process_peak_rss_kb:%d|g' % (prefix, metrics.process_peak_rss_kb))
+        lines.append('%s.peak_rss_growth_kb:%d|g' % (prefix, metrics.peak_rss_growth_kb))
+
+    if _statsd_socket is None:
+        _statsd_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        _statsd_socket.sendto('\n'.join(lines).encode('ascii'), (host, port))
+    except (socket.error, OSError):
+        logger.warning("Could not send export metrics to statsd at %s:%s", host, port)
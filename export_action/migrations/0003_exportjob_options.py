@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 15:39
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('export_action', '0002_exportjob_selection'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='options',
+            field=models.TextField(default='{}'),
+        ),
+    ]
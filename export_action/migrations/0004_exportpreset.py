@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 16:05
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('export_action', '0003_exportjob_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportPreset',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('fields', models.TextField()),
+                ('format', models.CharField(max_length=10)),
+                ('options', models.TextField(default='{}')),
+                ('filters', models.TextField(blank=True, help_text='Query string of the changelist filters.')),
+                ('plan', models.TextField(default='{}')),
+                ('schema', models.CharField(blank=True, max_length=40)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+                ('user', models.ForeignKey(blank=True, help_text='Owner of the preset, or empty to share it with every user.', null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('name',),
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 16:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('export_action', '0004_exportpreset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportpreset',
+            name='selection',
+            field=models.BinaryField(null=True),
+        ),
+    ]
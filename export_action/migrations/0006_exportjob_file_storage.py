@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 16:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import export_action.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('export_action', '0005_exportpreset_selection'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='exportjob',
+            name='file',
+            field=models.FileField(blank=True, storage=export_action.storage.ExportStorage(), upload_to=export_action.storage.get_file_name),
+        ),
+    ]
@@ -1 +1,234 @@
-# -*- coding: utf-8 -*-
+# coding: utf-8
+
+from __future__ import unicode_literals, absolute_import
+
+import json
+import pickle
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.contenttypes.models import ContentType
+from django.core.urlresolvers import reverse
+from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils.encoding import python_2_unicode_compatible
+from django.utils.translation import ugettext_lazy as _
+
+from .admin import get_export_options
+from .introspection import (
+    compile_field_paths, dump_field_plan, get_joined_models, get_model_index,
+    get_schema_fingerprint, load_field_plan)
+from .selection import decode_pks, encode_pks
+from .storage import export_storage, get_file_name
+
+
+@python_2_unicode_compatible
+class ExportJob(models.Model):
+    """ An export that runs in background, see `export_action.jobs` """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS = (
+        (PENDING, _('Pending')),
+        (RUNNING, _('Running')),
+        (DONE, _('Done')),
+        (FAILED, _('Failed')),
+    )
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    query = models.BinaryField()
+    selection = models.BinaryField(null=True)
+    fields = models.TextField()
+    options = models.TextField(default='{}')
+    format = models.CharField(max_length=10)
+    status = models.CharField(max_length=10, choices=STATUS, default=PENDING)
+    rows_total = models.PositiveIntegerField(null=True, blank=True)
+    rows_done = models.PositiveIntegerField(default=0)
+    file = models.FileField(upload_to=get_file_name, storage=export_storage, blank=True)
+    message = models.TextField(blank=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+    started_on = models.DateTimeField(null=True, blank=True)
+    finished_on = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('-created_on',)
+
+    def __str__(self):
+        return "{} export of {}".format(self.format, self.content_type)
+
+    def get_absolute_url(self):
+        return reverse("export_action:job", args=[self.pk])
+
+    @property
+    def finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    @property
+    def progress(self):
+        """ Percentage of rows written, or None if unknown """
+        if not self.rows_total:
+            return 100 if self.status == self.DONE else None
+        return min(100, self.rows_done * 100 // self.rows_total)
+
+    def set_queryset(self, queryset):
+        self.content_type = ContentType.objects.get_for_model(queryset.model)
+        self.query = pickle.dumps(queryset.query)
+
+    def get_queryset(self):
+        model_class = self.content_type.model_class()
+        queryset = model_class._default_manager.all()
+        queryset.query = pickle.loads(bytes(self.query))
+        return queryset
+
+    def set_selection(self, pks):
+        """ Store the pks to export from the queryset, see `report_to_iterator` """
+        self.selection = None if pks is None else encode_pks(pks)
+
+    def get_selection(self):
+        return None if self.selection is None else decode_pks(bytes(self.selection))
+
+    def set_fields(self, fields):
+        self.fields = json.dumps(fields)
+
+    def get_fields(self):
+        return json.loads(self.fields)
+
+    def set_options(self, options):
+        self.options = json.dumps(options)
+
+    def get_options(self):
+        return json.loads(self.options)
+
+
+@receiver(post_delete, sender=ExportJob)
+def _delete_job_file(sender, instance, **kwargs):
+    if instance.file:
+        instance.file.delete(save=False)
+
+
+# Plans of presets loaded by this process, with the index of each model they
+# read: {(pk, schema, plan): (plan, `FieldPathPlan`, [(model, index)])}
+_loaded_plans = {}
+
+
+@python_2_unicode_compatible
+class ExportPreset(models.Model):
+    """ A saved export of a model, run in one click from the export page.
+
+    The fields are validated and compiled once into `plan`, which is
+    compiled again when the schema of the models it reads changes.
+    Permissions are still checked on each run, for the user running it.
+    """
+    name = models.CharField(max_length=100)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True,
+        help_text=_("Owner of the preset, or empty to share it with every user."))
+    fields = models.TextField()
+    format = models.CharField(max_length=10)
+    options = models.TextField(default='{}')
+    filters = models.TextField(blank=True, help_text=_("Query string of the changelist filters."))
+    selection = models.BinaryField(null=True)
+    plan = models.TextField(default='{}')
+    schema = models.CharField(max_length=40, blank=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('name',)
+
+    def __str__(self):
+        return self.name
+
+    def get_absolute_url(self):
+        return reverse("export_action:preset", args=[self.pk])
+
+    def set_selection(self, pks):
+        """ Store the selected pks to export, or None to export the objects
+        of the changelist matching `filters`.
+        """
+        self.selection = None if pks is None else encode_pks(pks)
+
+    def get_selection(self):
+        return None if self.selection is None else decode_pks(bytes(self.selection))
+
+    def set_fields(self, fields):
+        self.fields = json.dumps(fields)
+
+    def get_fields(self):
+        return json.loads(self.fields)
+
+    def set_options(self, options):
+        self.options = json.dumps(options)
+
+    def get_options(self):
+        return json.loads(self.options)
+
+    def _get_paths(self, fields):
+        """ Field paths of `fields`, without the computed fields """
+        model_class = self.content_type.model_class()
+        computed = get_export_options(admin.site._registry.get(model_class)).get('computed', {})
+        return [name for name in fields if name not in computed]
+
+    def compile(self):
+        """ Resolve the fields, dropping the ones that no longer exist, and
+        store the plan with the schema it was compiled for.
+        """
+        model_class = self.content_type.model_class()
+        fields = self.get_fields()
+        paths = self._get_paths(fields)
+        invalid = compile_field_paths(model_class, paths).invalid
+        paths = [path for path in paths if path not in invalid]
+        plan = compile_field_paths(model_class, paths)
+        self.plan = json.dumps({
+            'fields': [name for name in fields if name not in invalid],
+            'invalid': list(invalid),
+            'paths': dump_field_plan(plan),
+            'models': [
+                '%s.%s' % (model._meta.app_label, model._meta.model_name)
+                for model in get_joined_models(model_class, plan)
+            ],
+        })
+        self.schema = get_schema_fingerprint(model_class, paths)
+
+    def _load_plan(self):
+        """ Return the stored plan and the `FieldPathPlan` of its paths,
+        compiling them again if the schema of the models they read changed
+        since. The schema is checked once per process, and then only when
+        one of these models is indexed again.
+        """
+        key = (self.pk, self.schema, self.plan)
+        loaded = _loaded_plans.get(key)
+        if loaded is not None and all(
+                get_model_index(model) is index for model, index in loaded[2]):
+            return loaded[:2]
+
+        plan = json.loads(self.plan)
+        if 'paths' not in plan or self.schema != get_schema_fingerprint(
+                self.content_type.model_class(), self._get_paths(plan['fields'])):
+            self.compile()
+            if self.pk:
+                self.save(update_fields=['plan', 'schema'])
+            plan = json.loads(self.plan)
+        models = [apps.get_model(label) for label in plan['models']]
+        loaded = (plan, load_field_plan(plan['paths']),
+                  [(model, get_model_index(model)) for model in models])
+        if len(_loaded_plans) >= 256:
+            _loaded_plans.clear()
+        _loaded_plans[(self.pk, self.schema, self.plan)] = loaded
+        return loaded[:2]
+
+    def get_plan(self):
+        """ Return the compiled plan, as a dict of the valid `fields`, the
+        `invalid` ones and the `paths` of the fields, see `_load_plan`.
+        """
+        return self._load_plan()[0]
+
+    def get_field_plan(self):
+        """ Return the `FieldPathPlan` of the field paths of the plan, to be
+        passed to `report.report_to_iterator`.
+        """
+        return self._load_plan()[1]
@@ -0,0 +1,223 @@
+# coding: utf-8
+"""
+Parallel exports of large selections.
+
+The objects to export are split in shards of contiguous primary keys, and
+each shard is exported to a temporary file by a worker process, with its own
+database connection. Parts are then concatenated in pk order. XLSX exports
+are not split, so their workbook does not depend on the number of workers.
+
+Workers are forked from the exporting process, which should not run other
+threads, as forking a multi-threaded process may leave the workers with locks
+held by threads they do not have. Background jobs are only exported in
+parallel by the `export_action_worker` command for this reason. On PostgreSQL, they read the
+snapshot exported by the transaction of the exporting process, so shards are
+consistent with each other; other databases give no such guarantee when
+objects change during the export.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+from contextlib import contextmanager
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from django.contrib import admin
+from django.db import connections, transaction
+from django.utils import six
+
+from . import report
+from .admin import get_export_options
+
+
+FORMATS = ('csv', 'ndjson')
+
+# Export of the shards, set in each worker by `_init_worker`
+_export = None
+# Connections of the exporting process, kept open in workers
+_inherited_connections = []
+
+
+def is_supported(queryset, format, pks=None):
+    """ Whether `queryset` can be exported in parallel in `format`. Exports
+    keep the order of the queryset, so it has to be ordered by pk.
+    """
+    return (format in FORMATS and hasattr(os, 'fork') and
+            (pks is not None or report._get_pk_ordering(queryset) == 'pk'))
+
+
+def get_shards(queryset, pks, count):
+    """ Split the objects of `queryset` in at most `count` shards of
+    contiguous primary keys, or `pks` in at most `count` consecutive slices,
+    in order. Shards are ('pks', list of pks) or ('range', (first pk, pk
+    after the last or None)).
+    """
+    if pks is not None:
+        pks = list(pks)
+        size = max(-(-len(pks) // count), 1)
+        return [('pks', pks[i:i + size]) for i in six.moves.range(0, len(pks), size)]
+
+    pk_queryset = queryset.order_by('pk').values_list('pk', flat=True)
+    total = pk_queryset.count()
+    # Positions of the first pk of each shard, read in a single pass
+    positions = [i * total // count for i in six.moves.range(min(count, total))]
+    bounds = []
+    for position, bound in enumerate(pk_queryset.iterator()):
+        if position > positions[-1]:
+            break
+        if position in positions and (not bounds or bound != bounds[-1]):
+            bounds.append(bound)
+    return [
+        ('range', (bound, bounds[i + 1] if i + 1 < len(bounds) else None))
+        for i, bound in enumerate(bounds)
+    ]
+
+
+@contextmanager
+def _snapshot(using):
+    """ Open a transaction on PostgreSQL and yield the id of its snapshot,
+    to be read by workers. Yields None on other databases.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        yield None
+        return
+    # A transaction opened here has read nothing yet
+    isolate = not connection.in_atomic_block
+    with transaction.atomic(using=using):
+        with connection.cursor() as cursor:
+            if isolate:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            cursor.execute("SELECT pg_export_snapshot()")
+            yield cursor.fetchone()[0]
+
+
+def _is_in_memory_db(connection):
+    """ Compatible with Django<1.10, where `is_in_memory_db` takes the name
+    of the database.
+    """
+    try:
+        return connection.is_in_memory_db()
+    except TypeError:
+        return connection.is_in_memory_db(connection.settings_dict['NAME'])
+
+
+def _init_worker(export):
+    """ Set the `export` of the shards in a forked worker, and keep it from
+    using or closing the connections of the exporting process, it opens its
+    own. In-memory SQLite databases only exist in their connection, which is
+    kept.
+    """
+    global _export
+    _export = export
+    for connection in connections.all():
+        if connection.connection is None:
+            continue
+        if connection.vendor == 'sqlite' and _is_in_memory_db(connection):
+            continue
+        _inherited_connections.append(connection.connection)
+        connection.connection = None
+
+
+def _export_shard(task):
+    """ Export a shard to a part file, returning its path and row count """
+    index, (kind, value) = task
+    queryset, fields, format, user, options, snapshot, directory = _export
+    queryset = queryset.order_by('pk')
+    pks = None
+    if kind == 'pks':
+        pks = value
+    else:
+        queryset = queryset.filter(pk__gte=value[0])
+        if value[1] is not None:
+            queryset = queryset.filter(pk__lt=value[1])
+
+    rows_done = [0]
+
+    def count(rows):
+        for row in rows:
+            rows_done[0] += 1
+            yield row
+
+    path = os.path.join(directory, '%06d%s' % (index, report.get_format_extension(format)))
+    with transaction.atomic(using=queryset.db):
+        if snapshot:
+            with connections[queryset.db].cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                cursor.execute("SET TRANSACTION SNAPSHOT %s", [snapshot])
+        rows, message = report.report_to_iterator(queryset, fields, user, pks=pks, **options)
+        rows = count(rows)
+        columns = report.get_export_columns(queryset.model, fields, user, **options)
+        # Parts are concatenated, only the first one has the csv header
+        header = [name for name, field in columns] if index == 0 else None
+        with open(path, 'wb') as part:
+            for chunk in report.iter_format(rows, format, header=header, columns=columns):
+                part.write(chunk)
+    return path, rows_done[0]
+
+
+def _get_pool(workers, export):
+    """ Fork `workers` processes exporting shards of `export`. Arguments of
+    forked workers are inherited, not pickled.
+    """
+    get_context = getattr(multiprocessing, 'get_context', None)
+    context = get_context('fork') if get_context else multiprocessing
+    return context.Pool(workers, initializer=_init_worker, initargs=(export,))
+
+
+def export_parts(queryset, fields, format, user, pks=None, options=None, workers=2,
+                 directory=None, progress=None):
+    """ Export `fields` of `queryset`, or of its objects in `pks`, in
+    `workers` processes, to part files of `format` in `directory`.
+
+    `options` are keyword arguments for `report.report_to_iterator`, merged
+    with the ones declared on the model admin. `progress` is an optional
+    function called with the number of rows exported as shards complete.
+
+    Returns the paths of the parts, in order.
+    """
+    options = dict(options or {})
+    options.update(get_export_options(admin.site._registry.get(queryset.model)))
+    chunk_size = report._get_chunk_size()
+
+    with _snapshot(queryset.db) as snapshot:
+        total = len(pks) if pks is not None else queryset.count()
+        count = min(workers * 4, max(-(-total // chunk_size), 1))
+        # An empty export still has a part, with the header
+        shards = get_shards(queryset, pks, count) or [('pks', [])]
+        export = (queryset, fields, format, user, options, snapshot, directory)
+        pool = _get_pool(min(workers, len(shards)), export)
+        try:
+            paths, rows_done = [], 0
+            for path, rows in pool.imap(_export_shard, enumerate(shards)):
+                paths.append(path)
+                rows_done += rows
+                if progress:
+                    progress(rows_done)
+        finally:
+            pool.terminate()
+            pool.join()
+    return paths
+
+
+def _iter_concatenated(paths):
+    for path in paths:
+        for chunk in report._iter_file(open(path, 'rb')):
+            yield chunk
+
+
+def iter_parallel(queryset, fields, format, user, pks=None, options=None, workers=2,
+                  progress=None):
+    """ Same as `export_parts`, yielding chunks of bytes of the concatenated
+    parts. Part files are removed once read.
+    """
+    directory = tempfile.mkdtemp(prefix='export_action')
+    try:
+        paths = export_parts(queryset, fields, format, user, pks=pks, options=options,
+                             workers=workers, directory=directory, progress=progress)
+        for chunk in _iter_concatenated(paths):
+            yield chunk
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
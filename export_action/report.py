@@ -2,28 +2,46 @@
 
 from __future__ import unicode_literals, absolute_import
 
-from collections import namedtuple
-from itertools import chain
+from collections import defaultdict, namedtuple, OrderedDict
+from itertools import chain, islice
+from tempfile import SpooledTemporaryFile
 import csv
+import datetime
+import json
 import re
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.contrib import auth
+from django.db import connections
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils.text import force_text
 from django.template.loader import render_to_string
 from django.utils import timezone
+from django.utils.duration import duration_string
 
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font
 from openpyxl.utils import get_column_letter
 from openpyxl.workbook import Workbook
 from openpyxl.writer.excel import save_virtual_workbook
 
-from django.utils.six import BytesIO, text_type
+from django.utils import six
+from django.utils.six import BytesIO, StringIO, text_type
 
-from .introspection import get_model_from_path_string
+from . import columnar, compression
+from .aggregates import get_string_agg, SEPARATOR
+from .converters import binary_to_text, convert_rows, get_converters, html_cell, to_cell
+from .expressions import choices_display, get_format_expression
+from .introspection import (
+    compile_field_paths, get_model_index, get_related_lookups, get_value_field)
 
 
 DisplayField = namedtuple("DisplayField", "path field")
 
+# Formats keeping the types of values, which need the columns of the rows.
+# Other formats use them to convert values, when given.
+TYPED_FORMATS = ('ndjson',) + columnar.FORMATS
+
 
 def generate_filename(title, ends_with):
     title = title.split('.')[0]
@@ -34,66 +52,516 @@ def generate_filename(title, ends_with):
     return title
 
 
+def _get_all_permissions(user):
+    """ Return all permissions of `user`, or None if some authentication
+    backend can't list them, so each one must be checked with `has_perm`.
+    """
+    if not all(hasattr(backend, 'get_all_permissions') for backend in auth.get_backends()):
+        return None
+    if not hasattr(user, '_export_action_all_perms'):
+        user._export_action_all_perms = user.get_all_permissions()
+    return user._export_action_all_perms
+
+
 def _can_change_or_view(model, user):
     """ Return True iff `user` has either change or view permission
     for `model`.
+
+    Results are cached on `user`, like backends cache permissions, so each
+    model is checked once per request.
     """
     model_name = model._meta.model_name
     app_label = model._meta.app_label
-    can_change = user.has_perm(app_label + '.change_' + model_name)
-    can_view = user.has_perm(app_label + '.view_' + model_name)
+    if not hasattr(user, '_export_action_perm_cache'):
+        user._export_action_perm_cache = {}
+    cache = user._export_action_perm_cache
+
+    if (app_label, model_name) not in cache:
+        perms = (app_label + '.change_' + model_name, app_label + '.view_' + model_name)
+        all_perms = None
+        if user.is_active and not user.is_superuser:
+            all_perms = _get_all_permissions(user)
+        if all_perms is not None:
+            allowed = any(perm in all_perms for perm in perms)
+        else:
+            allowed = user.has_perm(perms[0]) or user.has_perm(perms[1])
+        cache[(app_label, model_name)] = allowed
 
-    return can_change or can_view
+    return cache[(app_label, model_name)]
 
 
-def report_to_list(queryset, display_fields, user):
-    """ Create list from a report with all data filtering.
-
-    queryset: initial queryset to generate results
-    display_fields: list of field references or DisplayField models
-    user: requesting user
+def _get_chunk_size():
+    return getattr(settings, 'EXPORT_ACTION_CHUNK_SIZE', 2000)
 
-    Returns list, message in case of issues.
-    """
-    model_class = queryset.model
-    objects = queryset
-    message = ""
 
-    if not _can_change_or_view(model_class, user):
-        return [], 'Permission Denied'
+def _get_stream_buffer_size():
+    return getattr(settings, 'EXPORT_ACTION_STREAM_BUFFER_SIZE', 64 * 1024)
 
-    # Convert list of strings to DisplayField objects.
-    new_display_fields = []
 
-    for display_field in display_fields:
-        field_list = display_field.split('__')
-        field = field_list[-1]
-        path = '__'.join(field_list[:-1])
+def _iterator(queryset, chunk_size):
+    """
+    Compatible with Django<2.0, where `QuerySet.iterator` has no `chunk_size`
+    """
+    try:
+        return queryset.iterator(chunk_size=chunk_size)
+    except TypeError:
+        return queryset.iterator()
 
-        if path:
-            path += '__'  # Legacy format to append a __ here.
 
-        df = DisplayField(path, field)
-        new_display_fields.append(df)
+def _resolve_display_fields(model_class, display_fields, user, plan=None):
+    """ Convert field references to the `values_list` paths `user` is
+    allowed to see. `plan` is the `FieldPathPlan` of `display_fields`, when
+    compiled beforehand.
 
-    display_fields = new_display_fields
+    Returns list of paths, message in case of issues.
+    """
+    message = ""
+    plan = plan or compile_field_paths(model_class, display_fields)
 
     # Display Values
     display_field_paths = []
 
-    for i, display_field in enumerate(display_fields):
-        model = get_model_from_path_string(model_class, display_field.path)
+    for column in plan.columns:
+        if column.path in plan.invalid:
+            message += 'Error: Unknown field {0}.'.format(column.path)
+
+        elif _can_change_or_view(column.model, user):
+            display_field_paths.append(column.path)
+
+        else:
+            message += 'Error: Permission denied on access to {0}.'.format(column.path)
 
-        if not model or _can_change_or_view(model, user):
-            display_field_key = display_field.path + display_field.field
+    return display_field_paths, message
 
-            display_field_paths.append(display_field_key)
 
+def _get_pk_ordering(queryset):
+    """ Return 'pk' or '-pk' if `queryset` can be paginated on its primary
+    key without changing its ordering, None otherwise.
+    """
+    query = queryset.query
+    ordering = query.order_by or (query.default_ordering and queryset.model._meta.ordering)
+    if not ordering:
+        return 'pk'
+    pk = queryset.model._meta.pk
+    if len(ordering) == 1 and isinstance(ordering[0], six.string_types):
+        if ordering[0].lstrip('-') in ('pk', pk.name, pk.attname):
+            return '-pk' if ordering[0].startswith('-') else 'pk'
+    return None
+
+
+def _iter_keyset(queryset, values, chunk_size, ordering='pk'):
+    """ Yield `values(queryset)` rows, `chunk_size` objects at a time, using
+    keyset pagination on the primary key.
+
+    Each chunk is bounded by the pk of its last object, found beforehand, so
+    objects spanning several rows through to-many relations are not split.
+    """
+    descending = ordering == '-pk'
+    after, until = ('pk__lt', 'pk__gte') if descending else ('pk__gt', 'pk__lte')
+    queryset = queryset.order_by(ordering)
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(**{after: last_pk})
+        bound = list(chunk.values_list('pk', flat=True)[chunk_size - 1:chunk_size])
+        if bound:
+            chunk = chunk.filter(**{until: bound[0]})
+        for row in values(chunk):
+            yield row
+        if not bound:
+            break
+        last_pk = bound[0]
+
+
+def _iter_pk_chunks(queryset, values, pks, chunk_size):
+    """ Yield `values(queryset)` rows, which start with the pk, for objects
+    in `pks`, in the order of `pks`, querying at most `chunk_size` pks at a
+    time. Rows of each chunk are grouped by object before they are yielded.
+    """
+    ops = connections[queryset.db].ops
+    pk_field = queryset.model._meta.pk
+    pks = list(OrderedDict.fromkeys(pk_field.to_python(pk) for pk in pks))
+    chunk_size = max(min(chunk_size, ops.bulk_batch_size(['pk'], pks)), 1)
+    for i in six.moves.range(0, len(pks), chunk_size):
+        chunk = pks[i:i + chunk_size]
+        if all(isinstance(pk, six.integer_types) for pk in chunk) and \
+                max(chunk) - min(chunk) == len(chunk) - 1:
+            chunk_queryset = queryset.filter(pk__range=(min(chunk), max(chunk)))
         else:
-            message += 'Error: Permission denied on access to {0}.'.format(
-                display_field.name
+            chunk_queryset = queryset.filter(pk__in=chunk)
+        rows = defaultdict(list)
+        for row in values(chunk_queryset):
+            rows[row[0]].append(row)
+        for pk in chunk:
+            for row in rows.pop(pk, ()):
+                yield row
+
+
+def _iter_joined_to_many(rows, queryset, paths, to_many, chunk_size):
+    """ Fill the `to_many` columns of `rows`, which start with the pk and
+    have the other `paths`, with the distinct values of each object joined in
+    a string. Values are queried for `chunk_size` objects at a time.
+
+    Yields rows starting with the pk, followed by `paths`.
+    """
+    ops = connections[queryset.db].ops
+    queryset = queryset.model._default_manager.using(queryset.db).order_by()
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        pks = [row[0] for row in chunk]
+        joined = {}
+        for path in to_many:
+            values = defaultdict(OrderedDict)
+            batch_size = max(ops.bulk_batch_size(['pk'], pks), 1)
+            for i in six.moves.range(0, len(pks), batch_size):
+                for pk, value in queryset.filter(
+                        pk__in=pks[i:i + batch_size]).values_list('pk', path):
+                    if value is not None:
+                        values[pk][force_text(value)] = None
+            joined[path] = values
+        for row in chunk:
+            pk, others = row[0], iter(row[1:])
+            yield (pk,) + tuple(
+                (SEPARATOR.join(joined[path][pk]) or None) if path in to_many else next(others)
+                for path in paths
+            )
+
+
+def _get_computed_value(obj, name):
+    if obj is None:
+        return None
+    value = getattr(obj, name)
+    if callable(value):
+        value = value()
+    return value
+
+
+def _iter_computed(rows, queryset, columns, computed, chunk_size):
+    """ Insert the `computed` columns in `rows`, which start with the pk and
+    have the other `columns`. Values are read from model instances, fetched
+    `chunk_size` objects at a time along with the relations their
+    dependencies declare, so each chunk takes a fixed number of queries.
+    """
+    ops = connections[queryset.db].ops
+    select_related, prefetch_related = get_related_lookups(
+        queryset.model, chain.from_iterable(computed.values()))
+    queryset = queryset.model._default_manager.using(queryset.db).order_by()
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    if prefetch_related:
+        queryset = queryset.prefetch_related(*prefetch_related)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        pks = list(OrderedDict.fromkeys(row[0] for row in chunk))
+        objects = {}
+        batch_size = max(ops.bulk_batch_size(['pk'], pks), 1)
+        for i in six.moves.range(0, len(pks), batch_size):
+            for obj in queryset.filter(pk__in=pks[i:i + batch_size]):
+                objects[obj.pk] = obj
+        for row in chunk:
+            obj, others = objects.get(row[0]), iter(row[1:])
+            yield tuple(
+                _get_computed_value(obj, name) if name in computed else next(others)
+                for name in columns
             )
 
+
+def _resolve_computed_fields(model_class, display_fields, computed, user):
+    """ Return the `computed` fields selected in `display_fields` that
+    `user` is allowed to see, with their dependencies, and a message in case
+    of issues.
+    """
+    message = ""
+    allowed = OrderedDict()
+    for name in display_fields:
+        if name not in computed:
+            continue
+        if not hasattr(model_class, name):
+            message += 'Error: Unknown field {0}.'.format(name)
+            continue
+        plan = compile_field_paths(model_class, computed[name])
+        if all(_can_change_or_view(model, user) for model in plan.models):
+            allowed[name] = computed[name]
+        else:
+            message += 'Error: Permission denied on access to {0}.'.format(name)
+    return allowed, message
+
+
+def report_to_iterator(queryset, display_fields, user, chunk_size=None, pks=None,
+                       aggregate=False, computed=None, labels=False, formats=None, plan=None):
+    """ Same as `report_to_list`, but rows are fetched lazily from the
+    database in chunks of `chunk_size` (`EXPORT_ACTION_CHUNK_SIZE`) objects.
+
+    pks: optional list of primary keys to export from `queryset`, queried
+    in chunks instead of in a single `pk__in` lookup, and exported in their
+    order.
+    aggregate: if True, paths through m2m and reverse FK relations have the
+    distinct values of each object joined in a string, so there is one row per
+    object. Uses a database aggregate when there is one, or a query per chunk
+    of objects and path otherwise.
+    computed: optional dict of model properties or methods that can be
+    exported, to the list of field paths they read, like
+    `{'contact': ['reporter__email']}`.
+    labels: if True, fields with choices are exported with their labels.
+    formats: optional dict of field paths to a strftime format, an
+    expression or a function of the path returning an expression, computed
+    by the database, like `{'articletag__created_on': '%Y-%m-%d'}`.
+    plan: optional `FieldPathPlan` of the field paths of `display_fields`,
+    compiled beforehand like the ones of presets, so they are not resolved
+    again.
+
+    Querysets ordered by pk (or not ordered) are paginated on pk, so every
+    query is small. Other orderings are read through a single query.
+
+    Returns iterator of tuples, message in case of issues.
+    """
+    model_class = queryset.model
+    chunk_size = chunk_size or _get_chunk_size()
+
+    if not _can_change_or_view(model_class, user):
+        return iter([]), 'Permission Denied'
+
+    declared = computed or {}
+    computed, message = _resolve_computed_fields(model_class, display_fields, declared, user)
+    columns = list(display_fields)
+    display_fields = [name for name in columns if name not in declared]
+    plan = plan or compile_field_paths(model_class, display_fields)
+    display_field_paths, paths_message = _resolve_display_fields(
+        model_class, display_fields, user, plan)
+    message += paths_message
+
+    fields = dict((column.path, column.field) for column in plan.columns)
+    to_many, string_agg = [], None
+    if aggregate:
+        to_many = [path for path in display_field_paths if path in plan.to_many]
+        string_agg = get_string_agg(connections[queryset.db].vendor)
+
+    # Values computed by the database are annotated, and selected instead of
+    # their paths.
+    formats = formats or {}
+    annotations, names = OrderedDict(), []
+    for i, path in enumerate(display_field_paths):
+        name = '_export_action_%d' % i
+        if path in to_many:
+            if not string_agg:
+                continue
+            annotations[name] = string_agg(path)
+        elif path in formats:
+            annotations[name] = get_format_expression(path, formats[path])
+        elif labels and getattr(fields[path], 'flatchoices', None):
+            annotations[name] = choices_display(path, fields[path])
+        else:
+            name = path
+        names.append(name)
+
+    # Later stages need the pk of each row, dropped at the end
+    with_pk = bool(computed) or bool(to_many and not string_agg) or pks is not None
+    if with_pk:
+        names = ['pk'] + names
+
+    def values(queryset):
+        return queryset.annotate(**annotations).values_list(*names)
+
+    if pks is not None:
+        rows = _iter_pk_chunks(queryset, values, pks, chunk_size)
+    elif _get_pk_ordering(queryset):
+        rows = _iter_keyset(queryset, values, chunk_size, _get_pk_ordering(queryset))
+    else:
+        rows = _iterator(values(queryset), chunk_size)
+
+    if to_many and not string_agg:
+        rows = _iter_joined_to_many(rows, queryset, display_field_paths, to_many, chunk_size)
+    if computed:
+        columns = [name for name in columns if name in computed or name in display_field_paths]
+        rows = _iter_computed(rows, queryset, columns, computed, chunk_size)
+    elif with_pk:
+        rows = (row[1:] for row in rows)
+    return rows, message
+
+
+def get_export_columns(model_class, display_fields, user, aggregate=False, computed=None,
+                       labels=False, formats=None, plan=None):
+    """ Return the columns of the rows of `report_to_iterator`, called with
+    the same arguments, as a list of (name, field).
+
+    `field` is the model field the values are read from, or None if they
+    are text built by the export, like labels, formats, joined values of
+    to-many paths and computed fields.
+    """
+    declared = computed or {}
+    computed, _ = _resolve_computed_fields(model_class, display_fields, declared, user)
+    paths = [name for name in display_fields if name not in declared]
+    plan = plan or compile_field_paths(model_class, paths)
+    display_field_paths, _ = _resolve_display_fields(model_class, paths, user, plan)
+
+    fields = dict((column.path, column.field) for column in plan.columns)
+    formats = formats or {}
+    columns = []
+    for name in display_fields:
+        if name in computed:
+            columns.append((name, None))
+        elif name in display_field_paths:
+            field = fields[name]
+            if (name in formats or (aggregate and name in plan.to_many) or
+                    (labels and getattr(field, 'flatchoices', None))):
+                field = None
+            columns.append((name, field))
+    return columns
+
+
+def _split_relation(model_class, path):
+    """ Split `path` in the relations it goes through, as a list of
+    (name, related model, to many), and the field read at the end, which is
+    None if `path` ends with a relation.
+    """
+    sections = path.split('__')
+    model, relation = model_class, []
+    for section in sections:
+        index = get_model_index(model)
+        related_model = index.related_models.get(section)
+        if related_model is None:
+            break
+        relation.append((section, related_model, section in index.to_many))
+        model = related_model
+    return relation, '__'.join(sections[len(relation):]) or None
+
+
+def _iter_distinct(rows, width):
+    """ Yield `rows` whose first `width` values are set, once per value.
+    Values seen are kept in memory.
+    """
+    seen = set()
+    for row in rows:
+        key = tuple(row[:width])
+        if None in key or key in seen:
+            continue
+        seen.add(key)
+        yield row
+
+
+def report_to_sheets(queryset, display_fields, user, chunk_size=None, pks=None,
+                     computed=None, labels=False, formats=None, plan=None):
+    """ Same as `report_to_iterator`, but rows are normalized in one sheet
+    per model reached by `display_fields`, instead of joined in one sheet.
+
+    The root sheet has a row per object. Each related model has a sheet of
+    its distinct objects, keyed by pk, and objects hold the pks of their
+    to-one relations. To-many relations are kept in sheets of (pk, pk) links.
+    Each sheet is read by its own chunked query, related objects and links
+    being de-duplicated by the database, through a subquery of the exported
+    objects. On databases limiting query parameters, like SQLite, selections
+    of `pks` larger than a batch are read per chunk of exported objects and
+    de-duplicated in memory instead.
+
+    Returns list of (sheet name, header, rows iterator), message in case of
+    issues.
+    """
+    model_class = queryset.model
+    if not _can_change_or_view(model_class, user):
+        return [(model_class._meta.model_name, [], iter([]))], 'Permission Denied'
+
+    declared = computed or {}
+    computed, message = _resolve_computed_fields(model_class, display_fields, declared, user)
+    paths, paths_message = _resolve_display_fields(
+        model_class, [name for name in display_fields if name not in declared], user, plan)
+    message += paths_message
+
+    # {relation path: (model, columns)}, and (parent, relation) to-many links
+    sheets = OrderedDict([('', (model_class, []))])
+    links = []
+    for path in paths:
+        relation, field = _split_relation(model_class, path)
+        prefix = ''
+        for name, related_model, to_many in relation:
+            parent, prefix = prefix, prefix + '__' + name if prefix else name
+            if prefix in sheets:
+                continue
+            sheets[prefix] = (related_model, [])
+            if to_many:
+                links.append((parent, prefix))
+            else:
+                sheets[parent][1].append(prefix)
+        if field is not None and path not in sheets[prefix][1]:
+            sheets[prefix][1].append(path)
+
+    def pk_path(prefix):
+        pk_name = sheets[prefix][0]._meta.pk.name
+        return prefix + '__' + pk_name if prefix else pk_name
+
+    def sheet_name(prefix):
+        return prefix or model_class._meta.model_name
+
+    def rows(columns, **options):
+        return report_to_iterator(
+            queryset, columns, user, chunk_size=chunk_size, pks=pks, labels=labels,
+            formats=formats, **options)[0]
+
+    ops = connections[queryset.db].ops
+    in_database = pks is None or len(pks) <= ops.bulk_batch_size(['pk'], pks)
+    selected = queryset if pks is None else queryset.filter(pk__in=pks)
+
+    def related_rows(prefix, model, columns):
+        """ Rows of the distinct `model` objects reached by `prefix` """
+        if not in_database:
+            return _iter_distinct(rows(columns), 1)
+        start = len(prefix) + 2
+        related = model._default_manager.using(queryset.db).filter(
+            pk__in=selected.order_by().values(pk_path(prefix))).order_by('pk')
+        related_formats = dict(
+            (path[start:], format) for path, format in (formats or {}).items()
+            if path.startswith(prefix + '__'))
+        return report_to_iterator(
+            related, [path[start:] for path in columns], user, chunk_size=chunk_size,
+            labels=labels, formats=related_formats)[0]
+
+    def link_rows(parent, prefix, columns):
+        """ Rows of the distinct links between objects of `parent` and `prefix` """
+        if not all(_can_change_or_view(sheets[name][0], user) for name in (parent, prefix)):
+            return iter([])
+        if not in_database:
+            return _iter_distinct(rows(columns), 2)
+        links = selected.filter(**dict((path + '__isnull', False) for path in columns))
+        links = links.order_by(*columns).values_list(*columns).distinct()
+        return _iterator(links, chunk_size or _get_chunk_size())
+
+    result = []
+    for prefix, (model, columns) in sheets.items():
+        columns = [pk_path(prefix)] + [path for path in columns if path != pk_path(prefix)]
+        if prefix:
+            header = [path[len(prefix) + 2:] for path in columns]
+            result.append((sheet_name(prefix), header, related_rows(prefix, model, columns)))
+        else:
+            columns += list(computed)
+            result.append((sheet_name(prefix), columns, rows(columns, computed=computed)))
+    for parent, prefix in links:
+        columns = [pk_path(parent), pk_path(prefix)]
+        header = [sheet_name(parent), sheet_name(prefix)]
+        result.append((
+            sheet_name(parent) + '_' + prefix.rpartition('__')[2], header,
+            link_rows(parent, prefix, columns)))
+    return result, message
+
+
+def report_to_list(queryset, display_fields, user):
+    """ Create list from a report with all data filtering.
+
+    queryset: initial queryset to generate results
+    display_fields: list of field references or DisplayField models
+    user: requesting user
+
+    Returns list, message in case of issues.
+    """
+    model_class = queryset.model
+    objects = queryset
+
+    if not _can_change_or_view(model_class, user):
+        return [], 'Permission Denied'
+
+    display_field_paths, message = _resolve_display_fields(model_class, display_fields, user)
+
     values_list = objects.values_list(*display_field_paths)
     values_and_properties_list = [list(row) for row in values_list]
 
@@ -115,16 +583,7 @@ def build_sheet(data, ws, sheet_name='report', header=None, widths=None):
 
     for row in data:
         for i in range(len(row)):
-            item = row[i]
-            # If item is a regular string
-            if isinstance(item, str):
-                # Change it to a unicode string
-                try:
-                    row[i] = text_type(item)
-                except UnicodeDecodeError:
-                    row[i] = text_type(item.decode('utf-8', 'ignore'))
-            elif type(item) is dict:
-                row[i] = text_type(item)
+            row[i] = to_cell(row[i])
         try:
             ws.append(row)
         except ValueError as e:
@@ -166,6 +625,113 @@ def build_xlsx_response(wb, title="report"):
     return response
 
 
+def _convert_rows(data, columns, target):
+    """ Convert values of `data` for `target` if its `columns` are known,
+    see `converters.get_converters`.
+    """
+    if columns is None:
+        return None
+    converters, null = get_converters(columns, target)
+    return convert_rows(data, converters, null)
+
+
+def _write_sheet(wb, data, title='report', header=None, widths=None, columns=None):
+    ws = wb.create_sheet(title=re.sub(r'\W+', '', title)[:30])
+
+    if widths:
+        for i, width in enumerate(widths):
+            ws.column_dimensions[get_column_letter(i + 1)].width = width
+    if header:
+        header_cells = []
+        for header_cell in header:
+            cell = WriteOnlyCell(ws, value=header_cell)
+            cell.font = Font(bold=True)
+            header_cells.append(cell)
+        ws.append(header_cells)
+
+    rows = _convert_rows(data, columns, 'xlsx')
+    if rows is None:
+        rows = ([to_cell(item) for item in row] for row in data)
+    for row in rows:
+        try:
+            ws.append(row)
+        except ValueError as e:
+            ws.append([text_type(e)])
+
+
+def build_xlsx_sheets_file(sheets, widths=None, columns=None):
+    """ Write each (title, header, rows) of `sheets`, like the result of
+    `report_to_sheets`, to its own sheet of a write-only workbook, so cells
+    are not kept in memory, and save it to a temporary file that is spooled
+    to disk once it grows past `EXPORT_ACTION_SPOOL_MAX_SIZE` bytes. Values
+    are converted per column when the `columns` of the rows are given.
+
+    Returns the file, positioned at its end.
+    """
+    wb = Workbook(write_only=True)
+    for title, header, data in sheets:
+        _write_sheet(wb, data, title=title, header=header, widths=widths, columns=columns)
+
+    max_size = getattr(settings, 'EXPORT_ACTION_SPOOL_MAX_SIZE', 10 * 1024 * 1024)
+    myfile = SpooledTemporaryFile(max_size=max_size)
+    wb.save(myfile)
+    return myfile
+
+
+def build_xlsx_file(data, title='report', header=None, widths=None, columns=None):
+    """ Same as `build_xlsx_sheets_file`, with the rows of `data` in a
+    single sheet.
+    """
+    return build_xlsx_sheets_file([(title, header, data)], widths=widths, columns=columns)
+
+
+def _iter_file(myfile, chunk_size=None):
+    """ Read `myfile` from the start in chunks, closing it at the end """
+    chunk_size = chunk_size or _get_stream_buffer_size()
+    try:
+        myfile.seek(0)
+        while True:
+            chunk = myfile.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        myfile.close()
+
+
+def iter_xlsx(data, title='report', header=None, widths=None, columns=None):
+    """ Same as `build_xlsx_file`, yielding chunks of bytes of the file """
+    return _iter_file(build_xlsx_file(
+        data, title=title, header=header, widths=widths, columns=columns))
+
+
+def iter_xlsx_sheets(sheets):
+    """ Same as `build_xlsx_sheets_file`, yielding chunks of bytes of the file """
+    return _iter_file(build_xlsx_sheets_file(sheets))
+
+
+def stream_to_xlsx_response(data, title='report', header=None, widths=None, columns=None):
+    """ Make an iterable of rows into a xlsx response for download.
+    The workbook is built with constant memory and then served in chunks.
+    """
+    return stream_to_xlsx_sheets_response(
+        [(title, header, data)], title=title, widths=widths, columns=columns)
+
+
+def stream_to_xlsx_sheets_response(sheets, title='report', widths=None, columns=None):
+    """ Same as `stream_to_xlsx_response`, with a sheet per
+    (title, header, rows) of `sheets`.
+    """
+    myfile = build_xlsx_sheets_file(sheets, widths=widths, columns=columns)
+    response = StreamingHttpResponse(
+        _iter_file(myfile),
+        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    response['Content-Disposition'] = 'attachment; filename=%s' % generate_filename(
+        title, '.xlsx')
+    response['Content-Length'] = myfile.tell()
+    return response
+
+
 def list_to_xlsx_response(data, title='report', header=None,
                           widths=None):
     """ Make 2D list into a xlsx response for download
@@ -180,12 +746,230 @@ def list_to_csv_response(data, title='report', header=None, widths=None):
     """ Make 2D list into a csv response for download data.
     """
     response = HttpResponse(content_type="text/csv; charset=UTF-8")
-    cw = csv.writer(response)
-    for row in chain([header] if header else [], data):
-        cw.writerow([force_text(s).encode(response.charset) for s in row])
+    for chunk in iter_csv(data, header=header, encoding=response.charset):
+        response.write(chunk)
     return response
 
 
 def list_to_html_response(data, title='', header=None):
     html = render_to_string('export_action/report_html.html', locals())
     return HttpResponse(html)
+
+
+def iter_csv(data, header=None, encoding='utf-8', columns=None):
+    """ Encode rows of `data` as csv, yielding chunks of bytes.
+
+    Rows are written through a single reusable buffer that is flushed every
+    `EXPORT_ACTION_STREAM_BUFFER_SIZE` bytes, so memory usage does not grow
+    with the number of rows. When the `columns` of the rows are given, only
+    the values the csv module cannot write are converted.
+    """
+    buffer_size = _get_stream_buffer_size()
+    buf = BytesIO() if six.PY2 else StringIO()
+    cw = csv.writer(buf)
+    rows = None if six.PY2 else _convert_rows(data, columns, 'csv')
+    if rows is None:
+        if six.PY2:
+            rows = ([force_text(s).encode(encoding) for s in row] for row in data)
+        else:
+            rows = ([force_text(s) for s in row] for row in data)
+    if header:
+        cw.writerow([force_text(s).encode(encoding) for s in header] if six.PY2 else header)
+    for row in rows:
+        cw.writerow(row)
+        if buf.tell() >= buffer_size:
+            yield _flush(buf, encoding)
+    if buf.tell():
+        yield _flush(buf, encoding)
+
+
+def _flush(buf, encoding):
+    value = buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    return value if six.PY2 else value.encode(encoding)
+
+
+def stream_to_csv_response(data, title='report', header=None, columns=None):
+    """ Make an iterable of rows into a streaming csv response for download.
+    `data` is consumed lazily, so it can be a `report_to_iterator` result.
+    """
+    response = StreamingHttpResponse(content_type="text/csv; charset=UTF-8")
+    response.streaming_content = iter_csv(
+        data, header=header, encoding=response.charset, columns=columns)
+    response['Content-Disposition'] = 'attachment; filename=%s' % generate_filename(title, '.csv')
+    return response
+
+
+def iter_html(data, title='', header=None, encoding='utf-8', columns=None):
+    """ Render rows of `data` as an html table, yielding chunks of bytes.
+
+    The document head is rendered once from a template, while rows are
+    escaped and formatted by a row template built from the first row. When
+    the `columns` of the rows are given, values that cannot contain html,
+    like numbers and dates, are not escaped.
+    """
+    context = {'title': title, 'header': header}
+    buffer_size = _get_stream_buffer_size()
+    yield render_to_string('export_action/report_html_head.html', context).encode(encoding)
+
+    rows = _convert_rows(data, columns, 'html')
+    if rows is None:
+        rows = (tuple(html_cell(cell) for cell in row) for row in data)
+    row_format = None
+    chunk, size = [], 0
+    for row in rows:
+        if row_format is None:
+            row_format = '        <tr>' + '<td>%s</td>' * len(row) + '</tr>\n'
+        line = row_format % row
+        chunk.append(line)
+        size += len(line)
+        if size >= buffer_size:
+            yield ''.join(chunk).encode(encoding)
+            chunk, size = [], 0
+    if chunk:
+        yield ''.join(chunk).encode(encoding)
+
+    yield render_to_string('export_action/report_html_foot.html', context).encode(encoding)
+
+
+def stream_to_html_response(data, title='', header=None, columns=None):
+    """ Make an iterable of rows into a streaming html response.
+    Rows are sent as they are read, so browsers can start rendering early.
+    """
+    response = StreamingHttpResponse()
+    response.streaming_content = iter_html(
+        data, title=title, header=header, encoding=response.charset, columns=columns)
+    return response
+
+
+def _json_default(value):
+    """ Encode values of computed columns, whose types are unknown """
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return duration_string(value)
+    return force_text(value)
+
+
+def _isoformat(value):
+    return value.isoformat()
+
+
+JSON_ENCODERS = {
+    'DecimalField': force_text,
+    'DateTimeField': _isoformat,
+    'DateField': _isoformat,
+    'TimeField': _isoformat,
+    'DurationField': duration_string,
+    'UUIDField': force_text,
+    'BinaryField': binary_to_text,
+}
+
+
+def get_json_encoder(field):
+    """ Return a function converting values of a model `field` to a json
+    type, or None if they are json types already.
+    """
+    field = get_value_field(field)
+    if field is None:
+        return None
+    return JSON_ENCODERS.get(field.get_internal_type())
+
+
+def iter_ndjson(data, columns, encoding='utf-8'):
+    """ Encode rows of `data` as newline delimited json objects, yielding
+    chunks of bytes.
+
+    `columns` are the names and fields of the rows, see `get_export_columns`.
+    Keys are encoded once, and values by an encoder chosen per column, so
+    ints, floats and booleans keep their types, decimals are strings and
+    dates are in ISO 8601.
+    """
+    buffer_size = _get_stream_buffer_size()
+    dumps = json.JSONEncoder(ensure_ascii=False, default=_json_default).encode
+    keys = [
+        (',' if i else '{') + dumps(force_text(name)) + ':'
+        for i, (name, field) in enumerate(columns)
+    ]
+    encoders = [get_json_encoder(field) for name, field in columns]
+    cells = list(zip(keys, encoders))
+
+    chunk, size = [], 0
+    for row in data:
+        parts = []
+        for (key, encoder), value in zip(cells, row):
+            if encoder is not None and value is not None:
+                value = encoder(value)
+            parts.append(key)
+            parts.append(dumps(value))
+        line = ''.join(parts) + ('}\n' if parts else '{}\n')
+        chunk.append(line)
+        size += len(line)
+        if size >= buffer_size:
+            yield ''.join(chunk).encode(encoding)
+            chunk, size = [], 0
+    if chunk:
+        yield ''.join(chunk).encode(encoding)
+
+
+def stream_to_ndjson_response(data, columns, title='report'):
+    """ Make an iterable of rows into a streaming newline delimited json
+    response, see `iter_ndjson`.
+    """
+    response = StreamingHttpResponse(content_type='application/x-ndjson; charset=UTF-8')
+    response.streaming_content = iter_ndjson(data, columns, encoding=response.charset)
+    response['Content-Disposition'] = 'attachment; filename=%s' % generate_filename(
+        title, '.ndjson')
+    return response
+
+
+def stream_to_columnar_response(data, format, columns, title='report'):
+    """ Make an iterable of rows into a streaming parquet or arrow response.
+    `columns` are the names and fields of the rows, see `get_export_columns`.
+    """
+    response = StreamingHttpResponse(
+        columnar.iter_columnar(data, format, columns),
+        content_type=columnar.CONTENT_TYPES[format])
+    response['Content-Disposition'] = 'attachment; filename=%s' % generate_filename(
+        title, get_format_extension(format))
+    return response
+
+
+def compress_response(response, method, filename):
+    """ Compress the content of a streaming export `response` as it is
+    sent, with one of `compression.COMPRESSIONS`. `filename` is the name of
+    the uncompressed file, like `generate_filename` returns it.
+    """
+    response.streaming_content = compression.iter_compressed(
+        response.streaming_content, method, filename)
+    if response.has_header('Content-Length'):
+        del response['Content-Length']
+    response['Content-Type'] = compression.CONTENT_TYPES[method]
+    response['Content-Disposition'] = 'attachment; filename=%s' % compression.get_filename(
+        filename, method)
+    return response
+
+
+def get_format_extension(format):
+    if format in ("html", "csv", "ndjson") + columnar.FORMATS:
+        return "." + format
+    return ".xlsx"
+
+
+def iter_format(data, format, title='report', header=None, columns=None):
+    """ Encode rows of `data` in one of the export formats, yielding chunks
+    of bytes. Unknown formats default to xlsx, like the export view.
+    Formats in `TYPED_FORMATS` need the `columns` of the rows, see
+    `get_export_columns`, other formats convert values per column with them.
+    """
+    if format == "html":
+        return iter_html(data, title=title, header=header, columns=columns)
+    elif format == "csv":
+        return iter_csv(data, header=header, columns=columns)
+    elif format == "ndjson":
+        return iter_ndjson(data, columns)
+    elif format in columnar.FORMATS:
+        return columnar.iter_columnar(data, format, columns)
+    else:
+        return iter_xlsx(data, title=title, header=header, columns=columns)
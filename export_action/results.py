@@ -0,0 +1,364 @@
+# coding: utf-8
+"""
+Cache of export results.
+
+When `EXPORT_ACTION_RESULT_CACHE` is set, exported files are kept in the
+storage of exported files, see `export_action.storage`, so repeating an
+export serves the file instead of running it again. Results are keyed by the
+content type, a fingerprint of the queryset and of the selection, the columns
+the user can read, the format and its options, and a freshness token:
+
+* the latest value of the field named in `export_freshness_field` of the
+  model admin, like an `updated_on` field, and the number of objects, when
+  declared;
+* otherwise, version counters of the exported model, of the models its
+  columns and the dependencies of its computed columns are read from, and of
+  the models joined by the filters of the queryset, bumped by the
+  `post_save`, `post_delete` and `m2m_changed` signals. `update()`,
+  `bulk_create()` and raw SQL send none of them, so models changed that way
+  need a freshness field.
+
+Entries expire after `EXPORT_ACTION_RESULT_CACHE_TTL` seconds, and the least
+recently used ones are removed once their files take more than
+`EXPORT_ACTION_RESULT_CACHE_MAX_SIZE` bytes. Concurrent identical exports
+share a single build: the first one streams the export while writing it to
+the storage, the others wait a few seconds for it to be stored, and build it
+without storing it when it takes longer.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+from tempfile import TemporaryFile
+import hashlib
+import json
+import time
+import uuid
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib import admin
+from django.core.cache import caches
+from django.core.files import File
+from django.db.models import Count, Max
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.http import FileResponse
+from django.utils import translation
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:  # Django<1.11
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+from . import report
+from .introspection import compile_field_paths
+from .selection import encode_pks
+from .storage import export_storage
+
+
+ENTRY_PREFIX = 'export_action_result_'
+LOCK_PREFIX = 'export_action_result_lock_'
+VERSION_PREFIX = 'export_action_version_'
+INDEX_KEY = 'export_action_result_index'
+
+
+def is_enabled():
+    return getattr(settings, 'EXPORT_ACTION_RESULT_CACHE', False)
+
+
+def _get_cache():
+    return caches[getattr(settings, 'EXPORT_ACTION_CACHE', 'default')]
+
+
+def _get_ttl():
+    return getattr(settings, 'EXPORT_ACTION_RESULT_CACHE_TTL', 60 * 60)
+
+
+def _label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.model_name)
+
+
+def get_version(model):
+    """ Return the version counter of `model`. Counters lost by the cache
+    restart from the current time, so they never go back to a used value.
+    """
+    cache = _get_cache()
+    key = VERSION_PREFIX + _label(model)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000000), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(model):
+    cache = _get_cache()
+    key = VERSION_PREFIX + _label(model)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, int(time.time() * 1000000), None)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def _bump_saved_model(sender, **kwargs):
+    if is_enabled():
+        bump_version(sender)
+
+
+@receiver(m2m_changed)
+def _bump_related_models(sender, instance, model, **kwargs):
+    if is_enabled() and kwargs['action'].startswith('post_'):
+        for changed in (sender, type(instance), model):
+            bump_version(changed)
+
+
+def _get_joined_models(queryset):
+    """ Return the models of the tables joined by the filters of `queryset` """
+    tables = dict(
+        (model._meta.db_table, model) for model in apps.get_models(include_auto_created=True))
+    return [
+        tables[join.table_name] for join in queryset.query.alias_map.values()
+        if join.table_name in tables
+    ]
+
+
+def get_freshness_token(queryset, fields, computed=None):
+    """ Return a token changing whenever objects of `queryset` exported with
+    `fields` may have changed, see the module documentation. `computed` are
+    the computed fields that can be exported, to the field paths they read.
+    """
+    model_class = queryset.model
+    model_admin = admin.site._registry.get(model_class)
+    freshness_field = getattr(model_admin, 'export_freshness_field', None)
+    if freshness_field:
+        # The count catches deletions, which leave the latest value as is
+        values = model_class._default_manager.aggregate(
+            latest=Max(freshness_field), count=Count('pk', distinct=True))
+        latest = values['latest']
+        return 'latest:%s:%d' % (latest.isoformat() if latest is not None else '',
+                                 values['count'])
+    computed = computed or {}
+    paths = [name for name in fields if name not in computed]
+    for name in fields:
+        paths.extend(computed.get(name, ()))
+    models = set(compile_field_paths(model_class, paths).models)
+    models.update(_get_joined_models(queryset))
+    models.add(model_class)
+    return 'versions:' + ','.join(
+        '%s=%s' % (_label(model), get_version(model))
+        for model in sorted(models, key=_label))
+
+
+def get_key(queryset, fields, format, user, pks=None, options=None, plan=None):
+    """ Return the key of the result of an export, or None if the export
+    cannot be cached. `options` are the options of the export, including
+    compression and the ones declared on the model admin, and `plan` the
+    `FieldPathPlan` of `fields`, when compiled beforehand.
+
+    Exports by users who cannot read the exported model are not cached, so
+    they are denied instead of served the result of another user.
+    """
+    model_class = queryset.model
+    if not report._can_change_or_view(model_class, user):
+        return None
+    report_options = dict(
+        (name, value) for name, value in (options or {}).items()
+        if name in ('aggregate', 'computed', 'labels', 'formats'))
+    columns = [name for name, field in report.get_export_columns(
+        model_class, fields, user, plan=plan, **report_options)]
+    try:
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return None
+    # The queryset restricts the selection too, like `get_queryset` of the
+    # model admin does for some users
+    selection = repr((sql, params)).encode('utf-8')
+    if pks is not None:
+        selection += b'\n' + encode_pks(pks)
+
+    description = json.dumps([
+        _label(model_class),
+        hashlib.sha256(selection).hexdigest(),
+        columns,
+        format,
+        sorted((name, repr(value)) for name, value in (options or {}).items()),
+        translation.get_language(),
+        get_freshness_token(queryset, columns, (options or {}).get('computed')),
+    ], sort_keys=True)
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+
+def get_entry(key):
+    """ Return the stored result under `key`, or None """
+    entry = _get_cache().get(ENTRY_PREFIX + key)
+    if entry is not None:
+        def touch(index):
+            if key in index:
+                index[key]['accessed'] = time.time()
+
+        _update_index(touch)
+    return entry
+
+
+def acquire(key, timeout=None, poll=None):
+    """ Return the stored result under `key`, waiting for a concurrent build
+    of it to be stored for up to `timeout` seconds
+    (`EXPORT_ACTION_RESULT_CACHE_WAIT`), kept short so waiting requests do
+    not hit the timeouts of proxies.
+
+    Returns entry, lock. Without entry, the caller builds the result: `lock`
+    is the token of the lock of `key` when the caller holds it and stores
+    the result, or None when a concurrent build was not stored in time, and
+    the result is built without being stored. Locks expire after
+    `EXPORT_ACTION_RESULT_CACHE_LOCK_TTL` seconds, in case their holder dies.
+    """
+    cache = _get_cache()
+    if timeout is None:
+        timeout = getattr(settings, 'EXPORT_ACTION_RESULT_CACHE_WAIT', 10)
+    poll = poll or getattr(settings, 'EXPORT_ACTION_RESULT_CACHE_POLL', 0.5)
+    lock_ttl = getattr(settings, 'EXPORT_ACTION_RESULT_CACHE_LOCK_TTL', 10 * 60)
+    lock = uuid.uuid4().hex
+    deadline = time.time() + timeout
+    while True:
+        entry = get_entry(key)
+        if entry is not None:
+            return entry, None
+        if cache.add(LOCK_PREFIX + key, lock, lock_ttl):
+            # Stored between the check and the lock
+            entry = get_entry(key)
+            if entry is not None:
+                release(key, lock)
+                return entry, None
+            return None, lock
+        if time.time() > deadline:
+            return None, None
+        time.sleep(poll)
+
+
+def release(key, lock):
+    """ Release the lock of `key`, if it is still held with the token `lock`
+    returned by `acquire`, so the lock of another build is left alone.
+    """
+    cache = _get_cache()
+    if lock is not None and cache.get(LOCK_PREFIX + key) == lock:
+        cache.delete(LOCK_PREFIX + key)
+
+
+def _update_index(update):
+    """ Apply `update` to the index of stored results. Concurrent updates
+    may be lost, leaving files to be removed by a later eviction.
+    """
+    cache = _get_cache()
+    index = cache.get(INDEX_KEY) or {}
+    update(index)
+    cache.set(INDEX_KEY, index, None)
+
+
+def _delete(index, key):
+    entry = index.pop(key)
+    _get_cache().delete(ENTRY_PREFIX + key)
+    export_storage.delete(entry['name'])
+
+
+def _evict(index, max_size=None):
+    """ Remove expired entries and the least recently used ones once their
+    files take more than `max_size` (`EXPORT_ACTION_RESULT_CACHE_MAX_SIZE`)
+    bytes.
+    """
+    cache = _get_cache()
+    if max_size is None:
+        max_size = getattr(settings, 'EXPORT_ACTION_RESULT_CACHE_MAX_SIZE', 1024 * 1024 * 1024)
+    expired = time.time() - _get_ttl()
+    size = 0
+    for key, entry in sorted(index.items(), key=lambda item: -item[1]['accessed']):
+        if entry['created'] < expired or size + entry['size'] > max_size or \
+                cache.get(ENTRY_PREFIX + key) is None:
+            _delete(index, key)
+        else:
+            size += entry['size']
+
+
+def store(key, myfile, content_type, filename, lock=None):
+    """ Save `myfile` as the result under `key`, evicting older results,
+    and release `lock`, the lock of `key` returned by `acquire`.
+    """
+    try:
+        name = export_storage.save(
+            'export_action/results/%s_%s' % (key[:16], filename), File(myfile, name=filename))
+        now = time.time()
+        entry = {
+            'name': name, 'size': export_storage.size(name), 'created': now,
+            'content_type': content_type, 'filename': filename,
+        }
+        _get_cache().set(ENTRY_PREFIX + key, entry, _get_ttl())
+
+        def add(index):
+            index[key] = {'name': name, 'size': entry['size'], 'created': now, 'accessed': now}
+            _evict(index)
+
+        _update_index(add)
+        return entry
+    finally:
+        release(key, lock)
+
+
+def get_response(entry):
+    """ Return a response serving the stored result `entry` """
+    response = FileResponse(
+        export_storage.open(entry['name']), content_type=entry['content_type'])
+    response['Content-Disposition'] = 'attachment; filename=%s' % entry['filename']
+    response['Content-Length'] = entry['size']
+    return response
+
+
+def _get_filename(response):
+    return response['Content-Disposition'].split('filename=', 1)[-1]
+
+
+def iter_stored(key, lock, response, chunks):
+    """ Yield `chunks` of `response`, writing them to a temporary file that
+    is stored under `key` once they are all written. `lock` is released even
+    if the export fails or is interrupted.
+    """
+    try:
+        with TemporaryFile() as myfile:
+            for chunk in chunks:
+                myfile.write(chunk)
+                yield chunk
+            myfile.seek(0)
+            store(key, myfile, response['Content-Type'], _get_filename(response), lock)
+    finally:
+        release(key, lock)
+
+
+class StoredContent(object):
+    """ Chunks of `iter_stored`, also releasing `lock` when the response is
+    closed without reading them, as the generator would not run its cleanup.
+    """
+
+    def __init__(self, key, lock, response, chunks):
+        self.key = key
+        self.lock = lock
+        self.chunks = iter_stored(key, lock, response, chunks)
+
+    def __iter__(self):
+        return self.chunks
+
+    def close(self):
+        self.chunks.close()
+        release(self.key, self.lock)
+
+
+def cache_response(key, lock, response):
+    """ Store the content of `response` under `key` as it is streamed,
+    holding `lock`, the lock of `key` returned by `acquire`.
+    """
+    response.streaming_content = StoredContent(key, lock, response, response.streaming_content)
+    return response
+
+
+def clear():
+    """ Remove every stored result """
+    _update_index(lambda index: _evict(index, max_size=-1))
@@ -0,0 +1,95 @@
+# coding: utf-8
+"""
+Storage for selections too large to be passed in the export url.
+
+Selections are kept in the cache set in `EXPORT_ACTION_CACHE` for
+`EXPORT_ACTION_SELECTION_TTL` seconds, under an opaque token, so they can be
+exported again until they expire. Expiry is the only way they are removed.
+Integer primary keys are stored in order as delta encoded runs, so contiguous
+selections take a few bytes no matter how many objects they have.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+import json
+import uuid
+import zlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import six
+
+
+KEY_PREFIX = 'export_action_selection_'
+
+
+def _get_cache():
+    return caches[getattr(settings, 'EXPORT_ACTION_CACHE', 'default')]
+
+
+def iter_ranges(pks):
+    """ Group integer `pks` into (first, last) runs of consecutive values,
+    ascending or descending, keeping their order.
+    """
+    first = last = step = None
+    for pk in pks:
+        if first is not None and pk - last in (1, -1) and step in (None, pk - last):
+            last, step = pk, pk - last
+            continue
+        if first is not None:
+            yield first, last
+        first = last = pk
+        step = None
+    if first is not None:
+        yield first, last
+
+
+def encode_pks(pks):
+    """ Encode `pks` as compressed bytes, keeping their order.
+
+    Integer pks are stored as runs of `gap:length`, where `gap` is the
+    distance from the end of the previous run and `length` is negative for
+    descending runs. Other pks are stored as json.
+    """
+    pks = list(pks)
+    if all(isinstance(pk, six.integer_types) for pk in pks):
+        previous, parts = 0, []
+        for first, last in iter_ranges(pks):
+            parts.append('%d:%d' % (first - previous, last - first))
+            previous = last
+        value = 'i:' + ','.join(parts)
+    else:
+        value = 's:' + json.dumps([six.text_type(pk) for pk in pks])
+    return zlib.compress(value.encode('ascii'))
+
+
+def decode_pks(data):
+    """ Inverse of `encode_pks` """
+    value = zlib.decompress(data).decode('ascii')
+    kind, value = value[:2], value[2:]
+    if kind == 's:':
+        return json.loads(value)
+    pks, previous = [], 0
+    for part in value.split(',') if value else []:
+        gap, length = part.split(':')
+        first = previous + int(gap)
+        previous = first + int(length)
+        step = -1 if previous < first else 1
+        pks.extend(six.moves.range(first, previous + step, step))
+    return pks
+
+
+def save_selection(pks):
+    """ Store `pks`, returning the token to load them back """
+    token = uuid.uuid4().hex
+    timeout = getattr(settings, 'EXPORT_ACTION_SELECTION_TTL', 60 * 60)
+    _get_cache().set(KEY_PREFIX + token, encode_pks(pks), timeout)
+    return token
+
+
+def load_selection(token):
+    """ Return the pks stored under `token`, or None if it expired """
+    data = _get_cache().get(KEY_PREFIX + token)
+    if data is None:
+        return None
+    return decode_pks(data)
@@ -0,0 +1,10 @@
+# coding: utf-8
+
+from __future__ import unicode_literals, absolute_import
+
+from django.dispatch import Signal
+
+
+# Sent by the model exported once an export is written, with the
+# `export_action.metrics.ExportMetrics` of the export.
+export_finished = Signal(providing_args=['metrics'])
@@ -0,0 +1,52 @@
+# coding: utf-8
+"""
+Storage of exported files.
+
+Exported files are kept in the storage class set in `EXPORT_ACTION_STORAGE`,
+built with the keyword arguments in `EXPORT_ACTION_STORAGE_OPTIONS`, instead
+of the default storage, whose files are usually served to anyone under
+`MEDIA_URL`. By default, files are kept on the file system, in the
+`export_action` directory of the temporary directory, and only served by the
+download view of their job.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+import os
+import tempfile
+import uuid
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.functional import LazyObject, empty
+from django.utils.module_loading import import_string
+
+
+class ExportStorage(LazyObject):
+    """ The storage of exported files, built when first used """
+
+    def _setup(self):
+        storage_class = import_string(getattr(
+            settings, 'EXPORT_ACTION_STORAGE', 'django.core.files.storage.FileSystemStorage'))
+        options = getattr(settings, 'EXPORT_ACTION_STORAGE_OPTIONS', None)
+        if options is None:
+            options = {'location': os.path.join(tempfile.gettempdir(), 'export_action')}
+        self._wrapped = storage_class(**options)
+
+    def deconstruct(self):
+        return ('export_action.storage.ExportStorage', (), {})
+
+
+export_storage = ExportStorage()
+
+
+@receiver(setting_changed)
+def _reset_storage(setting, **kwargs):
+    if setting in ('EXPORT_ACTION_STORAGE', 'EXPORT_ACTION_STORAGE_OPTIONS'):
+        export_storage._wrapped = empty
+
+
+def get_file_name(instance, filename):
+    """ Name exported files in a random directory, so they can't be guessed """
+    return 'export_action/%s/%s' % (uuid.uuid4().hex, filename)
@@ -1,9 +1,15 @@
 from django.conf.urls import url
 from django.contrib.admin.views.decorators import staff_member_required
-from .views import AdminExport
+from .views import AdminExport, ExportJobDetail, ExportJobDownload, ExportPresetRun, FieldTree
 
 view = staff_member_required(AdminExport.as_view())
 
 urlpatterns = [
     url(r'^export/$', view, name="export"),
+    url(r'^fields/$', staff_member_required(FieldTree.as_view()), name="field_tree"),
+    url(r'^jobs/(?P<pk>\d+)/$', staff_member_required(ExportJobDetail.as_view()), name="job"),
+    url(r'^jobs/(?P<pk>\d+)/download/$', staff_member_required(ExportJobDownload.as_view()),
+        name="job_download"),
+    url(r'^presets/(?P<pk>\d+)/$', staff_member_required(ExportPresetRun.as_view()),
+        name="preset"),
 ]
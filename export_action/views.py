@@ -2,13 +2,65 @@
 
 from __future__ import unicode_literals, absolute_import
 
-from django.contrib import admin
+from copy import copy
+import hashlib
+import json
+
+import django
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.utils import label_for_field
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import PAGE_VAR
 from django.contrib.contenttypes.models import ContentType
-from django.views.generic import TemplateView
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.http import (
+    FileResponse, Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified,
+    HttpResponseRedirect, QueryDict)
+from django.shortcuts import get_object_or_404
+from django.utils.translation import ugettext_lazy as _
+from django.views.generic import DetailView, TemplateView, View
+
+if django.VERSION >= (1, 11):
+    from django.utils.cache import get_conditional_response
+else:  # Missing before Django 1.9, and taking unquoted ETags before 1.11
+    def get_conditional_response(request, etag=None, response=None):
+        """ `If-None-Match` part of `get_conditional_response` of Django>=1.11,
+        for the strong ETags of `FieldTree`.
+        """
+        if_none_match = [
+            tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]
+        if request.method in ('GET', 'HEAD') and etag and (
+                etag in if_none_match or '*' in if_none_match):
+            not_modified = HttpResponseNotModified()
+            for header in ('ETag', 'Cache-Control'):
+                if header in response:
+                    not_modified[header] = response[header]
+            return not_modified
+        return response
 
 
+from . import columnar
+from . import compression
 from . import introspection
+from .admin import get_export_options
+from .metrics import ExportMetrics
+from . import jobs
 from . import report
+from . import results
+from .models import ExportJob, ExportPreset
+from .selection import load_selection
+
+
+def get_computed_fields(model_admin):
+    """ Return name and label of the properties and methods declared in
+    `export_computed_fields` of `model_admin`.
+    """
+    return [
+        (name, label_for_field(name, model_admin.model, model_admin))
+        for name in getattr(model_admin, 'export_computed_fields', {})
+    ]
 
 
 class AdminExport(TemplateView):
@@ -16,53 +68,257 @@ class AdminExport(TemplateView):
     """ Get fields from a particular model """
     template_name = 'export_action/export.html'
 
-    def get_queryset(self, model_class):
-        if self.request.GET.get("session_key"):
-            ids = self.request.session[self.request.GET["session_key"]]
-        else:
-            ids = self.request.GET['ids'].split(',')
+    def get_model_admin(self, model_class):
         try:
-            model_admin = admin.site._registry[model_class]
+            return admin.site._registry[model_class]
         except KeyError:
             raise ValueError("Model %r not registered with admin" % model_class)
-        queryset = model_admin.get_queryset(self.request).filter(pk__in=ids)
+
+    def get_selected_pks(self):
+        """ Return the pks of the selected objects, or None when all objects
+        of the changelist were selected.
+        """
+        if not hasattr(self, '_selected_pks'):
+            if self.request.GET.get("select_across"):
+                ids = None
+            elif self.request.GET.get("selection"):
+                ids = load_selection(self.request.GET["selection"])
+                if ids is None:
+                    raise Http404(_("The selection to export has expired."))
+            else:
+                pk_field = self.get_model_class()._meta.pk
+                try:
+                    ids = [pk_field.to_python(pk) for pk in self.request.GET['ids'].split(',')]
+                except ValidationError:
+                    raise Http404(_("The selection to export is not valid."))
+            self._selected_pks = ids
+        return self._selected_pks
+
+    def get_export_queryset(self, model_class):
+        """ Same as `get_queryset`, but the selected pks are returned apart,
+        so they can be queried in chunks.
+
+        Returns queryset, list of pks or None.
+        """
+        if not hasattr(self, '_export_queryset'):
+            model_admin = self.get_model_admin(model_class)
+            pks = self.get_selected_pks()
+            if pks is None:
+                self._export_queryset = self.get_changelist_queryset(model_admin), None
+            else:
+                self._export_queryset = model_admin.get_queryset(self.request), pks
+        return self._export_queryset
+
+    def get_queryset(self, model_class):
+        queryset, pks = self.get_export_queryset(model_class)
+        if pks is not None:
+            queryset = queryset.filter(pk__in=pks)
         return queryset
 
+    def get_changelist_filters(self):
+        """ Query string of the changelist whose objects are exported """
+        return self.request.GET.get('_changelist_filters', '')
+
+    def get_changelist_queryset(self, model_admin):
+        """ Rebuild the queryset of the admin changelist, with the filters,
+        search and ordering found in `_changelist_filters`. Its results are
+        not counted or fetched, only the queryset is needed.
+        """
+        request = copy(self.request)
+        request.GET = QueryDict(self.get_changelist_filters(), mutable=True)
+        request.GET.pop(PAGE_VAR, None)
+        if hasattr(model_admin, 'get_changelist_instance'):  # Django>=2.0
+            return model_admin.get_changelist_instance(request).queryset
+
+        list_display = model_admin.get_list_display(request)
+        if model_admin.get_actions(request):
+            list_display = ['action_checkbox'] + list(list_display)
+        if hasattr(model_admin, 'get_list_select_related'):  # Django>=1.9
+            list_select_related = model_admin.get_list_select_related(request)
+        else:
+            list_select_related = model_admin.list_select_related
+
+        class ChangeList(model_admin.get_changelist(request)):
+
+            def get_results(self, request):
+                pass
+
+        changelist = ChangeList(
+            request, model_admin.model, list_display,
+            model_admin.get_list_display_links(request, list_display),
+            model_admin.get_list_filter(request),
+            model_admin.date_hierarchy,
+            model_admin.get_search_fields(request),
+            list_select_related,
+            model_admin.list_per_page,
+            model_admin.list_max_show_all,
+            model_admin.list_editable,
+            model_admin,
+        )
+        return changelist.queryset
+
     def get_model_class(self):
         model_class = ContentType.objects.get(id=self.request.GET['ct']).model_class()
         return model_class
 
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super(AdminExport, self).dispatch(request, *args, **kwargs)
+        except IncorrectLookupParameters:
+            return HttpResponseBadRequest(_("The filters of the changelist are not valid."))
+
     def get_context_data(self, **kwargs):
         context = super(AdminExport, self).get_context_data(**kwargs)
         field_name = self.request.GET.get('field', '')
         model_class = self.get_model_class()
-        queryset = self.get_queryset(model_class)
+        export_queryset, pks = self.get_export_queryset(model_class)
         path = self.request.GET.get('path', '')
         context['opts'] = model_class._meta
-        context['queryset'] = queryset
+        context['queryset'] = self.get_queryset(model_class)
+        context['export_queryset'] = export_queryset
+        context['pks'] = pks
+        if pks is None:
+            context['object_count'] = export_queryset.count()
+            context['preview'] = export_queryset[:10]
+        else:
+            context['object_count'] = len(pks)
+            context['preview'] = export_queryset.filter(pk__in=pks[:10])
         context['model_ct'] = self.request.GET['ct']
         context['related_fields'] = introspection.get_relation_fields_from_model(model_class)
+        context['computed_fields'] = self.get_computed_fields(model_class)
+        context['columnar_formats'] = columnar.is_available()
+        context['presets'] = get_presets_for_user(self.request.user).filter(
+            content_type_id=self.request.GET['ct'])
         context.update(introspection.get_fields(model_class, field_name, path))
         return context
 
+    def get_computed_fields(self, model_class):
+        return get_computed_fields(self.get_model_admin(model_class))
+
     def post(self, request, **kwargs):
-        context = self.get_context_data(**kwargs)
+        # Only the exported objects are needed, not the page
+        export_queryset, pks = self.get_export_queryset(self.get_model_class())
         fields = []
         for field_name, value in request.POST.items():
             if value == "on":
                 fields.append(field_name)
-        data_list, message = report.report_to_list(
-            context['queryset'],
-            fields,
-            self.request.user,
-        )
         format = request.POST.get("__format")
+        method = request.POST.get("__compression")
+        if method not in compression.COMPRESSIONS:
+            method = None
+        options = {
+            'aggregate': bool(request.POST.get("__aggregate")),
+            'labels': bool(request.POST.get("__labels")),
+        }
+        normalize = format == "xlsx" and bool(request.POST.get("__normalize"))
+        background = bool(request.POST.get("__background"))
+        if request.POST.get("__preset"):
+            preset = ExportPreset(
+                name=request.POST["__preset"], content_type_id=self.request.GET['ct'],
+                user=self.request.user, format=format,
+                filters=self.request.GET.get('_changelist_filters', ''))
+            preset.set_selection(pks)
+            preset.set_fields(fields)
+            preset.set_options(dict(
+                options, compression=method, normalize=normalize, background=background))
+            preset.compile()
+            preset.save()
+        return self.export(
+            export_queryset, pks, fields, format, options,
+            method=method, normalize=normalize, background=background)
+
+    def export(self, queryset, pks, fields, format, options, method=None, normalize=False,
+               background=False, plan=None):
+        """ Export `fields` of `queryset`, or of its objects in `pks`, in
+        `format`, compressed with `method`. `plan` is the `FieldPathPlan` of
+        the field paths of `fields`, when compiled beforehand. Returns the
+        response streaming the export, or redirecting to its job when run in
+        `background`.
+        """
+        if format in columnar.FORMATS and not columnar.is_available():
+            return HttpResponseBadRequest(
+                _("Parquet and Arrow exports need pyarrow, which is not installed."))
+        if background:
+            job = jobs.start_job(
+                queryset, fields, format, self.request.user, pks=pks, options=options,
+                compression=method, normalize=normalize)
+            return HttpResponseRedirect(job.get_absolute_url())
+        model_class = queryset.model
+        options = dict(options)
+        options.update(get_export_options(self.get_model_admin(model_class)))
+        key = lock = None
+        if results.is_enabled():
+            key = results.get_key(
+                queryset, fields, format, self.request.user, pks=pks,
+                options=dict(options, compression=method, normalize=normalize), plan=plan)
+        if key:
+            entry, lock = results.acquire(key)
+            if entry is not None:
+                return results.get_response(entry)
+        try:
+            response, export_metrics = self.build_export_response(
+                queryset, pks, fields, format, method, normalize, options, plan)
+        except Exception:
+            if lock:
+                results.release(key, lock)
+            raise
+        if lock:
+            response = results.cache_response(key, lock, response)
+        response.streaming_content = export_metrics.iter_chunks(response.streaming_content)
+        return response
+
+    def build_export_response(self, queryset, pks, fields, format, method, normalize, options,
+                              plan=None):
+        """ Return a streaming response of the export, and the metrics
+        measuring it.
+        """
+        model_class = queryset.model
+        export_metrics = ExportMetrics(model_class, format, self.request.user)
+        with export_metrics.measure():
+            if normalize:
+                options.pop('aggregate')
+                sheets, message = report.report_to_sheets(
+                    queryset, fields, self.request.user, pks=pks, plan=plan, **options)
+                self.warn(message)
+                sheets = [
+                    (title, header, export_metrics.iter_rows(rows))
+                    for title, header, rows in sheets
+                ]
+                response = report.stream_to_xlsx_sheets_response(sheets)
+            else:
+                response = self.get_export_response(
+                    queryset, fields, format, pks, options, export_metrics, plan)
+            if method:
+                filename = report.generate_filename('report', report.get_format_extension(format))
+                response = report.compress_response(response, method, filename)
+        return response, export_metrics
+
+    def get_export_response(self, queryset, fields, format, pks, options, export_metrics,
+                            plan=None):
+        """ Return a streaming response of `fields` of `queryset` in `format` """
+        rows, message = report.report_to_iterator(
+            queryset, fields, self.request.user, pks=pks, plan=plan, **options)
+        rows = export_metrics.iter_rows(rows)
+        self.warn(message)
+        columns = report.get_export_columns(
+            queryset.model, fields, self.request.user, plan=plan, **options)
+        # Columns the user cannot read, or unknown, are left out of the rows
+        header = [name for name, field in columns]
         if format == "html":
-            return report.list_to_html_response(data_list, header=fields)
+            return report.stream_to_html_response(rows, header=header, columns=columns)
         elif format == "csv":
-            return report.list_to_csv_response(data_list, header=fields)
+            return report.stream_to_csv_response(rows, header=header, columns=columns)
+        elif format == "ndjson":
+            return report.stream_to_ndjson_response(rows, columns)
+        elif format in report.TYPED_FORMATS:
+            return report.stream_to_columnar_response(rows, format, columns)
         else:
-            return report.list_to_xlsx_response(data_list, header=fields)
+            return report.stream_to_xlsx_response(rows, header=header, columns=columns)
+
+    def warn(self, message):
+        """ Show the `message` of an export, about columns left out of it """
+        if message:
+            messages.warning(self.request, message, fail_silently=True)
 
     def get(self, request, *args, **kwargs):
         if request.GET.get("related", request.POST.get("related")):  # Dispatch to the other view
@@ -70,6 +326,82 @@ class AdminExport(TemplateView):
         return super(AdminExport, self).get(request, *args, **kwargs)
 
 
+class FieldTree(View):
+    """ Fields and relations of a registered model, as json, for the field
+    tree of the export page.
+
+    `ct` is the content type of the exported model, `path` an optional
+    relation path like `reporter__`, and `depth` the number of levels of
+    relations to expand, up to `EXPORT_ACTION_FIELD_TREE_MAX_DEPTH`. The
+    tree only changes with the code, so responses have a strong ETag and
+    are cached as set in `EXPORT_ACTION_FIELD_TREE_CACHE_CONTROL`.
+    """
+
+    def get(self, request):
+        try:
+            model_class = ContentType.objects.get_for_id(int(request.GET['ct'])).model_class()
+            model_admin = admin.site._registry[model_class]
+        except (KeyError, ValueError, ContentType.DoesNotExist):
+            raise Http404("Unknown model")
+        try:
+            depth = int(request.GET.get('depth', 1))
+        except ValueError:
+            depth = 1
+        depth = max(1, min(depth, getattr(settings, 'EXPORT_ACTION_FIELD_TREE_MAX_DEPTH', 3)))
+        try:
+            tree = introspection.get_field_tree(
+                model_class, request.GET.get('path', ''), depth,
+                computed_fields=get_computed_fields(model_admin))
+        except LookupError:
+            raise Http404("Unknown relation")
+
+        content = json.dumps(tree, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        etag = '"%s"' % hashlib.sha1(content).hexdigest()
+        response = HttpResponse(content, content_type='application/json')
+        response['ETag'] = etag
+        response['Cache-Control'] = getattr(
+            settings, 'EXPORT_ACTION_FIELD_TREE_CACHE_CONTROL', 'private, max-age=3600')
+        return get_conditional_response(request, etag=etag, response=response)
+
+
+def get_presets_for_user(user):
+    """ Presets of `user`, and the ones shared with every user """
+    return ExportPreset.objects.filter(Q(user=user) | Q(user__isnull=True))
+
+
+class ExportPresetRun(AdminExport):
+    """ Export the objects selected when a preset was saved, or the ones of
+    its changelist, with its compiled fields and options. Runs are posted,
+    as they may start a background job.
+    """
+    http_method_names = ['post']
+
+    def get_preset(self):
+        if not hasattr(self, '_preset'):
+            self._preset = get_object_or_404(
+                get_presets_for_user(self.request.user), pk=self.kwargs['pk'])
+        return self._preset
+
+    def get_model_class(self):
+        return self.get_preset().content_type.model_class()
+
+    def get_selected_pks(self):
+        return self.get_preset().get_selection()
+
+    def get_changelist_filters(self):
+        return self.get_preset().filters
+
+    def post(self, request, **kwargs):
+        preset = self.get_preset()
+        queryset, pks = self.get_export_queryset(self.get_model_class())
+        options = preset.get_options()
+        return self.export(
+            queryset, pks, preset.get_plan()['fields'], preset.format,
+            {'aggregate': options.get('aggregate', False), 'labels': options.get('labels', False)},
+            method=options.get('compression'), normalize=options.get('normalize', False),
+            background=options.get('background', False), plan=preset.get_field_plan())
+
+
 class AdminExportRelated(TemplateView):
     template_name = 'export_action/fields.html'
 
@@ -87,3 +419,35 @@ class AdminExportRelated(TemplateView):
         context['table'] = True
         context.update(field_data)
         return self.render_to_response(context)
+
+
+def get_jobs_for_user(user):
+    if user.is_superuser:
+        return ExportJob.objects.all()
+    return ExportJob.objects.filter(user=user)
+
+
+class ExportJobDetail(DetailView):
+    """ Status of a background export, with a link to download when done """
+    template_name = 'export_action/job.html'
+    context_object_name = 'job'
+
+    def get_queryset(self):
+        return get_jobs_for_user(self.request.user)
+
+    def get_context_data(self, **kwargs):
+        context = super(ExportJobDetail, self).get_context_data(**kwargs)
+        context['opts'] = self.object.content_type.model_class()._meta
+        return context
+
+
+class ExportJobDownload(View):
+
+    def get(self, request, pk):
+        job = get_object_or_404(get_jobs_for_user(request.user), pk=pk)
+        if job.status != ExportJob.DONE or not job.file:
+            raise Http404("Export is not finished")
+        job.file.open('rb')
+        response = FileResponse(job.file)
+        response['Content-Disposition'] = 'attachment; filename=%s' % job.file.name.split('/')[-1]
+        return response
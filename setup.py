@@ -43,6 +43,7 @@ setup(
     ],
     include_package_data=True,
     install_requires=['openpyxl'],
+    extras_require={'arrow': ['pyarrow']},
     license="MIT",
     zip_safe=False,
     keywords='django-export-action',
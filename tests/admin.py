@@ -8,7 +8,8 @@ from .models import Publication, Reporter, Article, Tag
 
 @admin.register(Publication)
 class PublicationAdmin(admin.ModelAdmin):
-    pass
+    list_display = ('id', 'title')
+    search_fields = ('title',)
 
 
 @admin.register(Reporter)
@@ -18,7 +19,9 @@ class ReporterAdmin(admin.ModelAdmin):
 
 @admin.register(Article)
 class ArticleAdmin(admin.ModelAdmin):
-    pass
+    export_computed_fields = {
+        'contact': ['reporter__email'],
+    }
 
 
 @admin.register(Tag)
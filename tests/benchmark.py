@@ -0,0 +1,240 @@
+# -- encoding: UTF-8 --
+"""
+Benchmarks of the export pipeline on synthetic data of the tests models.
+
+Run from the repository root::
+
+    python -m tests.benchmark --rows 10000
+    python -m tests.benchmark --rows 100000 --save
+    python -m tests.benchmark --rows 100000 --compare
+
+Every format is exported for every column mix, measuring wall time, query
+count, peak memory allocated by Python (tracemalloc) and peak RSS of the
+process. `--save` records the results as baselines in `--baseline`, keyed by
+number of rows and fan out, and `--compare` exits with an error when a case
+is slower or uses more memory than its baseline beyond `--tolerance`, or runs
+more queries.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+
+COLUMN_MIXES = {
+    'direct': ['id', 'headline', 'status'],
+    'foreign_key': ['id', 'headline', 'reporter__first_name', 'reporter__email'],
+    'to_many': ['id', 'headline', 'publications__title', 'articletag__tag__name'],
+}
+
+STREAM_FORMATS = ['csv', 'html', 'xlsx', 'ndjson', 'parquet', 'arrow']
+LIST_FORMATS = ['csv', 'html', 'xlsx']
+
+
+def _bulk_create(model, objects, batch_size=10000):
+    for i in range(0, len(objects), batch_size):
+        model.objects.bulk_create(objects[i:i + batch_size])
+
+
+def generate_data(rows, fan_out):
+    """ Create `rows` articles, each one in `fan_out` publications and with
+    `fan_out` tags.
+    """
+    from .models import Article, ArticleTag, Publication, Reporter, Tag
+
+    _bulk_create(Reporter, [
+        Reporter(first_name='first %d' % i, last_name='last %d' % i,
+                 email='reporter%d@example.com' % i)
+        for i in range(max(rows // 100, 1))
+    ])
+    _bulk_create(Publication, [Publication(title='publication %d' % i) for i in range(50)])
+    _bulk_create(Tag, [Tag(name='tag %d' % i) for i in range(20)])
+    reporter_ids = list(Reporter.objects.values_list('pk', flat=True))
+    publication_ids = list(Publication.objects.values_list('pk', flat=True))
+    tag_ids = list(Tag.objects.values_list('pk', flat=True))
+
+    _bulk_create(Article, [
+        Article(headline='headline %d' % i, status=i % 3 + 1,
+                reporter_id=reporter_ids[i % len(reporter_ids)])
+        for i in range(rows)
+    ])
+    article_ids = list(Article.objects.values_list('pk', flat=True))
+    Through = Article.publications.through
+    _bulk_create(Through, [
+        Through(article_id=article_id,
+                publication_id=publication_ids[(i + j) % len(publication_ids)])
+        for i, article_id in enumerate(article_ids) for j in range(fan_out)
+    ])
+    _bulk_create(ArticleTag, [
+        ArticleTag(article_id=article_id, tag_id=tag_ids[(i + j) % len(tag_ids)])
+        for i, article_id in enumerate(article_ids) for j in range(fan_out)
+    ])
+
+
+def _consume(chunks):
+    """ Read an iterable of chunks of bytes, returning its size """
+    return sum(len(chunk) for chunk in chunks)
+
+
+def export_stream(queryset, fields, format, user):
+    """ Export as the export view does """
+    from export_action import report
+
+    rows, message = report.report_to_iterator(queryset, fields, user)
+    columns = report.get_export_columns(queryset.model, fields, user)
+    return _consume(report.iter_format(rows, format, header=fields, columns=columns))
+
+
+def export_list(queryset, fields, format, user):
+    """ Export through the list api, building the whole file in memory """
+    from export_action import report
+
+    rows, message = report.report_to_list(queryset, fields, user)
+    response = getattr(report, 'list_to_%s_response' % format)(rows, header=fields)
+    return len(response.content)
+
+
+def measure(export, trace_memory):
+    """ Run `export`, returning its metrics """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    with CaptureQueriesContext(connection) as queries:
+        start = time.time()
+        size = export()
+        elapsed = time.time() - start
+    metrics = {'seconds': round(elapsed, 3), 'queries': len(queries), 'bytes': size}
+    if trace_memory:
+        metrics['peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    if resource is not None:
+        metrics['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return metrics
+
+
+def get_cases(pipelines):
+    from export_action import columnar
+
+    for pipeline in pipelines:
+        formats = STREAM_FORMATS if pipeline == 'stream' else LIST_FORMATS
+        export = export_stream if pipeline == 'stream' else export_list
+        for format in formats:
+            if format in columnar.FORMATS and not columnar.is_available():
+                continue
+            for mix in sorted(COLUMN_MIXES):
+                yield '%s-%s-%s' % (pipeline, format, mix), export, format, COLUMN_MIXES[mix]
+
+
+def run(options):
+    from django.contrib.auth import get_user_model
+    from .models import Article
+
+    user = get_user_model().objects.create_superuser('benchmark', 'benchmark@example.com', 'pw')
+    queryset = Article.objects.order_by('pk')
+    # Exported before each case, so imports and caches are not measured
+    warm_up = queryset.filter(pk__in=list(queryset.values_list('pk', flat=True)[:10]))
+    results = {}
+    for name, export, format, fields in get_cases(options.pipelines):
+        if options.only and options.only not in name:
+            continue
+        export(warm_up, fields, format, user)
+        runs = [
+            measure(lambda: export(queryset, fields, format, user), trace_memory=False)
+            for _ in range(options.repeat)
+        ]
+        metrics = min(runs, key=lambda metrics: metrics['seconds'])
+        if tracemalloc is not None and not options.no_memory:
+            traced = measure(lambda: export(queryset, fields, format, user), trace_memory=True)
+            metrics['peak_kb'] = traced['peak_kb']
+            metrics['max_rss_kb'] = traced.get('max_rss_kb')
+        results[name] = metrics
+        print('{:<32} {seconds:>8.3f}s {queries:>6} queries {bytes:>12} bytes'
+              ' {peak:>10} KB peak'.format(name, peak=metrics.get('peak_kb', '-'), **metrics))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Return descriptions of the cases of `results` that regressed """
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        expected = baseline.get(name)
+        if not expected:
+            continue
+        for key in ('seconds', 'peak_kb'):
+            if key in metrics and key in expected and \
+                    metrics[key] > expected[key] * (1 + tolerance):
+                regressions.append('%s: %s %s > %s' % (name, key, metrics[key], expected[key]))
+        if metrics['queries'] > expected['queries']:
+            regressions.append('%s: queries %s > %s' % (
+                name, metrics['queries'], expected['queries']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000, help="Number of articles")
+    parser.add_argument('--fan-out', type=int, default=3,
+                        help="Publications and tags of each article")
+    parser.add_argument('--pipelines', type=lambda value: value.split(','), default=['stream'],
+                        help="Comma separated list of 'stream' and 'list'")
+    parser.add_argument('--only', help="Only run cases whose name contains this")
+    parser.add_argument('--repeat', type=int, default=1, help="Runs of each case, best is kept")
+    parser.add_argument('--no-memory', action='store_true', help="Do not trace memory")
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true', help="Save results as baseline")
+    parser.add_argument('--compare', action='store_true', help="Compare results to baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Allowed increase of time and memory over the baseline")
+    options = parser.parse_args(argv)
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+    import django
+    from django.core.management import call_command
+    django.setup()
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+    start = time.time()
+    generate_data(options.rows, options.fan_out)
+    print('Generated {} articles in {:.1f}s'.format(options.rows, time.time() - start))
+    results = run(options)
+
+    baselines = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+    key = 'rows=%d,fan_out=%d' % (options.rows, options.fan_out)
+
+    if options.compare:
+        regressions = compare(results, baselines.get(key, {}), options.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            return 1
+    if options.save:
+        baselines.setdefault(key, {}).update(results)
+        with open(options.baseline, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
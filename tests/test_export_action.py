@@ -1,17 +1,75 @@
 # -- encoding: UTF-8 --
 
+from collections import OrderedDict
+from decimal import Decimal
+import datetime
+import gzip
+import json
+import os
+import socket
+import threading
+import zipfile
+
+from django.contrib import admin
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command, CommandError
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.db.models import TextField
+from django.http import StreamingHttpResponse
+from django.utils import six, timezone
 from django.utils.http import urlencode
+from django.utils.six import BytesIO
 
 import pytest
 from mixer.backend.django import mixer
+from openpyxl import load_workbook
 
-from export_action import report
+from export_action import (
+    aggregates, columnar, expressions, introspection, jobs, metrics, parallel, report, results,
+    selection)
+from export_action.admin import export_selected_objects
+from export_action.converters import convert_rows, get_converters
+from export_action.jobs import iter_export
+from export_action.models import ExportJob, ExportPreset
+from export_action.signals import export_finished
 
 from .models import Publication, Reporter, Article, ArticleTag, Tag
 
 
+class CountingBackend(ModelBackend):
+    calls = []
+
+    def get_all_permissions(self, user_obj, obj=None):
+        self.calls.append('get_all_permissions')
+        return super(CountingBackend, self).get_all_permissions(user_obj, obj)
+
+    def has_perm(self, user_obj, perm, obj=None):
+        self.calls.append(perm)
+        return super(CountingBackend, self).has_perm(user_obj, perm, obj)
+
+
+class HasPermOnlyBackend(object):
+    calls = []
+
+    def authenticate(self, **credentials):
+        return None
+
+    def has_perm(self, user_obj, perm, obj=None):
+        self.calls.append(perm)
+        return perm == 'tests.change_article'
+
+
+def get_content(response):
+    if response.streaming:
+        return b''.join(response.streaming_content)
+    return response.content
+
+
 @pytest.mark.django_db
 @pytest.mark.parametrize('output_name', ['html', 'csv'])
 def test_AdminExport_list_to_method_response_should_return_200(admin_user, output_name):
@@ -23,6 +81,111 @@ def test_AdminExport_list_to_method_response_should_return_200(admin_user, outpu
     assert res.status_code == 200
 
 
+@pytest.mark.django_db
+def test_stream_to_csv_response_should_stream_all_rows(admin_user, settings):
+    settings.EXPORT_ACTION_STREAM_BUFFER_SIZE = 16
+    mixer.cycle(5).blend(Publication, title=mixer.sequence('title {0}'))
+    rows, message = report.report_to_iterator(
+        Publication.objects.order_by('pk'), ['id', 'title'], admin_user, chunk_size=2)
+
+    response = report.stream_to_csv_response(rows, header=['id', 'title'])
+
+    assert response.streaming
+    assert 'attachment; filename=report_' in response['Content-Disposition']
+    chunks = list(response.streaming_content)
+    assert len(chunks) > 1
+    lines = b''.join(chunks).decode('utf-8').splitlines()
+    assert lines[0] == 'id,title'
+    assert lines[1:] == [
+        '{},{}'.format(pk, title)
+        for pk, title in Publication.objects.order_by('pk').values_list('pk', 'title')
+    ]
+
+
+@pytest.mark.django_db
+def test_stream_to_xlsx_response_should_write_all_rows(admin_user, settings):
+    settings.EXPORT_ACTION_SPOOL_MAX_SIZE = 1
+    settings.EXPORT_ACTION_STREAM_BUFFER_SIZE = 512
+    mixer.cycle(5).blend(Publication, title=mixer.sequence('title {0}'))
+    rows, message = report.report_to_iterator(
+        Publication.objects.order_by('pk'), ['id', 'title'], admin_user)
+
+    response = report.stream_to_xlsx_response(rows, header=['id', 'title'])
+
+    assert response.streaming
+    assert response['Content-Disposition'].endswith('.xlsx')
+    content = get_content(response)
+    assert len(content) == int(response['Content-Length'])
+    ws = load_workbook(BytesIO(content)).active
+    assert [[cell.value for cell in row] for row in ws.rows] == [['id', 'title']] + [
+        list(row) for row in Publication.objects.order_by('pk').values_list('pk', 'title')
+    ]
+    assert ws['A1'].font.bold
+
+
+@pytest.mark.django_db
+def test_stream_to_html_response_should_escape_cells_like_template(admin_user):
+    mixer.blend(Publication, title='<b>first\nsecond</b>')
+    mixer.blend(Publication, title='plain')
+    queryset = Publication.objects.order_by('pk')
+
+    response = report.stream_to_html_response(
+        report.report_to_iterator(queryset, ['title', 'id'], admin_user)[0],
+        header=['title', 'id'])
+    rendered = report.list_to_html_response(
+        report.report_to_list(queryset, ['title', 'id'], admin_user)[0],
+        header=['title', 'id'])
+
+    assert response.streaming
+    content = get_content(response).decode('utf-8')
+    assert '<td>&lt;b&gt;first<br />second&lt;/b&gt;</td>' in content
+    assert content.split() == rendered.content.decode('utf-8').split()
+
+    columns = report.get_export_columns(Publication, ['title', 'id'], admin_user)
+    response = report.stream_to_html_response(
+        report.report_to_iterator(queryset, ['title', 'id'], admin_user)[0],
+        header=['title', 'id'], columns=columns)
+    assert get_content(response).decode('utf-8') == content
+
+
+def test_get_converters_should_skip_columns_written_as_they_are(settings):
+    settings.USE_TZ = True
+    columns = [
+        ('id', Article._meta.pk), ('headline', Article._meta.get_field('headline')),
+        ('articletag__created_on', ArticleTag._meta.get_field('created_on')),
+        ('reporter', Article._meta.get_field('reporter')), ('contact', None),
+    ]
+
+    converters, null = get_converters(columns, 'xlsx')
+    assert null is None
+    assert [convert is None for convert in converters] == [True, True, False, True, False]
+    created_on = timezone.make_aware(datetime.datetime(2020, 1, 2, 10), timezone.utc)
+    rows = [(1, 'a', created_on, 2, b'bytes'), (2, None, None, None, None)]
+    assert list(convert_rows(rows, converters, null, batch_size=1)) == [
+        (1, 'a', timezone.make_naive(created_on), 2, 'bytes'), (2, None, None, None, None)]
+
+    converters, null = get_converters(columns, 'csv')
+    assert [convert is None for convert in converters] == [True, True, True, True, False]
+    assert list(convert_rows(rows[1:], converters, null)) == [
+        (2, 'None', 'None', 'None', 'None')]
+
+
+@pytest.mark.django_db
+def test_stream_to_xlsx_response_should_write_aware_datetimes(admin_user, settings):
+    settings.USE_TZ = True
+    article = mixer.blend(Article)
+    article_tag = mixer.blend(ArticleTag, article=article)
+    fields = ['id', 'articletag__created_on']
+    columns = report.get_export_columns(Article, fields, admin_user)
+    rows, message = report.report_to_iterator(Article.objects.all(), fields, admin_user)
+
+    response = report.stream_to_xlsx_response(rows, header=fields, columns=columns)
+
+    ws = load_workbook(BytesIO(get_content(response))).active
+    created_on = timezone.make_naive(article_tag.created_on)
+    assert abs(ws.cell(row=2, column=2).value - created_on) < datetime.timedelta(seconds=1)
+
+
 @pytest.mark.django_db
 @pytest.mark.parametrize('output_format', ['html', 'csv', 'xls'])
 def test_AdminExport_post_should_return_200(admin_client, output_format):
@@ -137,11 +300,569 @@ def test_admin_action_should_redirect_to_export_view_without_ids_for_large_queri
     response = admin_client.post(url, data=data)
 
     assert response.status_code == 302
-    assert 'session_key' in response.url
+    assert 'select_across=1' in response.url
+    assert 'ids=' not in response.url
+    assert 'session_key' not in response.url
+
+    response = admin_client.post(response.url, data={'id': 'on', '__format': 'csv'})
+    lines = get_content(response).decode('utf-8').splitlines()
+    assert sorted(int(pk) for pk in lines[1:]) == [obj.pk for obj in objects]
+
+
+@pytest.mark.django_db
+def test_admin_action_select_across_should_keep_changelist_filters(admin_client):
+    mixer.blend(Publication, title='django b')
+    mixer.cycle(3).blend(Publication, title=mixer.sequence('python {0}'))
+    mixer.blend(Publication, title='django c')
+    mixer.blend(Publication, title='django a')
+
+    data = {
+        "action": "export_selected_objects",
+        "_selected_action": [Publication.objects.first().pk],
+        "select_across": '1',
+    }
+    url = "{}?{}".format(
+        reverse('admin:tests_publication_changelist'), urlencode({'q': 'django', 'o': '-2'}))
+    response = admin_client.post(url, data=data)
+
+    assert response.status_code == 302
+    response = admin_client.post(response.url, data={'title': 'on', '__format': 'csv'})
+    lines = get_content(response).decode('utf-8').splitlines()
+    assert lines == ['title', 'django c', 'django b', 'django a']
+
+
+@pytest.mark.django_db
+def test_admin_action_should_store_large_selections_out_of_the_session(admin_client, rf):
+    objects = mixer.cycle(1001).blend(Publication)
+    request = rf.post(reverse('admin:tests_publication_changelist'))
+
+    response = export_selected_objects(None, request, Publication.objects.all())
+
+    assert response.status_code == 302
+    assert 'selection=' in response.url
+    token = response.url[response.url.index('selection=') + len('selection='):]
+    assert selection.load_selection(token) == [obj.pk for obj in objects]
+    assert not any(key.startswith('export_action') for key in admin_client.session.keys())
+
+    url = response.url
+    response = admin_client.post(url, data={'id': 'on', '__format': 'csv'})
+    assert len(get_content(response).splitlines()) == 1002
+
+    # Kept until it expires, to export it again in another format
+    assert admin_client.get(url).status_code == 200
+    response = admin_client.post(url, data={'id': 'on', '__format': 'ndjson'})
+    assert len(get_content(response).splitlines()) == 1001
+    cache.delete(selection.KEY_PREFIX + token)
+    assert admin_client.get(url).status_code == 404
+
+
+@pytest.mark.parametrize('pks', [
+    [],
+    [7],
+    list(range(1, 5001)),
+    [1, 2, 3, 10, 12, 13, 14, 100, 3, 2],
+    [5, 4, 3, 4, 5, 5, -2, 0, 1],
+    list(range(5000, 0, -1)),
+    ['0c1e5a3a-3d8c-4ab5-9d1a-6d9ef6f4b0a1', 'a'],
+])
+def test_encode_pks_should_round_trip_in_selection_order(pks):
+    assert selection.decode_pks(selection.encode_pks(pks)) == pks
+
+
+@pytest.mark.parametrize('pks', [range(1, 1000001), range(1000000, 0, -1)])
+def test_encode_pks_should_be_compact_for_contiguous_ranges(pks):
+    assert len(selection.encode_pks(pks)) < 32
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('ordering', ['pk', '-pk', 'id'])
+def test_report_to_iterator_should_paginate_on_pk_without_splitting_objects(
+        admin_user, django_assert_num_queries, ordering):
+    publications = mixer.cycle(3).blend(Publication)
+    mixer.cycle(5).blend(Article, publications=publications)
+    queryset = Article.objects.order_by(ordering)
+    expected = list(queryset.values_list('headline', 'publications__title'))
+
+    rows, message = report.report_to_iterator(
+        queryset, ['headline', 'publications__title'], admin_user, chunk_size=2)
+
+    # two queries per chunk of two articles, the last one unbounded
+    with django_assert_num_queries(6):
+        assert list(rows) == expected
+
+
+@pytest.mark.django_db
+def test_report_to_iterator_should_query_pks_in_chunks(admin_user, django_assert_num_queries):
+    publications = mixer.cycle(10).blend(Publication)
+    pks = [obj.pk for obj in publications if obj.pk != publications[4].pk]
+
+    rows, message = report.report_to_iterator(
+        Publication.objects.all(), ['id'], admin_user, chunk_size=3, pks=pks)
+
+    with django_assert_num_queries(3):
+        assert [row[0] for row in rows] == pks
+
+
+@pytest.mark.django_db
+def test_AdminExport_post_should_keep_order_of_selected_ids(admin_client, settings):
+    settings.EXPORT_ACTION_CHUNK_SIZE = 3
+    publications = mixer.cycle(7).blend(Publication)
+    pks = [publications[i].pk for i in (6, 0, 5, 1, 2, 3)]
+    params = {
+        'ct': ContentType.objects.get_for_model(Publication).pk,
+        'ids': ','.join(str(pk) for pk in pks),
+    }
+    url = "{}?{}".format(reverse('export_action:export'), urlencode(params))
+    response = admin_client.post(url, data={'id': 'on', '__format': 'csv'})
+    assert get_content(response).decode('utf-8').splitlines() == ['id'] + [
+        str(pk) for pk in pks]
+
+
+def test_get_model_index_should_be_cached_until_fields_cache_expires():
+    index = introspection.get_model_index(Article)
+
+    assert introspection.get_model_index(Article) is index
+    assert [f.name for f in index.direct_fields] == ['id', 'headline', 'status']
+    assert index.related_models['reporter'] is Reporter
+    assert index.related_models['reporter_id'] is Reporter
+    assert index.related_models['articletag'] is ArticleTag
+    assert 'reporter_id' not in [f.field_name_override for f in index.relation_fields]
+
+    Article._meta._expire_cache()
+    assert introspection.get_model_index(Article) is not index
+
+
+def test_compile_field_paths_should_resolve_each_relation_once():
+    paths = [
+        'headline', 'reporter__email', 'reporter__id', 'publications__title',
+        'articletag__tag__name', 'reporter__unknown', 'nothing__title', 'pk',
+    ]
+
+    plan = introspection.compile_field_paths(Article, paths)
+
+    assert introspection.compile_field_paths(Article, paths) is plan
+    assert [column.model for column in plan.columns] == [
+        Article, Reporter, Reporter, Publication, Tag, Reporter, Article, Article]
+    assert plan.models == (Article, Reporter, Publication, Tag)
+    assert plan.joins == ('reporter', 'publications', 'articletag__tag')
+    assert plan.invalid == ('reporter__unknown', 'nothing__title')
+
+
+@pytest.mark.django_db
+def test_report_to_list_should_skip_unknown_fields(admin_user):
+    publication = mixer.blend(Publication)
+
+    data, message = report.report_to_list(
+        Publication.objects.all(), ['title', 'article__unknown'], admin_user)
+
+    assert data == [[publication.title]]
+    assert message == 'Error: Unknown field article__unknown.'
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('backend, expected_calls', [
+    (CountingBackend, ['get_all_permissions']),
+    (HasPermOnlyBackend, [
+        'tests.change_article', 'tests.change_reporter', 'tests.view_reporter']),
+])
+def test_report_to_list_should_check_each_model_permission_once(
+        django_user_model, settings, backend, expected_calls):
+    settings.AUTHENTICATION_BACKENDS = ['{}.{}'.format(__name__, backend.__name__)]
+    backend.calls[:] = []
+    user = django_user_model.objects.create(username='staff', is_staff=True)
+    user.user_permissions.add(Permission.objects.get(codename='change_article'))
+    mixer.blend(Article)
+
+    data, message = report.report_to_list(
+        Article.objects.all(),
+        ['headline', 'reporter__email', 'reporter__first_name', 'reporter__last_name'],
+        user)
+
+    assert backend.calls == expected_calls
+    assert len(data[0]) == 1
+    assert message.count('Permission denied') == 3
+
+
+def test_get_string_agg_postgresql_should_join_distinct_text_values():
+    queryset = Article.objects.values('reporter').annotate(
+        titles=aggregates.get_string_agg('postgresql')('publications__title'))
+
+    assert "STRING_AGG(DISTINCT CAST(" in str(queryset.query)
+    assert "AS text), ',')" in str(queryset.query)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('database_aggregate', [True, False])
+def test_report_to_iterator_aggregate_should_return_one_row_per_object(
+        admin_user, monkeypatch, database_aggregate):
+    if not database_aggregate:
+        monkeypatch.setattr(report, 'get_string_agg', lambda vendor: None)
+    reporter = mixer.blend(Reporter)
+    publications = [mixer.blend(Publication, title=title) for title in ['a', 'b', 'c']]
+    tags = [mixer.blend(Tag, name=name) for name in ['x', 'y']]
+    first, second, empty = mixer.cycle(3).blend(
+        Article, reporter=reporter, headline=mixer.sequence('headline {0}'))
+    first.publications.add(*publications)
+    second.publications.add(publications[1])
+    for tag in tags:
+        mixer.blend(ArticleTag, article=first, tag=tag)
+
+    rows, message = report.report_to_iterator(
+        Article.objects.order_by('pk'),
+        ['headline', 'publications__title', 'reporter__email', 'articletag__tag__name'],
+        admin_user, chunk_size=2, aggregate=True)
+    rows = [
+        (headline, publications and sorted(publications.split(',')), email, tags and sorted(
+            tags.split(',')))
+        for headline, publications, email, tags in rows
+    ]
 
-    session_key = response.url[response.url.index('session_key=') + len('session_key='):]
-    session_ids = admin_client.session[session_key]
-    assert session_ids == [obj.pk for obj in objects]
+    assert rows == [
+        ('headline 0', ['a', 'b', 'c'], reporter.email, ['x', 'y']),
+        ('headline 1', ['b'], reporter.email, None),
+        ('headline 2', None, reporter.email, None),
+    ]
+
+
+@pytest.mark.django_db
+def test_AdminExport_post_with_aggregate_should_return_one_row_per_object(admin_client):
+    publications = mixer.cycle(5).blend(Publication)
+    mixer.cycle(3).blend(Article, publications=publications)
+
+    params = {
+        'ct': ContentType.objects.get_for_model(Article).pk,
+        'ids': ','.join(repr(pk) for pk in Article.objects.values_list('pk', flat=True))
+    }
+    data = {'headline': 'on', 'publications__title': 'on', '__format': 'csv'}
+    url = "{}?{}".format(reverse('export_action:export'), urlencode(params))
+
+    assert len(get_content(admin_client.post(url, data=data)).splitlines()) == 16
+    data['__aggregate'] = '1'
+    assert len(get_content(admin_client.post(url, data=data)).splitlines()) == 4
+
+
+@pytest.mark.django_db
+def test_report_to_iterator_should_compute_declared_columns_per_chunk(
+        admin_user, django_assert_num_queries):
+    reporters = mixer.cycle(4).blend(Reporter)
+    for reporter in reporters:
+        mixer.blend(Article, reporter=reporter)
+    queryset = Article.objects.order_by('pk')
+
+    rows, message = report.report_to_iterator(
+        queryset, ['headline', 'contact', 'reporter__first_name'], admin_user, chunk_size=2,
+        computed={'contact': ['reporter__email']})
+
+    # two queries per chunk of pk pagination, one per chunk of instances
+    with django_assert_num_queries(8):
+        rows = list(rows)
+    assert rows == [
+        (article.headline, article.reporter.email, article.reporter.first_name)
+        for article in queryset
+    ]
+
+
+@pytest.mark.django_db
+def test_AdminExport_should_offer_computed_fields_declared_in_model_admin(admin_client):
+    article = mixer.blend(Article)
+
+    params = {'ct': ContentType.objects.get_for_model(Article).pk, 'ids': article.pk}
+    url = "{}?{}".format(reverse('export_action:export'), urlencode(params))
+    response = admin_client.get(url)
+    assert 'name="contact"' in response.content.decode('utf-8')
+
+    response = admin_client.post(url, data={'contact': 'on', '__format': 'csv'})
+    assert get_content(response).decode('utf-8').splitlines() == [
+        'contact', article.reporter.email]
+
+
+@pytest.mark.django_db
+def test_report_to_iterator_should_compute_labels_and_formats_in_database(admin_user):
+    article = mixer.blend(Article, status=3)
+    tag = mixer.blend(ArticleTag, article=article)
+    mixer.blend(Article, status=2)
+    Article.objects.filter(pk=article.pk + 1).update(status=9)
+
+    rows, message = report.report_to_iterator(
+        Article.objects.order_by('pk'),
+        ['status', 'articletag__created_on', 'id'],
+        admin_user, labels=True,
+        formats={
+            'articletag__created_on': '%d/%m/%Y',
+            'id': lambda path: expressions.Cast(path, TextField()),
+        })
+
+    assert list(rows) == [
+        ('Published', tag.created_on.strftime('%d/%m/%Y'), str(article.pk)),
+        ('9', None, str(article.pk + 1)),
+    ]
+
+
+def test_DateFormat_should_reject_unsupported_directives():
+    with pytest.raises(ValueError):
+        expressions._translate_format('%Y %b', expressions.SQLITE_FORMATS)
+
+
+@pytest.mark.django_db
+def test_AdminExport_post_ndjson_should_keep_value_types(admin_client):
+    article = mixer.blend(Article, headline='caf\xe9 "1"', status=2)
+    tag = mixer.blend(ArticleTag, article=article)
+
+    params = {'ct': ContentType.objects.get_for_model(Article).pk, 'ids': article.pk}
+    data = {
+        'id': 'on', 'headline': 'on', 'reporter': 'on', 'articletag__created_on': 'on',
+        'contact': 'on', '__format': 'ndjson',
+    }
+    url = "{}?{}".format(reverse('export_action:export'), urlencode(params))
+    response = admin_client.post(url, data=data)
+
+    assert response['Content-Type'].startswith('application/x-ndjson')
+    assert response['Content-Disposition'].endswith('.ndjson')
+    lines = get_content(response).decode('utf-8').splitlines()
+    assert [json.loads(line, object_pairs_hook=OrderedDict) for line in lines] == [OrderedDict([
+        ('id', article.pk),
+        ('headline', 'caf\xe9 "1"'),
+        ('reporter', article.reporter.pk),
+        ('articletag__created_on', tag.created_on.isoformat()),
+        ('contact', article.reporter.email),
+    ])]
+
+
+def test_iter_ndjson_should_encode_values_of_unknown_types():
+    rows = [(Decimal('1.50'), datetime.date(2020, 1, 2), None, True)]
+    columns = [('price', None), ('day', None), ('missing', None), ('flag', None)]
+
+    content = b''.join(report.iter_ndjson(rows, columns)).decode('utf-8')
+
+    assert content == '{"price":"1.50","day":"2020-01-02","missing":null,"flag":true}\n'
+
+
+@pytest.mark.django_db
+def test_report_to_sheets_should_export_each_model_once(admin_user, django_assert_num_queries):
+    reporter = mixer.blend(Reporter)
+    publications = mixer.cycle(2).blend(Publication)
+    articles = mixer.cycle(3).blend(Article, reporter=reporter, publications=publications)
+    tag = mixer.blend(Tag)
+    mixer.blend(ArticleTag, article=articles[0], tag=tag)
+
+    sheets, message = report.report_to_sheets(
+        Article.objects.order_by('pk'),
+        ['headline', 'reporter__email', 'publications__title', 'articletag__tag__name'],
+        admin_user, chunk_size=10)
+
+    # two queries per sheet of objects: the bound of the chunk of pk
+    # pagination, and the rows; one per sheet of links
+    with django_assert_num_queries(12):
+        sheets = [(name, header, list(rows)) for name, header, rows in sheets]
+    assert sheets == [
+        ('article', ['id', 'headline', 'reporter'],
+         [(article.pk, article.headline, reporter.pk) for article in articles]),
+        ('reporter', ['id', 'email'], [(reporter.pk, reporter.email)]),
+        ('publications', ['id', 'title'], [(p.pk, p.title) for p in publications]),
+        ('articletag', ['id', 'tag'], [(articles[0].articletag_set.get().pk, tag.pk)]),
+        ('articletag__tag', ['id', 'name'], [(tag.pk, tag.name)]),
+        ('article_publications', ['article', 'publications'],
+         [(article.pk, p.pk) for article in articles for p in publications]),
+        ('article_articletag', ['article', 'articletag'],
+         [(articles[0].pk, articles[0].articletag_set.get().pk)]),
+    ]
+
+
+@pytest.mark.django_db
+def test_report_to_sheets_should_only_export_objects_related_to_selection(
+        admin_user, monkeypatch):
+    publications = mixer.cycle(3).blend(Publication)
+    articles = [
+        mixer.blend(Article, publications=publications[i:i + 2]) for i in range(2)]
+    mixer.blend(Article, publications=publications[2:])
+    pks = [article.pk for article in articles]
+    expected = [
+        ('article', ['id', 'reporter'], [
+            (article.pk, article.reporter.pk) for article in articles]),
+        ('reporter', ['id', 'email'], [
+            (article.reporter.pk, article.reporter.email) for article in articles]),
+        ('publications', ['id', 'title'], [(p.pk, p.title) for p in publications]),
+        ('article_publications', ['article', 'publications'], [
+            (article.pk, p.pk) for i, article in enumerate(articles)
+            for p in publications[i:i + 2]]),
+    ]
+
+    def get_sheets():
+        sheets, message = report.report_to_sheets(
+            Article.objects.all(), ['reporter__email', 'publications__title'], admin_user,
+            pks=pks)
+        return [(name, header, list(rows)) for name, header, rows in sheets]
+
+    assert get_sheets() == expected
+    # Selections too large for a query are de-duplicated in memory
+    monkeypatch.setattr(connection.ops, 'bulk_batch_size', lambda fields, objs: 1)
+    assert get_sheets() == expected
+
+
+@pytest.mark.django_db
+def test_AdminExport_post_normalize_should_write_a_sheet_per_model(admin_client):
+    articles = mixer.cycle(3).blend(Article, reporter=mixer.blend(Reporter))
+
+    params = {
+        'ct': ContentType.objects.get_for_model(Article).pk,
+        'ids': ','.join(repr(article.pk) for article in articles)
+    }
+    data = {'headline': 'on', 'reporter__email': 'on', '__format': 'xlsx', '__normalize': '1'}
+    url = "{}?{}".format(reverse('export_action:export'), urlencode(params))
+    response = admin_client.post(url, data=data)
+
+    wb = load_workbook(BytesIO(get_content(response)))
+    assert wb.sheetnames == ['article', 'reporter']
+    assert len(list(wb['article'].rows)) == 4
+    assert len(list(wb['reporter'].rows)) == 2
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('output_format', ['csv', 'xlsx'])
+def test_AdminExport_post_should_send_export_metrics(admin_client, settings, output_format):
+    settings.EXPORT_ACTION_METRICS_CALLBACKS = ['export_action.metrics.log_metrics']
+    mixer.cycle(3).blend(Publication)
+    received = []
+
+    def receiver(sender, **kwargs):
+        received.append((sender, kwargs['metrics']))
+
+    params = {
+        'ct': ContentType.objects.get_for_model(Publication).pk,
+        'ids': ','.join(repr(pk) for pk in Publication.objects.values_list('pk', flat=True))
+    }
+    url = "{}?{}".format(reverse('export_action:export'), urlencode(params))
+    export_finished.connect(receiver)
+    try:
+        response = admin_client.post(url, data={'title': 'on', '__format': output_format})
+        assert not received
+        content = get_content(response)
+    finally:
+        export_finished.disconnect(receiver)
+
+    (sender, export_metrics), = received
+    assert sender is Publication
+    assert export_metrics.completed
+    assert (export_metrics.format, export_metrics.rows, export_metrics.bytes) == (
+        output_format, 3, len(content))
+    assert export_metrics.query_time > 0
+    if output_format == 'xlsx':
+        assert export_metrics.serialization_time > 0
+    if metrics.resource is not None:
+        assert export_metrics.process_peak_rss_kb > 0
+        assert 0 <= export_metrics.peak_rss_growth_kb <= export_metrics.process_peak_rss_kb
+
+
+def test_statsd_metrics_should_send_counters_and_timers(settings):
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(5)
+    settings.EXPORT_ACTION_STATSD_HOST, settings.EXPORT_ACTION_STATSD_PORT = \
+        receiver.getsockname()
+    export_metrics = metrics.ExportMetrics(Publication, 'csv')
+    export_metrics.rows, export_metrics.bytes = 3, 120
+    export_metrics.query_time, export_metrics.completed = 0.5, True
+
+    metrics.statsd_metrics(export_metrics)
+
+    lines = receiver.recv(4096).decode('ascii').splitlines()
+    receiver.close()
+    assert lines[:4] == [
+        'export_action.csv.exports:1|c',
+        'export_action.csv.rows:3|c',
+        'export_action.csv.bytes:120|c',
+        'export_action.csv.query_time:500|ms',
+    ]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('method', ['gzip', 'zip'])
+def test_AdminExport_post_should_compress_streamed_exports(admin_client, method):
+    mixer.cycle(50).blend(Publication)
+
+    params = {
+        'ct': ContentType.objects.get_for_model(Publication).pk,
+        'ids': ','.join(repr(pk) for pk in Publication.objects.values_list('pk', flat=True))
+    }
+    data = {'id': 'on', 'title': 'on', '__format': 'csv', '__compression': method}
+    url = "{}?{}".format(reverse('export_action:export'), urlencode(params))
+    response = admin_client.post(url, data=data)
+
+    assert response.streaming
+    chunks = list(response.streaming_content)
+    if method == 'gzip':
+        assert response['Content-Type'] == 'application/gzip'
+        assert response['Content-Disposition'].endswith('.csv.gz')
+        content = gzip.GzipFile(fileobj=BytesIO(b''.join(chunks))).read()
+    else:
+        assert response['Content-Type'] == 'application/zip'
+        assert response['Content-Disposition'].endswith('.zip')
+        archive = zipfile.ZipFile(BytesIO(b''.join(chunks)))
+        assert archive.testzip() is None
+        name, = archive.namelist()
+        assert name.endswith('.csv')
+        content = archive.read(name)
+    lines = content.decode('utf-8').splitlines()
+    assert lines[1:] == [
+        '{},{}'.format(*row) for row in Publication.objects.values_list('pk', 'title')]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('output_format', ['parquet', 'arrow'])
+def test_AdminExport_post_columnar_should_type_columns_after_fields(
+        admin_client, settings, output_format):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet  # noqa
+    settings.EXPORT_ACTION_CHUNK_SIZE = 2
+    settings.EXPORT_ACTION_PARQUET_ROW_GROUP_SIZE = 4
+    articles = mixer.cycle(5).blend(Article, status=3)
+    mixer.blend(ArticleTag, article=articles[0])
+
+    params = {
+        'ct': ContentType.objects.get_for_model(Article).pk,
+        'ids': ','.join(repr(article.pk) for article in articles)
+    }
+    data = {
+        'id': 'on', 'headline': 'on', 'status': 'on', 'reporter': 'on',
+        'articletag__created_on': 'on', '__labels': '1', '__format': output_format,
+    }
+    url = "{}?{}".format(reverse('export_action:export'), urlencode(params))
+    response = admin_client.post(url, data=data)
+
+    assert response.streaming
+    assert 'filename=report_' in response['Content-Disposition']
+    chunks = list(response.streaming_content)
+    if output_format == 'parquet':
+        # batches of two rows are grouped in row groups of four
+        parquet_file = pa.parquet.ParquetFile(pa.BufferReader(b''.join(chunks)))
+        assert parquet_file.num_row_groups == 2
+        assert len(chunks) > 1
+        table = parquet_file.read()
+    else:
+        assert len(chunks) > 3
+        table = pa.ipc.open_file(pa.BufferReader(b''.join(chunks))).read_all()
+    assert table.schema.names == [
+        'id', 'headline', 'status', 'reporter', 'articletag__created_on']
+    assert table.schema.types[:4] == [pa.int64(), pa.string(), pa.string(), pa.int64()]
+    assert pa.types.is_timestamp(table.schema.types[4])
+    assert table.column('id').to_pylist() == [article.pk for article in articles]
+    assert table.column('status').to_pylist() == ['Published'] * 5
+
+
+@pytest.mark.django_db
+def test_columnar_exports_should_be_rejected_without_pyarrow(
+        admin_client, admin_user, monkeypatch):
+    monkeypatch.setattr(columnar, 'is_available', lambda: False)
+    mixer.blend(Publication)
+
+    response = post_export(admin_client, {'id': 'on', '__format': 'parquet'})
+    assert response.status_code == 400
+    assert not response.streaming
+
+    with pytest.raises(CommandError, match='pyarrow'):
+        call_command(
+            'export_action_dump', 'tests.Publication', 'id', user=admin_user.username,
+            format='arrow', stdout=BytesIO())
 
 
 @pytest.mark.django_db
@@ -173,7 +894,7 @@ def test_export_with_related_should_return_200(admin_client, output_format):
     url = "{}?{}".format(reverse('export_action:export'), urlencode(params))
     response = admin_client.post(url, data=data)
     assert response.status_code == 200
-    assert response.content
+    assert get_content(response)
 
     assert Article.objects.first().publications.count() == 5
     assert Article.objects.first().tags.count() == 1
@@ -191,3 +912,631 @@ def test_export_with_related_should_return_200(admin_client, output_format):
         url = reverse('admin:tests_article_change', args=[article.pk])
         response = admin_client.get(url)
         assert response.status_code == 200
+
+
+@pytest.fixture
+def export_job_settings(settings, tmpdir):
+    settings.MEDIA_ROOT = str(tmpdir.mkdir('media'))
+    settings.EXPORT_ACTION_STORAGE_OPTIONS = {'location': str(tmpdir.mkdir('exports'))}
+    settings.EXPORT_ACTION_EXECUTOR = 'export_action.jobs.ImmediateExecutor'
+    return settings
+
+
+def post_background_export(client, data):
+    params = {
+        'ct': ContentType.objects.get_for_model(Publication).pk,
+        'ids': ','.join(repr(pk) for pk in Publication.objects.values_list('pk', flat=True))
+    }
+    data = dict(data, __background='1')
+    url = "{}?{}".format(reverse('export_action:export'), urlencode(params))
+    return client.post(url, data=data)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_AdminExport_post_in_background_should_redirect_to_job(
+        admin_client, export_job_settings):
+    mixer.cycle(3).blend(Publication)
+
+    response = post_background_export(admin_client, {'title': 'on', '__format': 'csv'})
+
+    job = ExportJob.objects.get()
+    assert response.status_code == 302
+    assert response.url.endswith(job.get_absolute_url())
+    assert job.status == ExportJob.DONE
+    assert job.rows_total == job.rows_done == 3
+    assert job.get_fields() == ['title']
+
+    response = admin_client.get(job.get_absolute_url())
+    assert response.status_code == 200
+
+    response = admin_client.get(reverse('export_action:job_download', args=[job.pk]))
+    assert response.status_code == 200
+    lines = get_content(response).decode('utf-8').splitlines()
+    assert lines == ['title'] + list(Publication.objects.values_list('title', flat=True))
+
+
+@pytest.mark.django_db
+def test_export_action_worker_should_run_pending_jobs(admin_client, export_job_settings):
+    export_job_settings.EXPORT_ACTION_EXECUTOR = 'export_action.jobs.QueueExecutor'
+    mixer.cycle(3).blend(Publication)
+
+    post_background_export(admin_client, {'title': 'on', '__format': 'xlsx'})
+    job = ExportJob.objects.get()
+    assert job.status == ExportJob.PENDING
+    response = admin_client.get(reverse('export_action:job_download', args=[job.pk]))
+    assert response.status_code == 404
+
+    call_command('export_action_worker', once=True, stdout=six.StringIO())
+
+    job.refresh_from_db()
+    assert job.status == ExportJob.DONE
+    assert job.file.name.endswith('.xlsx')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_background_export_should_write_columnar_formats(admin_client, export_job_settings):
+    pa = pytest.importorskip('pyarrow')
+    mixer.cycle(3).blend(Publication)
+
+    post_background_export(admin_client, {'id': 'on', 'title': 'on', '__format': 'arrow'})
+
+    job = ExportJob.objects.get()
+    assert job.status == ExportJob.DONE
+    assert job.file.name.endswith('.arrow')
+    table = pa.ipc.open_file(job.file.path).read_all()
+    assert table.column('id').to_pylist() == list(Publication.objects.values_list('pk', flat=True))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_background_export_should_normalize_xlsx(admin_client, export_job_settings):
+    mixer.cycle(3).blend(Publication)
+
+    data = {'title': 'on', '__format': 'xlsx', '__normalize': '1', '__compression': 'zip'}
+    post_background_export(admin_client, data)
+
+    job = ExportJob.objects.get()
+    assert job.status == ExportJob.DONE
+    assert job.rows_done == 3
+    assert job.file.name.endswith('.zip')
+    with zipfile.ZipFile(job.file.path) as archive:
+        wb = load_workbook(BytesIO(archive.read(archive.namelist()[0])))
+    assert wb.sheetnames == ['publication']
+
+
+@pytest.mark.django_db
+def test_export_action_dump_should_stream_filtered_objects_to_a_file(admin_user, tmpdir):
+    reporter = mixer.blend(Reporter)
+    articles = mixer.cycle(4).blend(Article, reporter=reporter, status=mixer.sequence(1, 2))
+    pks_file = tmpdir.join('pks.txt')
+    pks_file.write('\n'.join(str(article.pk) for article in articles[1:]))
+
+    call_command(
+        'export_action_dump', 'tests.Article', 'id', 'reporter__email', 'status',
+        user=admin_user.username, filter=['status=2'], pks_file=str(pks_file),
+        order_by=['pk'], output=str(tmpdir), labels=True, stderr=six.StringIO())
+
+    output, = [path for path in tmpdir.listdir() if path.ext == '.csv']
+    assert output.basename.startswith('article_')
+    assert output.read_text('utf-8').splitlines() == ['id,reporter__email,status'] + [
+        '{},{},Revision'.format(article.pk, reporter.email)
+        for article in articles[1:] if article.status == 2
+    ]
+
+
+@pytest.mark.django_db
+def test_export_action_dump_should_parse_lookups_and_write_to_stdout(admin_user):
+    articles = mixer.cycle(3).blend(Article)
+    stdout = BytesIO()
+
+    call_command(
+        'export_action_dump', 'tests.Article', 'id', user=admin_user.username,
+        filter=['reporter__isnull=False'], exclude=['headline=null'], order_by=['pk'],
+        stdout=stdout)
+
+    assert stdout.getvalue().decode('utf-8').splitlines() == ['id'] + [
+        str(article.pk) for article in articles]
+
+
+@pytest.mark.django_db
+def test_export_action_dump_should_check_arguments(admin_user):
+    with pytest.raises(CommandError):
+        call_command('export_action_dump', 'tests.Nothing', 'id', user=admin_user.username)
+    with pytest.raises(CommandError):
+        call_command('export_action_dump', 'tests.Article', 'id', user='nobody')
+    with pytest.raises(CommandError):
+        call_command(
+            'export_action_dump', 'tests.Article', 'id', user=admin_user.username,
+            filter=['nothing=1'])
+
+
+@pytest.mark.django_db
+def test_get_shards_should_split_contiguous_pks(django_assert_num_queries):
+    publications = mixer.cycle(5).blend(Publication)
+    pks = [publication.pk for publication in publications]
+
+    # A count, and a single pass over the pks for the bounds of all shards
+    with django_assert_num_queries(2):
+        shards = parallel.get_shards(Publication.objects.all(), None, 3)
+    assert shards == [
+        ('range', (pks[0], pks[1])), ('range', (pks[1], pks[3])), ('range', (pks[3], None))]
+    shards = parallel.get_shards(Publication.objects.all(), None, 2)
+    assert shards == [('range', (pks[0], pks[2])), ('range', (pks[2], None))]
+    assert parallel.get_shards(Publication.objects.none(), None, 2) == []
+    shards = parallel.get_shards(Publication.objects.all(), pks[::-1], 2)
+    assert shards == [('pks', pks[:1:-1]), ('pks', pks[1::-1])]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('format', ['csv', 'ndjson'])
+def test_iter_export_in_parallel_should_concatenate_parts(admin_user, settings, format):
+    settings.EXPORT_ACTION_CHUNK_SIZE = 2
+    mixer.cycle(5).blend(Publication, title=mixer.sequence('title {0}'))
+    queryset = Publication.objects.all()
+    progress = []
+
+    chunks, filename, message = iter_export(
+        queryset, ['id', 'title'], format, admin_user, workers=2, progress=progress.append)
+
+    expected, _, _ = iter_export(queryset, ['id', 'title'], format, admin_user)
+    assert b''.join(chunks) == b''.join(expected)
+    assert progress == [1, 3, 5]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_background_export_in_parallel_should_keep_xlsx_in_one_sheet(
+        admin_client, export_job_settings):
+    export_job_settings.EXPORT_ACTION_CHUNK_SIZE = 2
+    export_job_settings.EXPORT_ACTION_PARALLEL_WORKERS = 2
+    export_job_settings.EXPORT_ACTION_EXECUTOR = 'export_action.jobs.QueueExecutor'
+    mixer.cycle(3).blend(Publication)
+
+    for format in ('csv', 'xlsx'):
+        post_background_export(admin_client, {'id': 'on', 'title': 'on', '__format': format})
+    call_command('export_action_worker', once=True, stdout=six.StringIO())
+
+    csv_job, xlsx_job = ExportJob.objects.order_by('pk')
+    assert csv_job.status == xlsx_job.status == ExportJob.DONE
+    assert xlsx_job.rows_done == 3
+    expected = [[publication.pk, publication.title] for publication in Publication.objects.all()]
+    assert csv_job.file.read().decode('utf-8').splitlines() == ['id,title'] + [
+        '{},{}'.format(*row) for row in expected]
+    wb = load_workbook(xlsx_job.file.path)
+    assert len(wb.worksheets) == 1
+    assert [[cell.value for cell in row] for row in wb.active.iter_rows()] == [
+        ['id', 'title']] + expected
+    assert not parallel.is_supported(Publication.objects.all(), 'xlsx')
+
+
+@pytest.mark.django_db
+def test_export_action_dump_should_export_in_parallel(admin_user, settings, tmpdir):
+    settings.EXPORT_ACTION_CHUNK_SIZE = 1
+    articles = mixer.cycle(3).blend(Article)
+
+    call_command(
+        'export_action_dump', 'tests.Article', 'id', user=admin_user.username,
+        order_by=['pk'], output=str(tmpdir.join('articles.csv')), workers=3)
+
+    lines = tmpdir.join('articles.csv').read_text('utf-8').splitlines()
+    assert lines == ['id'] + [str(article.pk) for article in articles]
+
+
+@pytest.fixture
+def result_cache_settings(settings, tmpdir):
+    settings.EXPORT_ACTION_STORAGE_OPTIONS = {'location': str(tmpdir)}
+    settings.EXPORT_ACTION_RESULT_CACHE = True
+    cache.clear()
+    yield settings
+    cache.clear()
+
+
+@pytest.mark.django_db
+def test_get_freshness_token_should_follow_freshness_field(
+        result_cache_settings, monkeypatch):
+    monkeypatch.setattr(
+        admin.site._registry[Article], 'export_freshness_field', 'articletag__created_on',
+        raising=False)
+    articles = mixer.cycle(2).blend(Article)
+    queryset = Article.objects.all()
+    tokens = [results.get_freshness_token(queryset, ['headline'])]
+
+    mixer.blend(ArticleTag, article=articles[0])
+    tokens.append(results.get_freshness_token(queryset, ['headline']))
+    articles[1].delete()
+    tokens.append(results.get_freshness_token(queryset, ['headline']))
+    assert len(set(tokens)) == 3
+
+
+def post_export(client, data, model=Publication):
+    params = {
+        'ct': ContentType.objects.get_for_model(model).pk,
+        'select_across': '1',
+    }
+    url = "{}?{}".format(reverse('export_action:export'), urlencode(params))
+    return client.post(url, data=data)
+
+
+@pytest.mark.django_db
+def test_AdminExport_post_should_serve_repeated_exports_from_result_cache(
+        admin_client, result_cache_settings, monkeypatch):
+    publication = mixer.blend(Publication, title='first')
+    data = {'id': 'on', 'title': 'on', '__format': 'csv', '__compression': 'gzip'}
+
+    content = get_content(post_export(admin_client, data))
+    response = post_export(admin_client, {'id': 'on', 'title': 'on', '__format': 'csv'})
+    assert gzip.decompress(content) == get_content(response)
+
+    with monkeypatch.context() as patched:
+        patched.setattr(report, 'report_to_iterator', None)
+        response = post_export(admin_client, data)
+    assert response['Content-Type'] == 'application/gzip'
+    assert response['Content-Disposition'].endswith('.csv.gz')
+    assert get_content(response) == content
+
+    publication.title = 'second'
+    publication.save()
+    response = post_export(admin_client, data)
+    assert gzip.decompress(get_content(response)).decode('utf-8').splitlines() == [
+        'id,title', '{},second'.format(publication.pk)]
+
+
+@pytest.mark.django_db
+def test_result_cache_should_evict_least_recently_used_results(result_cache_settings):
+    result_cache_settings.EXPORT_ACTION_RESULT_CACHE_MAX_SIZE = 10
+    for key in ('a', 'b'):
+        entry, lock = results.acquire(key)
+        assert entry is None
+        results.store(key, BytesIO(b'1234'), 'text/csv', 'report.csv', lock)
+    results.get_entry('a')
+
+    entry, lock = results.acquire('c')
+    assert entry is None
+    entry = results.store('c', BytesIO(b'1234'), 'text/csv', 'report.csv', lock)
+
+    assert results.get_entry('a') is not None
+    assert results.get_entry('b') is None
+    assert get_content(results.get_response(entry)) == b'1234'
+    results.clear()
+    assert results.get_entry('a') is None
+    assert not results.export_storage.exists(entry['name'])
+
+
+def test_result_cache_should_share_concurrent_builds(result_cache_settings):
+    result_cache_settings.EXPORT_ACTION_RESULT_CACHE_POLL = 0.01
+    entry, lock = results.acquire('key')
+    assert entry is None and lock
+    entries = []
+    waiting = threading.Thread(target=lambda: entries.append(results.acquire('key')))
+    waiting.start()
+
+    entry = results.store('key', BytesIO(b'data'), 'text/csv', 'report.csv', lock)
+    waiting.join()
+
+    assert entries == [(entry, None)]
+
+
+def test_result_cache_should_build_without_lock_when_waiting_too_long(result_cache_settings):
+    result_cache_settings.EXPORT_ACTION_RESULT_CACHE_POLL = 0.01
+    entry, lock = results.acquire('key', timeout=0.05)
+    assert entry is None and lock
+    assert results.acquire('key', timeout=0.05) == (None, None)
+
+    # Only the holder of the lock releases it
+    results.release('key', 'other')
+    assert results.acquire('key', timeout=0.05) == (None, None)
+    results.release('key', lock)
+    entry, other_lock = results.acquire('key', timeout=0.05)
+    assert other_lock and other_lock != lock
+
+
+@pytest.mark.django_db
+def test_result_cache_should_release_lock_of_responses_closed_unread(result_cache_settings):
+    entry, lock = results.acquire('key')
+    response = StreamingHttpResponse(iter([b'data']), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename=report.csv'
+    response = results.cache_response('key', lock, response)
+    response.close()
+
+    entry, lock = results.acquire('key', timeout=0)
+    assert entry is None and lock
+
+
+@pytest.mark.django_db
+def test_AdminExport_post_should_save_presets_run_in_one_click(admin_client, admin_user):
+    publications = mixer.cycle(2).blend(Publication, title=mixer.sequence('title {0}'))
+    params = {
+        'ct': ContentType.objects.get_for_model(Publication).pk,
+        'select_across': '1',
+        '_changelist_filters': 'id__exact={}'.format(publications[1].pk),
+    }
+    url = "{}?{}".format(reverse('export_action:export'), urlencode(params))
+    data = {'id': 'on', 'title': 'on', '__format': 'csv', '__preset': 'Last one'}
+    content = get_content(admin_client.post(url, data=data))
+
+    preset = ExportPreset.objects.get()
+    assert (preset.name, preset.user, preset.format) == ('Last one', admin_user, 'csv')
+    assert preset.get_plan()['fields'] == ['id', 'title']
+    assert 'Last one' in admin_client.get(url).content.decode('utf-8')
+
+    response = admin_client.post(preset.get_absolute_url())
+    assert response.status_code == 200
+    assert get_content(response) == content
+    assert content.decode('utf-8').splitlines() == [
+        'id,title', '{},{}'.format(publications[1].pk, publications[1].title)]
+
+    other = mixer.blend('auth.User', username='other', is_staff=True)
+    other.set_password('password')
+    other.save()
+    admin_client.login(username='other', password='password')
+    assert admin_client.post(preset.get_absolute_url()).status_code == 404
+
+
+@pytest.mark.django_db
+def test_ExportPreset_should_compile_again_when_schema_changes():
+    preset = ExportPreset(
+        name='articles', content_type=ContentType.objects.get_for_model(Article), format='csv')
+    preset.set_fields(['headline', 'reporter__email', 'contact', 'reporter__nothing'])
+    preset.compile()
+    preset.save()
+    plan = preset.get_plan()
+    assert plan['fields'] == ['headline', 'reporter__email', 'contact']
+    assert plan['invalid'] == ['reporter__nothing']
+    assert plan['paths']['joins'] == ['reporter']
+
+    preset.set_fields(['headline', 'status'])
+    ExportPreset.objects.filter(pk=preset.pk).update(fields=preset.fields, schema='outdated')
+    preset.refresh_from_db()
+    assert preset.get_plan()['fields'] == ['headline', 'status']
+    preset.refresh_from_db()
+    assert preset.schema == introspection.get_schema_fingerprint(Article, ['headline', 'status'])
+
+
+@pytest.mark.django_db
+def test_FieldTree_should_return_fields_and_relations_as_json(admin_client):
+    url = '{}?{}'.format(reverse('export_action:field_tree'), urlencode({
+        'ct': ContentType.objects.get_for_model(Article).pk,
+        'path': 'reporter__',
+        'depth': 2,
+    }))
+    response = admin_client.get(url)
+    assert response.status_code == 200
+    assert response['Content-Type'] == 'application/json'
+    tree = json.loads(get_content(response).decode('utf-8'))
+    assert tree['model'] == 'tests.reporter'
+    assert tree['path'] == 'reporter__'
+    assert 'reporter__email' in [field['path'] for field in tree['fields']]
+    articles = [relation for relation in tree['relations'] if relation['name'] == 'article']
+    assert articles[0]['path'] == 'reporter__article__'
+    assert articles[0]['to_many']
+    assert 'reporter__article__headline' in [
+        field['path'] for field in articles[0]['children']['fields']]
+
+
+@pytest.mark.django_db
+def test_FieldTree_should_answer_not_modified_to_matching_etag(admin_client, settings):
+    settings.EXPORT_ACTION_FIELD_TREE_CACHE_CONTROL = 'public, max-age=60'
+    url = '{}?{}'.format(reverse('export_action:field_tree'), urlencode({
+        'ct': ContentType.objects.get_for_model(Article).pk,
+    }))
+    response = admin_client.get(url)
+    assert response['Cache-Control'] == 'public, max-age=60'
+    etag = response['ETag']
+    assert etag.startswith('"')
+
+    response = admin_client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response['ETag'] == etag
+    assert not response.content
+
+    assert admin_client.get(url, HTTP_IF_NONE_MATCH='"other"').status_code == 200
+
+
+@pytest.mark.django_db
+def test_FieldTree_should_return_404_for_unknown_relations(admin_client):
+    url = '{}?{}'.format(reverse('export_action:field_tree'), urlencode({
+        'ct': ContentType.objects.get_for_model(Article).pk,
+        'path': 'headline__',
+    }))
+    assert admin_client.get(url).status_code == 404
+    url = '{}?{}'.format(reverse('export_action:field_tree'), urlencode({
+        'ct': ContentType.objects.get_for_model(ArticleTag).pk,
+    }))
+    assert admin_client.get(url).status_code == 404
+
+
+@pytest.mark.django_db
+def test_result_cache_key_should_depend_on_queryset_of_selection(
+        admin_user, result_cache_settings):
+    publications = mixer.cycle(2).blend(Publication)
+    pks = [publication.pk for publication in publications]
+    keys = set(
+        results.get_key(queryset, ['id', 'title'], 'csv', admin_user, pks=pks)
+        for queryset in (Publication.objects.all(), Publication.objects.filter(title='nothing')))
+    assert len(keys) == 2
+
+
+@pytest.mark.django_db
+def test_ExportPreset_should_export_objects_selected_when_saved(admin_client):
+    publications = mixer.cycle(5).blend(Publication)
+    params = {
+        'ct': ContentType.objects.get_for_model(Publication).pk,
+        'ids': publications[2].pk,
+    }
+    url = "{}?{}".format(reverse('export_action:export'), urlencode(params))
+    data = {'id': 'on', '__format': 'csv', '__preset': 'Third one'}
+    content = get_content(admin_client.post(url, data=data))
+    assert content.decode('utf-8').splitlines() == ['id', str(publications[2].pk)]
+
+    preset = ExportPreset.objects.get()
+    assert get_content(admin_client.post(preset.get_absolute_url())) == content
+
+
+@pytest.mark.django_db
+def test_ExportPresetRun_should_reuse_compiled_plan(admin_client, monkeypatch):
+    articles = mixer.cycle(2).blend(Article, reporter=mixer.blend(Reporter))
+    preset = ExportPreset(
+        name='articles', content_type=ContentType.objects.get_for_model(Article), format='csv')
+    preset.set_fields(['headline', 'reporter__email'])
+    preset.compile()
+    preset.save()
+    url = preset.get_absolute_url()
+    assert admin_client.get(url).status_code == 405
+    content = get_content(admin_client.post(url))
+
+    def fail(*args):
+        raise AssertionError("Fields compiled again")
+
+    with monkeypatch.context() as patched:
+        patched.setattr(report, 'compile_field_paths', fail)
+        patched.setattr(introspection, 'compile_field_paths', fail)
+        assert get_content(admin_client.post(url)) == content
+    assert content.decode('utf-8').splitlines() == ['headline,reporter__email'] + [
+        '{},{}'.format(article.headline, article.reporter.email)
+        for article in sorted(articles, key=lambda article: article.headline)]
+
+
+@pytest.mark.skipif(not hasattr(transaction, 'on_commit'), reason="Django>=1.9 only")
+@pytest.mark.django_db(transaction=True)
+def test_start_job_should_submit_job_once_committed(admin_user, export_job_settings):
+    mixer.cycle(3).blend(Publication)
+
+    with transaction.atomic():
+        job = jobs.start_job(Publication.objects.all(), ['title'], 'csv', admin_user)
+        job.refresh_from_db()
+        assert job.status == ExportJob.PENDING
+
+    job.refresh_from_db()
+    assert job.status == ExportJob.DONE
+
+
+@pytest.mark.django_db(transaction=True)
+def test_background_export_in_threads_should_not_fork(
+        admin_user, export_job_settings, monkeypatch):
+    export_job_settings.EXPORT_ACTION_PARALLEL_WORKERS = 2
+    export_job_settings.EXPORT_ACTION_EXECUTOR = 'export_action.jobs.QueueExecutor'
+    monkeypatch.setattr(parallel, 'export_parts', None)
+    mixer.cycle(3).blend(Publication)
+
+    job = jobs.start_job(Publication.objects.all(), ['title'], 'csv', admin_user)
+    # What threads of `ThreadPoolExecutor` run
+    jobs._run_job_in_thread(job.pk)
+    job.refresh_from_db()
+    assert job.status == ExportJob.DONE
+
+
+@pytest.mark.django_db(transaction=True)
+def test_job_files_should_be_private_and_deleted_once_expired(
+        admin_user, export_job_settings, tmpdir):
+    mixer.cycle(3).blend(Publication)
+    job = jobs.start_job(Publication.objects.all(), ['title'], 'csv', admin_user)
+    job.refresh_from_db()
+    assert job.file.path.startswith(str(tmpdir.join('exports')))
+    assert len(job.file.name.split('/')[1]) == 32
+    assert not tmpdir.join('media').listdir()
+
+    path = job.file.path
+    ExportJob.objects.filter(pk=job.pk).update(
+        finished_on=timezone.now() - datetime.timedelta(days=2))
+    jobs.delete_expired_jobs()
+    assert not ExportJob.objects.filter(pk=job.pk).exists()
+    assert not os.path.exists(path)
+
+
+@pytest.mark.django_db
+def test_result_cache_should_not_serve_users_without_model_permission(
+        admin_client, client, django_user_model, result_cache_settings):
+    mixer.blend(Article)
+    data = {'reporter__email': 'on', '__format': 'csv'}
+    content = get_content(post_export(admin_client, data, model=Article))
+    assert content.decode('utf-8').splitlines()[0] == 'reporter__email'
+
+    user = django_user_model.objects.create(username='staff', is_staff=True)
+    user.set_password('password')
+    user.save()
+    user.user_permissions.add(Permission.objects.get(codename='change_reporter'))
+    assert results.get_key(Article.objects.all(), ['reporter__email'], 'csv', user) is None
+    client.login(username='staff', password='password')
+    assert get_content(post_export(client, data, model=Article)) != content
+
+
+@pytest.mark.django_db
+def test_result_cache_key_should_change_with_computed_and_filtered_models(
+        admin_user, result_cache_settings):
+    article = mixer.blend(Article)
+    computed = {'contact': ['reporter__email']}
+
+    def get_key(queryset, fields):
+        return results.get_key(queryset, fields, 'csv', admin_user, options={'computed': computed})
+
+    queryset = Article.objects.all()
+    key = get_key(queryset, ['contact'])
+    article.reporter.email = 'other@example.com'
+    article.reporter.save()
+    assert get_key(queryset, ['contact']) != key
+
+    queryset = Article.objects.filter(publications__title='first')
+    key = get_key(queryset, ['headline'])
+    mixer.blend(Publication)
+    assert get_key(queryset, ['headline']) != key
+
+
+@pytest.mark.django_db
+def test_result_cache_eviction_should_only_count_kept_results(result_cache_settings):
+    result_cache_settings.EXPORT_ACTION_RESULT_CACHE_MAX_SIZE = 10
+    for key in ('a', 'b'):
+        entry, lock = results.acquire(key)
+        results.store(key, BytesIO(b'1234'), 'text/csv', 'report.csv', lock)
+    cache.delete(results.ENTRY_PREFIX + 'b')
+
+    entry, lock = results.acquire('c')
+    results.store('c', BytesIO(b'1234'), 'text/csv', 'report.csv', lock)
+
+    assert results.get_entry('a') is not None
+    assert results.get_entry('c') is not None
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('workers', [1, 2])
+def test_export_header_should_match_rows_without_denied_and_unknown_columns(
+        client, django_user_model, workers):
+    article = mixer.blend(Article, headline='h1')
+    user = django_user_model.objects.create(username='staff', is_staff=True)
+    user.set_password('password')
+    user.save()
+    user.user_permissions.add(Permission.objects.get(codename='change_article'))
+    fields = ['reporter__email', 'headline', 'bogus__x']
+
+    chunks, filename, message = iter_export(
+        Article.objects.order_by('pk'), fields, 'csv', user, workers=workers)
+    assert b''.join(chunks).decode('utf-8').splitlines() == ['headline', 'h1']
+    assert 'reporter__email' in message and 'bogus__x' in message
+
+    client.login(username='staff', password='password')
+    params = {'ct': ContentType.objects.get_for_model(Article).pk, 'ids': article.pk}
+    url = "{}?{}".format(reverse('export_action:export'), urlencode(params))
+    response = client.post(url, data=dict(dict.fromkeys(fields, 'on'), __format='csv'))
+    assert get_content(response).decode('utf-8').splitlines() == ['headline', 'h1']
+    response = client.get(reverse('admin:index'))
+    assert 'bogus__x' in ' '.join(str(m) for m in response.context['messages'])
+
+
+@pytest.mark.django_db
+def test_AdminExport_post_select_across_should_not_count_objects(admin_client):
+    mixer.cycle(3).blend(Publication)
+    data = {'id': 'on', '__format': 'csv'}
+
+    with CaptureQueriesContext(connection) as queries:
+        content = get_content(post_export(admin_client, data))
+    assert len(content.splitlines()) == 4
+    assert not [query for query in queries if 'COUNT(' in query['sql'].upper()]
+
+
+@pytest.mark.django_db
+def test_AdminExport_should_reject_invalid_changelist_filters(admin_client):
+    params = {
+        'ct': ContentType.objects.get_for_model(Publication).pk,
+        'select_across': '1',
+        '_changelist_filters': 'bogus__x=1',
+    }
+    url = "{}?{}".format(reverse('export_action:export'), urlencode(params))
+    assert admin_client.get(url).status_code == 400
+    assert admin_client.post(url, data={'id': 'on', '__format': 'csv'}).status_code == 400